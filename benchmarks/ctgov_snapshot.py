@@ -0,0 +1,87 @@
+'''
+Ingest a synthetic ClinicalTrials.gov bulk export (zip of per-study JSON) into
+utils.ctgov_snapshot and time local searches and NCT lookups; each search is
+checked against a scan of every study.
+
+python -m benchmarks.ctgov_snapshot
+python -m benchmarks.ctgov_snapshot --n_studies 20000
+'''
+
+import os
+import json
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+from utils.ctgov_snapshot import CTGovSnapshot, search_phrases, phrase_pattern, indexed_columns
+from utils.drug_search import read_pytrials_fields
+
+drugs = ['aspirin', 'acetylsalicylic acid', 'ibuprofen', 'zelquistinel', 'rapastinel', 'ketamine', 'esketamine',
+	'pembrolizumab', 'nivolumab', 'cadonilimab', 'metformin', 'semaglutide', 'AGN-241751', 'GATE-202']
+conditions = ['Major Depressive Disorder', 'Bladder Cancer', 'Type 2 Diabetes', 'Pain', 'Fever',
+	'Treatment Resistant Depression', 'Renal Cell Carcinoma', 'Obesity', 'Migraine']
+sponsors = ['Gate Neurosciences', 'Allergan', 'Merck Sharp & Dohme LLC', 'Tongji Hospital', 'Novo Nordisk A/S', 'Bayer']
+
+def synthetic_study(s_index, rng):
+	nct_id = f'NCT{s_index:08d}'
+	return {
+		'protocolSection': {
+			'identificationModule': {'nctId': nct_id, 'briefTitle': f'Study {s_index}'},
+			'statusModule': {
+				'overallStatus': rng.choice(['COMPLETED', 'RECRUITING', 'TERMINATED']),
+				'startDateStruct': {'date': f'{rng.randint(2000, 2024)}-{rng.randint(1, 12):02d}'},
+				'lastUpdatePostDateStruct': {'date': f'{rng.randint(2015, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'},
+			},
+			'sponsorCollaboratorsModule': {'leadSponsor': {'name': rng.choice(sponsors), 'class': 'INDUSTRY'}},
+			'conditionsModule': {'conditions': rng.sample(conditions, 2)},
+			'designModule': {'phases': [rng.choice(['PHASE1', 'PHASE2', 'PHASE3'])], 'enrollmentInfo': {'count': rng.randint(10, 2000)}},
+			'armsInterventionsModule': {'interventions': [{'type': 'DRUG', 'name': drug} for drug in rng.sample(drugs, 2)]},
+		},
+		'hasResults': rng.random() < 0.3,
+	}
+
+def write_export(zip_path, n_studies, seed=0):
+	rng = random.Random(seed)
+	with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+		for s_index in range(n_studies):
+			archive.writestr(f'NCT{s_index // 10000:04d}xxxx/NCT{s_index:08d}.json', json.dumps(synthetic_study(s_index, rng)))
+
+def scan(snapshot, search_expr):
+	# every study, no index
+	matches = set()
+	phrases = [phrase_pattern(words) for words in search_phrases(search_expr)]
+	for nct_number, record in snapshot.records([row[0] for row in snapshot.db.execute('SELECT nct_number FROM studies')]):
+		text = [str(record.get(column) or '').lower() for column in indexed_columns]
+		if any(pattern.search(value) for pattern in phrases for value in text):
+			matches.add(nct_number)
+	return matches
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Local CT.gov snapshot ingest and search timings')
+	parser.add_argument('--n_studies', type=int, default=5000)
+	parser.add_argument('--number', type=int, default=20, help='timing repetitions per search')
+	args = parser.parse_args()
+	ct_fields = read_pytrials_fields()
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		zip_path = os.path.join(tmp_dir, 'export.zip')
+		write_export(zip_path, args.n_studies)
+		print(f'{args.n_studies} studies, {os.path.getsize(zip_path)/1e6:.1f} MB zip')
+		snapshot = CTGovSnapshot(os.path.join(tmp_dir, 'snapshot.sqlite'))
+		snapshot.ingest_zip(zip_path)
+		print(f'{"search":<45} {"studies":>8} {"find ms":>8} {"search ms":>10}')
+		for search_expr in ['aspirin', 'acetylsalicylic+acid', 'agn-241751', 'merck', '%22ketamine%22%20OR%20%22esketamine%22', 'bladder+cancer', 'not+a+drug']:
+			expected = scan(snapshot, search_expr)
+			assert snapshot.find(search_expr) == expected, f'index and scan disagree on {search_expr}'
+			start_time = time.perf_counter()
+			for _ in range(args.number):
+				snapshot.find(search_expr)
+			find_time = (time.perf_counter() - start_time)/args.number*1000
+			start_time = time.perf_counter()
+			ct_output = snapshot.search(search_expr, ct_fields)
+			search_time = (time.perf_counter() - start_time)*1000
+			print(f'{search_expr:<45} {len(ct_output) - 1:>8} {find_time:>8.2f} {search_time:>10.1f}')
+		start_time = time.perf_counter()
+		for s_index in range(0, args.n_studies, max(1, args.n_studies // 1000)):
+			assert snapshot.get_study(f'NCT{s_index:08d}') is not None
+		print(f'NCT lookup: {(time.perf_counter() - start_time)/min(args.n_studies, 1000)*1000:.3f} ms')
@@ -0,0 +1,69 @@
+'''
+Flattening pages of openFDA results: the previous get_fda_api_data loop called
+on each result (as the store ingest did; first product/submission only, later
+keys overwriting earlier ones) vs utils.openfda_flatten: flatten_records (the
+same rows and names) and flatten_results (every result, product
+and submission, columnar), with the rows each one keeps.
+
+python -m benchmarks.openfda_flatten
+python -m benchmarks.openfda_flatten --n_results 100000 --page_size 1000
+'''
+
+import time
+import random
+import argparse
+from collections import defaultdict
+from benchmarks.openfda_store import synthetic_result
+from utils.openfda_flatten import flatten_results, flatten_records
+
+def nested_loop_flatten(drug_key, api_results, fda_api_dict):
+	# get_fda_api_data before the compiled plan
+	for key in api_results[0].keys():
+		if type(api_results[0][key]) == list:
+			if type(api_results[0][key][0]) == dict:
+				for app_key in api_results[0][key][0].keys():
+					fda_api_dict[drug_key][app_key] = api_results[0][key][0][app_key]
+			else:
+				fda_api_dict[drug_key][key] = api_results[0][key]
+		elif type(api_results[0][key]) == str:
+			fda_api_dict[drug_key][key] = api_results[0][key]
+		elif type(api_results[0][key]) == dict:
+			for app_key in api_results[0][key].keys():
+				fda_api_dict[drug_key][app_key] = api_results[0][key][app_key]
+	return fda_api_dict
+
+def make_pages(dataset, n_results, page_size, seed=0):
+	rng = random.Random(seed)
+	results = [synthetic_result(dataset, r_index, rng) for r_index in range(n_results)]
+	if dataset == 'drugsfda':
+		# most applications have a few products and submissions
+		for result in results:
+			result['products'] += [dict(result['products'][0], product_number=f'{p_index:03d}') for p_index in range(rng.randint(0, 3))]
+			result['submissions'] += [dict(result['submissions'][0], submission_type='SUPPL', submission_number=str(s_index)) for s_index in range(rng.randint(0, 6))]
+	return [results[p_index:p_index + page_size] for p_index in range(0, n_results, page_size)]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='openFDA result flattening timings')
+	parser.add_argument('--n_results', type=int, default=20000)
+	parser.add_argument('--page_size', type=int, default=100)
+	args = parser.parse_args()
+	print(f'{"dataset":<10} {"method":<22} {"seconds":>8} {"rows kept":>28}')
+	for dataset in ['drugsfda', 'label']:
+		pages = make_pages(dataset, args.n_results, args.page_size)
+		start_time = time.perf_counter()
+		fda_api_dict = defaultdict(lambda: defaultdict(list))
+		for page in pages:
+			for result in page:
+				nested_loop_flatten(len(fda_api_dict), [result], fda_api_dict)
+		print(f'{dataset:<10} {"nested loop":<22} {time.perf_counter() - start_time:>8.3f} {len(fda_api_dict):>28}')
+		start_time = time.perf_counter()
+		for page in pages:
+			flatten_records(page, dataset)
+		print(f'{dataset:<10} {"plan (records)":<22} {time.perf_counter() - start_time:>8.3f} {args.n_results:>28}')
+		start_time = time.perf_counter()
+		n_rows = defaultdict(int)
+		for page in pages:
+			for table, columns in flatten_results(page, dataset).items():
+				n_rows[table] += len(next(iter(columns.values())))
+		kept = ', '.join([f'{table} {n}' for table, n in n_rows.items()])
+		print(f'{dataset:<10} {"plan (tables)":<22} {time.perf_counter() - start_time:>8.3f} {kept:>28}')
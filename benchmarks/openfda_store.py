@@ -0,0 +1,89 @@
+'''
+Ingest synthetic openFDA bulk downloads (Drugs@FDA and label zips) into
+utils.openfda_store and time name/application lookups and a full-dataset
+read; each lookup is checked against a scan of the raw results.
+
+python -m benchmarks.openfda_store
+python -m benchmarks.openfda_store --n_results 50000 --partition_rows 2000
+'''
+
+import os
+import json
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+import tracemalloc
+from utils.openfda_store import OpenFDAStore, iter_zip_results, fda_name_key, fda_result_names
+
+def synthetic_result(dataset, r_index, rng):
+	brand_name = f'BRAND{r_index % 5000}'
+	generic_name = f'generic {r_index % 3000}'
+	openfda = {'brand_name': [brand_name], 'generic_name': [generic_name], 'application_number': [f'NDA{r_index:06d}']}
+	if dataset == 'drugsfda':
+		return {
+			'application_number': f'NDA{r_index:06d}',
+			'sponsor_name': rng.choice(['ALLERGAN', 'MERCK SHARP DOHME', 'NOVO NORDISK', 'BAYER']),
+			'openfda': openfda,
+			'products': [{'brand_name': brand_name, 'dosage_form': rng.choice(['TABLET', 'INJECTION']), 'marketing_status': 'Prescription',
+				'active_ingredients': [{'name': generic_name.upper(), 'strength': f'{rng.randint(1, 500)}MG'}]}],
+			'submissions': [{'submission_type': 'ORIG', 'submission_number': '1', 'submission_status': 'AP',
+				'submission_status_date': f'{rng.randint(1990, 2024)}0{rng.randint(1, 9)}15'}],
+		}
+	return {
+		'id': f'label-{r_index}',
+		'effective_time': f'{rng.randint(2010, 2024)}0101',
+		'openfda': openfda,
+		'indications_and_usage': [f'{brand_name} is indicated for ' + ' '.join(rng.choice(['pain', 'depression', 'fever', 'diabetes']) for _ in range(40))],
+		'warnings': ['Warning text ' * rng.randint(10, 60)],
+	}
+
+def write_download(zip_path, dataset, n_results, seed=0):
+	# same layout as the bulk files: {"meta": {..., "results": {...}}, "results": [...]}
+	rng = random.Random(seed)
+	with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+		with archive.open(os.path.basename(zip_path)[:-4], 'w') as f:
+			f.write(json.dumps({'meta': {'disclaimer': 'synthetic', 'results': {'skip': 0, 'limit': n_results, 'total': n_results}}}).encode()[:-1])
+			f.write(b', "results": [\n')
+			for r_index in range(n_results):
+				f.write((',\n' if r_index else '').encode() + json.dumps(synthetic_result(dataset, r_index, rng)).encode())
+			f.write(b'\n]}')
+
+def scan(zip_path, name):
+	# positions of the results a name matches, reading every result
+	key = fda_name_key(name)
+	return [r_index for r_index, result in enumerate(iter_zip_results(zip_path)) if key in fda_result_names(result)]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Local openFDA store ingest and lookup timings')
+	parser.add_argument('--n_results', type=int, default=20000)
+	parser.add_argument('--partition_rows', type=int, default=5000)
+	parser.add_argument('--number', type=int, default=200, help='lookups timed per dataset')
+	args = parser.parse_args()
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		store = OpenFDAStore(os.path.join(tmp_dir, 'openfda'))
+		for dataset in ['drugsfda', 'label']:
+			zip_path = os.path.join(tmp_dir, f'drug-{dataset}-0001-of-0001.json.zip')
+			write_download(zip_path, dataset, args.n_results)
+			print(f'{dataset}: {args.n_results} results, {os.path.getsize(zip_path)/1e6:.1f} MB zip')
+			tracemalloc.start()
+			store.ingest(dataset, [zip_path], args.partition_rows)
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			print(f'  ingest peak memory: {peak/1e6:.1f} MB')
+			for name in ['BRAND7', 'generic 11', 'not a drug']:
+				assert len(store.lookup(dataset, name)) == len(scan(zip_path, name)), f'index and scan disagree on {name}'
+			rng = random.Random(1)
+			names = [f'BRAND{rng.randrange(5000)}' for _ in range(args.number)]
+			start_time = time.perf_counter()
+			for name in names:
+				store.first(dataset, name)
+			print(f'  name lookup: {(time.perf_counter() - start_time)/args.number*1000:.3f} ms')
+			start_time = time.perf_counter()
+			for name in sorted(names):
+				store.first(dataset, name)
+			print(f'  name lookup (sorted names): {(time.perf_counter() - start_time)/args.number*1000:.3f} ms')
+			start_time = time.perf_counter()
+			n_rows = sum([len(df) for df in store.iter_frames(dataset, ['brand_name', 'generic_name'] if dataset == 'label' else ['application_number', 'sponsor_name'])])
+			print(f'  {n_rows} rows read (2 columns) in {time.perf_counter() - start_time:.2f}s')
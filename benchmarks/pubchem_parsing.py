@@ -0,0 +1,92 @@
+'''
+Parse time and peak parse memory of the PubChem XML responses: BeautifulSoup+lxml
+(the previous parser) vs incremental iterparse (utils.pubchem_parsing). Both
+parse a body that is already in memory, which the peaks don't include.
+
+python -m benchmarks.pubchem_parsing databases/cassettes/crossbridge.jsonl
+python -m benchmarks.pubchem_parsing   # synthetic payloads sized like a well-studied compound
+'''
+
+import timeit
+import argparse
+import warnings
+import tracemalloc
+from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
+from utils.cassettes import load_interactions, interaction_body
+from utils.pubchem_parsing import first_information
+# the old path parsed XML with the lxml HTML parser
+warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
+
+# PUG REST operation -> repeated element
+operations = {
+	'synonyms': 'Synonym',
+	'PubMedID': 'PubMedID',
+	'PatentID': 'PatentID',
+}
+
+def soup_values(content, field):
+	soup = BeautifulSoup(content, features='lxml')
+	information = soup.find_all("information")
+	if len(information) == 0:
+		return None
+	return [value.get_text() for value in information[0].find_all(field.lower())]
+
+def iterparse_values(content, field):
+	information = first_information(content, [field])
+	if information is None:
+		return None
+	return information.get(field, [])
+
+def synthetic_payload(field, n_values):
+	values = ''.join([f'<{field}>{10000000 + i if field != "Synonym" else f"synonym-{i}"}</{field}>' for i in range(n_values)])
+	return (
+		'<?xml version="1.0"?>\n<InformationList xmlns="http://pubchem.ncbi.nlm.nih.gov/pug_rest">'
+		f'<Information><CID>2244</CID>{values}</Information></InformationList>'
+	).encode('utf-8')
+
+def recorded_payloads(cassette_paths):
+	payloads = []
+	for path in cassette_paths:
+		for interaction in load_interactions(path).values():
+			url = interaction['url']
+			if '/rest/pug/' not in url or not url.endswith('/XML') or interaction['status_code'] != 200:
+				continue
+			for operation, field in operations.items():
+				if f'/{operation}/' in url:
+					payloads.append((url, field, interaction_body(interaction)))
+	return payloads
+
+def peak_memory(func, *args):
+	tracemalloc.start()
+	func(*args)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return peak
+
+def benchmark(payloads, number=5):
+	print(f'{"payload":<60} {"size":>9} {"n":>7} {"bs4 ms":>9} {"iterparse ms":>13} {"bs4 MB":>8} {"iterparse MB":>13}')
+	totals = [0, 0, 0, 0]
+	for name, field, content in payloads:
+		soup_result = soup_values(content, field)
+		iterparse_result = iterparse_values(content, field)
+		assert soup_result == iterparse_result, f'parsers disagree on {name}'
+		times = [timeit.timeit(lambda: func(content, field), number=number)/number*1000 for func in [soup_values, iterparse_values]]
+		peaks = [peak_memory(func, content, field)/1e6 for func in [soup_values, iterparse_values]]
+		totals = [total + value for total, value in zip(totals, times + peaks)]
+		n_values = len(iterparse_result) if iterparse_result is not None else 0
+		print(f'{name[-60:]:<60} {len(content):>9} {n_values:>7} {times[0]:>9.1f} {times[1]:>13.1f} {peaks[0]:>8.1f} {peaks[1]:>13.1f}')
+	print(f'{"total":<60} {"":>9} {"":>7} {totals[0]:>9.1f} {totals[1]:>13.1f} {totals[2]:>8.1f} {totals[3]:>13.1f}')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='BeautifulSoup vs iterparse of PubChem XML responses')
+	parser.add_argument('cassettes', nargs='*', help='cassette files with recorded PubChem responses')
+	parser.add_argument('--number', type=int, default=5, help='timing repetitions per payload')
+	args = parser.parse_args()
+	payloads = recorded_payloads(args.cassettes)
+	if not payloads:
+		print('No recorded PubChem XML responses, using synthetic payloads')
+		payloads = [
+			(f'synthetic {field} x {n_values}', field, synthetic_payload(field, n_values))
+			for field, n_values in [('Synonym', 500), ('Synonym', 5000), ('PubMedID', 1000), ('PubMedID', 30000), ('PatentID', 10000)]
+		]
+	benchmark(payloads, args.number)
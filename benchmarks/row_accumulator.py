@@ -0,0 +1,54 @@
+'''
+Building a ctgov-shaped DataFrame (27 string columns) one row at a time:
+per-row pd.concat (the previous builders) vs RowAccumulator.
+
+python -m benchmarks.row_accumulator
+python -m benchmarks.row_accumulator --max_concat_rows 100000   # also time concat at 100k (slow)
+'''
+
+import time
+import argparse
+import pandas as pd
+from utils.row_accumulator import RowAccumulator
+
+columns = ['Drug Name', 'Search Term', 'NCT Number', 'Study Title', 'Study URL', 'Acronym',
+	'Study Status', 'Brief Summary', 'Study Results', 'Conditions', 'Interventions',
+	'Primary Outcome Measures', 'Secondary Outcome Measures', 'Sponsor', 'Collaborators',
+	'Sex', 'Age', 'Phases', 'Enrollment', 'Funder Type', 'Study Type', 'Start Date',
+	'Primary Completion Date', 'Completion Date', 'First Posted', 'Last Update Posted', 'Locations']
+
+def make_rows(n_rows):
+	return [[f'{column} {r_index}' for column in columns] for r_index in range(n_rows)]
+
+def build_concat(rows):
+	df = pd.DataFrame(columns=columns)
+	for row in rows:
+		df = pd.concat([df, pd.DataFrame(row, index=columns).T], ignore_index=True)
+	return df
+
+def build_accumulator(rows):
+	accumulator = RowAccumulator(columns)
+	for row in rows:
+		accumulator.append(row)
+	return accumulator.to_frame()
+
+def timed(func, rows):
+	start_time = time.perf_counter()
+	df = func(rows)
+	return time.perf_counter() - start_time, df
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='per-row pd.concat vs RowAccumulator')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+	parser.add_argument('--max_concat_rows', type=int, default=10000, help='skip pd.concat above this many rows')
+	args = parser.parse_args()
+	print(f'{"rows":>8} {"pd.concat s":>12} {"accumulator s":>14} {"speedup":>8}')
+	for n_rows in args.sizes:
+		rows = make_rows(n_rows)
+		accumulator_time, accumulator_df = timed(build_accumulator, rows)
+		if n_rows <= args.max_concat_rows:
+			concat_time, concat_df = timed(build_concat, rows)
+			pd.testing.assert_frame_equal(concat_df.astype(object), accumulator_df.astype(object))
+			print(f'{n_rows:>8} {concat_time:>12.3f} {accumulator_time:>14.3f} {concat_time/accumulator_time:>7.0f}x')
+		else:
+			print(f'{n_rows:>8} {"skipped":>12} {accumulator_time:>14.3f} {"":>8}')
@@ -9,23 +9,27 @@ import datetime
 import textwrap
 import pandas as pd
 import matplotlib.pyplot as plt
-from collections import defaultdict
+from collections import defaultdict, Counter
 # turn off lxml warning
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
-# pytrials
+# ClinicalTrials.gov fields
 from utils.drug_search import read_pytrials_fields
-from pytrials.client import ClinicalTrials
 # urllib / BeautifulSoup
 import urllib.request, urllib.parse, urllib.error
 from bs4 import BeautifulSoup
 # custom functions
-from utils.webpage_scraping import test_connection
+from utils.webpage_scraping import test_connection, read_url, set_host_override
+from utils.cassettes import set_cassette
+from utils.telemetry import write_telemetry, print_telemetry_summary
+from utils.circuit_breaker import UpstreamUnavailable, upstream_available
+from utils.http_cache import set_cache_mode
 from utils.pickle_dataframes import unpickle_dataframes
-from utils.ctgov_search import get_ctgov_synonyms
+from utils.row_accumulator import RowAccumulator
+from utils.ctgov_search import get_ctgov_synonyms, stream_ctgov_synonyms, iter_ctgov_chunks
 from utils.drug_search import ctgov_search, find_drug_multiple_fields
 from utils.fda_sponsors import fda_sponsor_list, clean_sponsors
-from utils.pubchem_search import search_pubchem
+from utils.pubchem_search import search_pubchem, iter_pmid_pages
 from utils.fda_api_search import scrape_fda_data, fda_api_dict_to_df
 from utils.pubmed_parser import SearchParameters, entrezSearch, linksParser, semantic_scholar_search, construct_dataframe
 # assign terms for search from the search file
@@ -88,7 +92,11 @@ def pubmed_links_parser(pubmed_links):
 		searchHash['articleCount'] = articleCount
 		articleCount += 1
 		# Open, read and process link through BeautifulSoup
-		r1 = urllib.request.urlopen(link).read()
+		try:
+			r1 = read_url(link)
+		except UpstreamUnavailable:
+			print(f'  Skipped (PubMed unavailable): {link}')
+			continue
 		soup = BeautifulSoup(r1, "html.parser")
 		# Add link to searchHash
 		searchHash['search_link'] = link
@@ -128,8 +136,7 @@ def pubmed_links_parser(pubmed_links):
 		searchHash['authors'] = author_list
 		searchHash['author_institutions'] = author_institutions
 		searchesHash[PMID] = searchHash
-		# pause for a second to avoid overloading the server
-		time.sleep(0.5)
+		# requests are paced by the shared per-host rate limiter
 	return searchesHash
 
 def load_databases():
@@ -192,14 +199,19 @@ def create_markdown(
 		f.write(f'\n## {date_formatted}\n\n')
 	return report_path
 
-def get_pubmed_info(pubmed_ids):
-	pubmed_links = [f'https://pubmed.ncbi.nlm.nih.gov/{pubmed_id}' for pubmed_id in pubmed_ids]
-	pubmed_dict = pubmed_links_parser(pubmed_links)
+def get_pubmed_info(pubmed_ids, max_articles=20):
+	# page through the most recent PMIDs until max_articles have been parsed
+	pubmed_dict = {}
+	for pmid_page in iter_pmid_pages(pubmed_ids, page_size=max_articles):
+		pubmed_links = [f'https://pubmed.ncbi.nlm.nih.gov/{pubmed_id}' for pubmed_id in pmid_page[:max_articles-len(pubmed_dict)]]
+		pubmed_dict.update(pubmed_links_parser(pubmed_links))
+		if len(pubmed_dict) >= max_articles or not upstream_available('pubmed.ncbi.nlm.nih.gov'):
+			break
 	# sort by publication date
 	pubmed_dict = dict(sorted(pubmed_dict.items(), key=lambda item: item[1]['publication_date'], reverse=True))
 	return pubmed_dict
 
-def write_pubchem_to_markdown(df, drug_name, active_ingredient, file):
+def write_pubchem_to_markdown(df, drug_name, active_ingredient, file, max_articles=20):
 	# write the pubchem dataframe to markdown
 	cols = df.columns
 	with open(file, 'a') as f:
@@ -208,9 +220,9 @@ def write_pubchem_to_markdown(df, drug_name, active_ingredient, file):
 		if len(df) > 0:
 			for col in cols:
 				if col == 'pubmed_ids':
-					if df[col].iloc[0] != None:
+					if df[col].iloc[0] is not None:
 						pubmed_ids = df[col].iloc[0]
-						pubmed_dict = get_pubmed_info(pubmed_ids)
+						pubmed_dict = get_pubmed_info(pubmed_ids, max_articles)
 					else:
 						pubmed_dict = {}
 				else:
@@ -296,14 +308,33 @@ def plot_sponsors_report(
 		df_sponsors = df.copy().drop_duplicates(subset=[drug_name_field, sponsor_field])
 	else:
 		df_sponsors = df.copy()
-	sponsors = df_sponsors[sponsor_field]
+	sponsor_counts = sponsor_counter(df_sponsors[sponsor_field])
+	phase_counts, phase_status_counts = phase_counters(df)
+	return plot_sponsor_counts(sponsor_counts, phase_counts, phase_status_counts)
+
+def sponsor_counter(sponsors):
 	# drop any nan values
-	sponsors = [sponsor for sponsor in sponsors if sponsor != '']
-	if len(sponsors) == 0:
+	return Counter([sponsor for sponsor in sponsors if isinstance(sponsor, str) and sponsor != ''])
+
+def phase_counters(df):
+	# number of studies per phase, and per (phase, status) for the statuses that are plotted
+	phase_counts = Counter([phase for phase in df['Phases'] if isinstance(phase, str) and (phase != '') and (phase != 'NA')])
+	phase_status_counts = Counter([
+		(phase, status) for phase, status in zip(df['Phases'], df['Study Status'])
+		if status in ['Completed', 'Recruiting']
+	])
+	return phase_counts, phase_status_counts
+
+def plot_sponsor_counts(sponsor_counts, phase_counts, phase_status_counts):
+	'''
+	Sponsor and phase bar plots from counts (Counters), so they can be
+	accumulated over chunks instead of computed from one DataFrame
+	'''
+	if len(sponsor_counts) == 0:
 		print('No sponsors found')
 		return
-	# count the number of unique sponsors from a list where value_counts() cannot be used
-	top_sponsors = pd.Series(sponsors).value_counts().nlargest(50)
+	# count the number of unique sponsors (ties stay in order of first appearance)
+	top_sponsors = pd.Series(sponsor_counts).sort_values(ascending=False, kind='stable').nlargest(50)
 	# plot
 	f, axarr = plt.subplots(1, 2, dpi=300, sharey=True)
 	top_sponsor_names = top_sponsors.index
@@ -313,16 +344,6 @@ def plot_sponsors_report(
 	axarr[0].bar(top_sponsor_names, top_sponsor_counts, edgecolor='black', color='#6B95B6')
 	# rotate x-axis labels
 	axarr[0].set_xticks(range(len(top_sponsor_names)))
-	# for s_index, sponsor in enumerate(top_sponsor_names):
-	# 	sponsor_df = df[df[sponsor_field] == sponsor]
-	# 	statuses = phase_df['Status']
-	# 	completed_studies = len([status for status in statuses if status == 'Completed'])
-	# 	# plot as darker green if completed
-	# 	if completed_studies > 0:
-	# 		axarr[1].bar(p_index, top_phase_counts[p_index], edgecolor='black', color='#7eb1a1')
-	# 	recruiting_studies = len([status for status in statuses if status == 'Recruiting'])
-	# 	if recruiting_studies > 0:
-	# 		axarr[1].bar(p_index, completed_studies+recruiting_studies, edgecolor='black', color='#deebe7')
 	top_sponsors_truncated = [textwrap.shorten(sponsor, width=30, placeholder='...') for sponsor in top_sponsor_names]
 	# make xticks font size to be proportional to the number of sponsors
 	xtick_fontsize = 6 if len(top_sponsor_names) < 10 else 4
@@ -334,14 +355,8 @@ def plot_sponsors_report(
 	# make sure nothing is cut off
 	plt.subplots_adjust(bottom=0.6, top=0.9)
 	# create a second plot with the same bar plot but with Phases on the x-axis and sort by Phases (i.e. PHASE1, PHASE2, PHASE3, PHASE4)
-	phases = df['Phases']
-	phases = [phase for phase in phases if (phase != '') and (phase != 'NA')]
-	# sort the phases
-	phases = sorted(list(phases))
-	# plot a bar graph of the number of drugs in each phase
-	top_phases = pd.Series(phases).value_counts()
 	# make sure it is sorted by phase
-	sorted_top_phases = top_phases.sort_index()
+	sorted_top_phases = pd.Series(phase_counts, dtype=int).sort_index()
 	top_phase_names = sorted_top_phases.index
 	top_phase_counts = sorted_top_phases.values
 	# plot the number of drugs in each phase with hex AECEC4
@@ -353,17 +368,15 @@ def plot_sponsors_report(
 	axarr[1].set_xlabel('Phases', fontsize=12, fontweight='bold', fontname='Optima')
 	# show the status of the studies in each phase
 	for p_index, phase in enumerate(top_phase_names):
-		phase_df = df[df['Phases'] == phase]
-		statuses = phase_df['Study Status']
-		completed_studies = len([status for status in statuses if status == 'Completed'])
+		completed_studies = phase_status_counts[(phase, 'Completed')]
 		# plot as darker green if completed
 		if completed_studies > 0:
 			axarr[1].bar(p_index, top_phase_counts[p_index], edgecolor='black', color='#7eb1a1')
-		recruiting_studies = len([status for status in statuses if status == 'Recruiting'])
+		recruiting_studies = phase_status_counts[(phase, 'Recruiting')]
 		if recruiting_studies > 0:
 			axarr[1].bar(p_index, completed_studies+recruiting_studies, edgecolor='black', color='#deebe7')
 	# set yticks to be integers with only 0 and the rounded max value closest to 5 with 5 ticks regardless of the max value
-	max_y = max(max(top_sponsor_counts), max(top_phase_counts))
+	max_y = max(max(top_sponsor_counts), max(top_phase_counts, default=0))
 	# round up to the nearest 5
 	max_y = int(max_y + 5 - (max_y % 5))
 	axarr[0].set_yticks(range(0, max_y, int(max_y / 5)))
@@ -390,22 +403,68 @@ def rename_sponsors_report(df, drug_name_field='drug_name', sponsor_field='fda_2
 	df[new_field] = final_sponsors
 	return df
 
+class CTGovSummary:
+	'''
+	What the Clinical Trials section reports for one search term (or all of them),
+	updated one chunk of rows at a time: sponsor/phase/status counts and the
+	studies with the earliest and latest start dates
+	'''
+	date_cols = ['Start Date', 'Completion Date', 'NCT Number', 'Study Title', 'Sponsor', 'Phases', 'Conditions']
+
+	def __init__(self):
+		self.n_rows = 0
+		self.sponsor_counts = Counter()
+		self.phase_counts = Counter()
+		self.phase_status_counts = Counter()
+		self.first_date = None
+		self.last_date = None
+
+	def update(self, df):
+		if len(df) == 0:
+			return
+		self.n_rows += len(df)
+		self.sponsor_counts.update(sponsor_counter(df['Sponsor']))
+		phase_counts, phase_status_counts = phase_counters(df)
+		self.phase_counts.update(phase_counts)
+		self.phase_status_counts.update(phase_status_counts)
+		# keep only the earliest/latest row seen so far (sorted like the whole frame would be)
+		self.first_date = self.date_row(df, self.first_date, ascending=True)
+		self.last_date = self.date_row(df, self.last_date, ascending=False)
+
+	def date_row(self, df, current, ascending):
+		candidates = df[self.date_cols] if current is None else pd.concat([current, df[self.date_cols]], ignore_index=True)
+		return candidates.sort_values(by='Start Date', ascending=ascending, kind='stable').iloc[:1]
+
+	def plot(self):
+		return plot_sponsor_counts(self.sponsor_counts, self.phase_counts, self.phase_status_counts)
+
+	def dates_df(self):
+		ct_dates_rows = RowAccumulator(self.date_cols)
+		ct_dates_rows.append(self.first_date.iloc[0].to_dict())
+		if self.n_rows > 1:
+			ct_dates_rows.append(self.last_date.iloc[0].to_dict())
+		ct_dates_df = ct_dates_rows.to_frame()
+		# show the dates without a time of day
+		for col in ['Start Date', 'Completion Date']:
+			if pd.api.types.is_datetime64_any_dtype(ct_dates_df[col]):
+				ct_dates_df[col] = ct_dates_df[col].dt.strftime('%Y-%m-%d').fillna('')
+		return ct_dates_df
+
 def write_ctgov_sponsors_to_markdown(f, df, search_term, file_path):
-	df = rename_sponsors_report(df, drug_name_field='NCT Number', sponsor_field='Sponsor')
+	if isinstance(df, CTGovSummary):
+		summary = df
+	else:
+		summary = CTGovSummary()
+		summary.update(df)
 	# plot sponsors
-	sponsor_figure = plot_sponsors_report(
-		df, 
-		drug_name_field=None, 
-		sponsor_field='Sponsor', 
-		unique_drugs_only=True
-	)
+	sponsor_figure = summary.plot()
 	if search_term != 'all':
 		ctgov_link = f'https://clinicaltrials.gov/search?term={search_term}'
 		f.write(f'**{search_term} ([link]({ctgov_link}))**\n')
 	else:
 		f.write(f'**All Synonyms**\n')
 	min_sponsor_count = 10
-	if sponsor_figure is not None and len(df) > min_sponsor_count:
+	if sponsor_figure is not None and summary.n_rows > min_sponsor_count:
 		# get directory name for file
 		dir_name = os.path.join(os.path.dirname(file_path), 'images')
 		# make the directory if it doesn't exist
@@ -415,37 +474,52 @@ def write_ctgov_sponsors_to_markdown(f, df, search_term, file_path):
 		sponsor_figure.savefig(figure_path)
 		f.write(f'![sponsor_plot](images/sponsor_plot_{search_term}.png)')
 		f.write('\n')
-	# sort dataframe by most recent start date and write the date, title, and sponsor to the markdown file
-	cols = ['Start Date', 'Completion Date', 'NCT Number', 'Study Title', 'Sponsor', 'Phases', 'Conditions']
-	ct_dates_df = pd.DataFrame(columns=cols)
-	if len(df) == 0:
+	if sponsor_figure is not None:
+		plt.close(sponsor_figure)
+	# write the date, title, and sponsor of the first and most recent studies to the markdown file
+	if summary.n_rows == 0:
 		f.write('> * No Clinical Trials Found\n')
 		return
-	first_date_info = df.sort_values(by='Start Date', ascending=True).iloc[0][cols]
-	ct_dates_df = pd.concat([ct_dates_df, pd.DataFrame(first_date_info).T], axis=0)
-	if len(df) > 1:
-		last_date_info = df.sort_values(by='Start Date', ascending=False).iloc[0][cols]
-		ct_dates_df = pd.concat([ct_dates_df, pd.DataFrame(last_date_info).T], axis=0)
+	ct_dates_df = summary.dates_df()
 	# conver all 'NCT Number' to links
 	ct_dates_df['NCT Number'] = ct_dates_df['NCT Number'].apply(lambda x: f'[{x}](https://clinicaltrials.gov/study/{x})')
 	f.write(ct_dates_df.to_markdown(index=False))
 	f.write('\n\n')
 
-def write_ctgov_to_markdown(f, ctgov_df):
-	search_terms = list(flatten_list([ctgov_df['Search Term'].values]))[0]
-	search_terms = list(set(flatten_list(search_terms)))
-	print(f'  Number of synonyms in ctgov: {len(search_terms)}')
-	file_path = f.name
+def write_ctgov_to_markdown(f, ctgov):
+	'''
+	ctgov: the ctgov DataFrame, or an iterable of DataFrame chunks (e.g. iter_ctgov_chunks)
+	'''
+	chunks = [ctgov] if isinstance(ctgov, pd.DataFrame) else ctgov
+	all_summary = CTGovSummary()
+	term_summaries = {}
+	for chunk in chunks:
+		all_summary.update(chunk)
+		for search_term in dict.fromkeys(flatten_list(list(chunk['Search Term'].values))):
+			if search_term not in term_summaries:
+				term_summaries[search_term] = CTGovSummary()
+			term_summaries[search_term].update(chunk[chunk['Search Term'].apply(lambda x: search_term in x)])
+	print(f'  Number of synonyms in ctgov: {len(term_summaries)}')
+	file_path = f if isinstance(f, str) else f.name
 	with open(file_path, 'a') as f:
 		f.write('\n#### Clinical Trials\n\n')
-		write_ctgov_sponsors_to_markdown(f, ctgov_df, 'all', file_path)
-		for search_term in search_terms:
-			df = ctgov_df[ctgov_df['Search Term'].apply(lambda x: search_term in x)]
-			# standardize sponsor names
-			write_ctgov_sponsors_to_markdown(f, df, search_term, file_path)
+		write_ctgov_sponsors_to_markdown(f, all_summary, 'all', file_path)
+		for search_term, summary in term_summaries.items():
+			write_ctgov_sponsors_to_markdown(f, summary, search_term, file_path)
+
+def write_unavailable_to_markdown(f, section, host):
+	# note a skipped (or incomplete) section when its upstream is down
+	file_path = f if isinstance(f, str) else f.name
+	with open(file_path, 'a') as f:
+		f.write(f'> * {section} skipped: {host} is unavailable\n\n')
+	return f
 
-def synonym_ctgov_search(pubchem_df):
+def synonym_ctgov_search(pubchem_df, out_dir=None):
 	if len(pubchem_df) > 0:
+		if out_dir is not None:
+			# stream the rows to partitions and hand back an iterator over them
+			stream_ctgov_synonyms(pubchem_df, out_dir, incremental=True)
+			return iter_ctgov_chunks(out_dir)
 		ctgov_df = get_ctgov_synonyms(pubchem_df)
 		return ctgov_df
 
@@ -523,7 +597,8 @@ def default_search(
 		active_ingredient='NMDAR', 
 		indication=['neurodegeneration'],
 		target=['NMDAR'],
-		mechanism=['NMDAR antagonist']
+		mechanism=['NMDAR antagonist'],
+		max_articles=20
 ):
 
 	# search for drug/active ingredient in pubchem
@@ -534,11 +609,19 @@ def default_search(
 			data=[[drug_name, active_ingredient]]),
 		save_df=False
 	)
-	f = write_pubchem_to_markdown(pubchem_df, drug_name, active_ingredient, f)
+	if upstream_available('pubchem.ncbi.nlm.nih.gov'):
+		f = write_pubchem_to_markdown(pubchem_df, drug_name, active_ingredient, f, max_articles)
+	else:
+		f = write_unavailable_to_markdown(f, 'PubChem Search', 'pubchem.ncbi.nlm.nih.gov')
 	
 	# search for synonyms in ctgov
-	ctgov_df = synonym_ctgov_search(pubchem_df)
-	write_ctgov_to_markdown(f, ctgov_df)
+	try:
+		file_path = f if isinstance(f, str) else f.name
+		ctgov_chunks = synonym_ctgov_search(pubchem_df, out_dir=os.path.splitext(file_path)[0] + '_ctgov')
+		write_ctgov_to_markdown(f, ctgov_chunks)
+	except UpstreamUnavailable as e:
+		print(f'  Skipping Clinical Trials: {e.host} unavailable')
+		f = write_unavailable_to_markdown(f, 'Clinical Trials', e.host)
 		
 	# FDA drug/active ingredient search
 	## separate by indication, separate by target - maybe from chatgpt/perplexity?
@@ -637,7 +720,11 @@ def default_search(
 	]
 	# flatten the search terms
 	pubmed_search_terms = list(set(flatten_list(pubmed_search_terms)))
-	abstract_text = pubmed_search(pubmed_search_terms)
+	try:
+		abstract_text = pubmed_search(pubmed_search_terms)
+	except UpstreamUnavailable as e:
+		print(f'  Skipping PubMed abstracts: {e.host} unavailable')
+		abstract_text = ''
 
 	model = 'llama3.2'
 	print(f'Asking {model}')
@@ -675,6 +762,7 @@ def main(
 		indication = ['neurodegeneration'],
 		target = ['NMDAR'],
 		mechanism = ['NMDAR antagonist'],
+		max_articles = 20,
 	):
 
 	df_dict = load_databases()
@@ -695,8 +783,12 @@ def main(
 		active_ingredient = active_ingredient, 
 		indication = indication,
 		target = target,
-		mechanism = mechanism
+		mechanism = mechanism,
+		max_articles = max_articles
 	)
+	# request telemetry (latency per endpoint, bytes, retries, cache hits) for this run
+	print_telemetry_summary()
+	write_telemetry(os.path.splitext(report_path)[0] + '_telemetry')
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Read provided pitch deck and write results to markdown')
@@ -709,8 +801,26 @@ if __name__ == '__main__':
 	parser.add_argument('--indication', nargs='+', help='search terms for indication')
 	parser.add_argument('--target', nargs='+', help='search terms for drug target')
 	parser.add_argument('--mechanism', nargs='+', help='search terms for mechanism of action')
+	parser.add_argument('--max_articles', type=int, default=20, help='most recent PubMed articles to include per compound')
+	parser.add_argument('--cache_only', action='store_true', help='answer web requests from the local response cache only (offline)')
+	parser.add_argument('--cassette', help='replay web requests from this cassette file (JSON lines)')
+	parser.add_argument('--record', action='store_true', help='record web requests to --cassette instead of replaying')
+	parser.add_argument('--standin_url', help='send all web requests to a local stand-in server (utils/standin_server.py)')
 	args = parser.parse_args()
 
+	if args.cache_only:
+		print('Using cached responses only...')
+		set_cache_mode('offline')
+	if args.cassette:
+		cassette_mode = 'record' if args.record else 'replay'
+		print(f'Cassette ({cassette_mode}): {args.cassette}')
+		set_cassette(args.cassette, mode=cassette_mode)
+	if args.standin_url:
+		print(f'Sending requests to stand-in server: {args.standin_url}')
+		set_host_override('*', args.standin_url)
+		# measure the stand-in, not the local response cache
+		set_cache_mode('off')
+
 	if args.search_file:
 		print('Using company_search for search terms...')
 		company_name = company_search['company_name']
@@ -735,5 +845,6 @@ if __name__ == '__main__':
 		active_ingredient=active_ingredient,
 		indication=indication,
 		target=target,
-		mechanism=mechanism
-	)
\ No newline at end of file
+		mechanism=mechanism,
+		max_articles=args.max_articles
+	)
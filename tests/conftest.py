@@ -0,0 +1,27 @@
+import os
+import sys
+import pytest
+
+# the utils package lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.http_cache import cache_config, set_cache_mode
+from utils.circuit_breaker import breaker_config, configure_breakers
+from utils.webpage_scraping import set_host_override
+
+@pytest.fixture
+def no_http_cache():
+	# requests go through test_connection without reading or writing databases/http_cache
+	mode = cache_config['mode']
+	set_cache_mode('off')
+	yield
+	set_cache_mode(mode)
+
+@pytest.fixture(autouse=True)
+def reset_breakers():
+	# every test starts with closed circuits and no stand-in redirect
+	config = dict(breaker_config)
+	configure_breakers()
+	yield
+	configure_breakers(**config)
+	set_host_override('*', None)
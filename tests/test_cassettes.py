@@ -0,0 +1,56 @@
+import json
+import requests
+from utils.cassettes import response_to_interaction, use_cassette, recorded_headers
+from utils.standin_server import StandinServer
+from utils import webpage_scraping
+from utils.webpage_scraping import set_host_override
+
+urls = [
+	'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/aspirin/cids/JSON',
+	'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/insulin glargine/cids/JSON',
+	'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&term=ketamine&retmax=20',
+]
+
+def json_response(body, headers={}):
+	response = requests.models.Response()
+	response.status_code = 200
+	response._content = json.dumps(body).encode()
+	response.encoding = 'utf-8'
+	response.headers['content-type'] = 'application/json'
+	response.headers.update(headers)
+	return response
+
+def write_cassette(path, urls):
+	with open(path, 'w') as f:
+		for u_index, url in enumerate(urls):
+			f.write(json.dumps(response_to_interaction(url, json_response({'index': u_index}))) + '\n')
+	return path
+
+def test_recorded_headers():
+	interaction = response_to_interaction(urls[0], json_response({}, {'etag': 'abc', 'x-next-page-token': 'next', 'set-cookie': 'x'}))
+	assert interaction['headers'] == {'content-type': 'application/json', 'etag': 'abc'}
+	assert 'x-next-page-token' not in recorded_headers
+
+def test_cassette_replay(tmp_path, no_http_cache):
+	path = write_cassette(str(tmp_path / 'cassette.jsonl'), urls)
+	with use_cassette(path) as cassette:
+		responses = [webpage_scraping.test_connection(url) for url in urls]
+		missing = webpage_scraping.test_connection('https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/nothing/cids/JSON')
+	assert [response.json() for response in responses] == [{'index': u_index} for u_index in range(len(urls))]
+	assert all(response.cache_status == 'cassette' for response in responses)
+	assert missing.status_code == 504
+	assert cassette.misses == ['https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/nothing/cids/JSON']
+
+def test_standin_replay(tmp_path, no_http_cache):
+	# http:// URLs and paths with spaces are matched as well as plain https ones
+	server = StandinServer(write_cassette(str(tmp_path / 'cassette.jsonl'), urls))
+	set_host_override('*', server.start())
+	try:
+		responses = [webpage_scraping.test_connection(url) for url in urls]
+		missing = webpage_scraping.test_connection('https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/nothing/cids/JSON')
+	finally:
+		server.stop()
+	assert [response.json() for response in responses] == [{'index': u_index} for u_index in range(len(urls))]
+	assert missing.status_code == 404
+	assert server.stats['hits'] == len(urls)
+	assert server.stats['misses'] == 1
@@ -0,0 +1,76 @@
+import time
+import pytest
+import requests
+from utils import webpage_scraping
+from utils.circuit_breaker import CircuitBreaker, UnavailableResponse, UpstreamUnavailable, get_breaker, configure_breakers, upstream_available, is_unavailable
+
+def test_opens_after_failure_threshold():
+	breaker = CircuitBreaker('example.org', failure_threshold=3, recovery_timeout=60)
+	for _ in range(2):
+		breaker.record_failure()
+	assert breaker.state == 'closed' and breaker.allow_request()
+	breaker.record_failure()
+	assert breaker.state == 'open'
+	assert not breaker.allow_request()
+
+def test_success_resets_failures():
+	breaker = CircuitBreaker('example.org', failure_threshold=2)
+	breaker.record_failure()
+	breaker.record_success()
+	breaker.record_failure()
+	assert breaker.state == 'closed'
+
+def test_half_open_lets_one_trial_through():
+	breaker = CircuitBreaker('example.org', failure_threshold=1, recovery_timeout=0)
+	breaker.record_failure()
+	assert breaker.allow_request()
+	assert breaker.state == 'half_open' and breaker.trial_in_flight
+	# only one trial at a time
+	assert not breaker.allow_request()
+	breaker.record_success()
+	assert breaker.state == 'closed' and not breaker.trial_in_flight
+	assert breaker.allow_request()
+
+def test_failed_trial_reopens():
+	breaker = CircuitBreaker('example.org', failure_threshold=3, recovery_timeout=0)
+	for _ in range(3):
+		breaker.record_failure()
+	assert breaker.allow_request()
+	breaker.record_failure()
+	assert breaker.state == 'open' and not breaker.trial_in_flight
+	assert breaker.opened_at <= time.monotonic()
+
+def test_upstream_available():
+	configure_breakers(failure_threshold=1, recovery_timeout=60)
+	assert upstream_available('example.org')
+	get_breaker('example.org').record_failure()
+	assert not upstream_available('example.org')
+
+def test_unavailable_response():
+	response = UnavailableResponse('https://example.org/x', 'example.org')
+	assert is_unavailable(response) and response.status_code == 503
+	with pytest.raises(UpstreamUnavailable):
+		response.json()
+
+def test_unavailable_host_fails_fast(monkeypatch):
+	configure_breakers(failure_threshold=1, recovery_timeout=60)
+	get_breaker('example.org').record_failure()
+	class NoSession:
+		def request(self, *args, **kwargs):
+			pytest.fail('request sent to an open circuit')
+	monkeypatch.setattr(webpage_scraping, 'get_session', lambda url: NoSession())
+	assert is_unavailable(webpage_scraping.get_with_retries('https://example.org/x'))
+
+def test_non_retried_error_ends_the_trial(monkeypatch):
+	# an exception that isn't retried still records a failure, so the half-open trial doesn't stay in flight
+	configure_breakers(failure_threshold=1, recovery_timeout=0)
+	breaker = get_breaker('example.org')
+	breaker.record_failure()
+	class InvalidSession:
+		def request(self, *args, **kwargs):
+			raise requests.exceptions.InvalidURL('bad url')
+	monkeypatch.setattr(webpage_scraping, 'get_session', lambda url: InvalidSession())
+	with pytest.raises(requests.exceptions.InvalidURL):
+		webpage_scraping.get_with_retries('https://example.org/x')
+	assert breaker.state == 'open' and not breaker.trial_in_flight
+	assert breaker.allow_request()
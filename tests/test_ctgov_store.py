@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from utils import ctgov_store
+from utils.ctgov_store import CTGovStore
+from utils.circuit_breaker import UpstreamUnavailable
+
+fields = ['NCT Number', 'Study Title', 'Last Update Posted']
+
+def ct_output(rows):
+	return [list(fields)] + [[nct_number, title, np.datetime64(last_update, 'D')] for nct_number, title, last_update in rows]
+
+class FakeRecords:
+	'''
+	Stands in for get_ctgov_records: hands out the prepared outputs in order and
+	keeps the filter of each call
+	'''
+	def __init__(self, *outputs):
+		self.outputs = list(outputs)
+		self.filters = []
+
+	def __call__(self, term, fields, filter_expr=None):
+		self.filters.append(filter_expr)
+		output = self.outputs.pop(0)
+		if isinstance(output, Exception):
+			raise output
+		return output
+
+@pytest.fixture
+def store(tmp_path):
+	return CTGovStore(str(tmp_path / 'ctgov_store.sqlite'))
+
+def test_incremental_sync_merges_updates(store, monkeypatch):
+	fake = FakeRecords(
+		ct_output([('NCT01', 'first', '2024-01-10'), ('NCT02', 'second', '2024-02-01')]),
+		# the second sync only gets what changed: an updated NCT02 and a new NCT03
+		ct_output([('NCT02', 'second (amended)', '2024-06-01'), ('NCT03', 'third', '2024-06-02')]),
+	)
+	monkeypatch.setattr(ctgov_store, 'get_ctgov_records', fake)
+	first = store.sync('ketamine', fields)
+	assert sorted(row[0] for row in first[1:]) == ['NCT01', 'NCT02']
+	records = store.sync('ketamine', fields)
+	# a full search first, then only studies updated since the last sync
+	assert fake.filters[0] is None
+	assert fake.filters[1].startswith('AREA[LastUpdatePostDate]RANGE[')
+	assert records[0] == fields
+	# newest update first, the amended study replacing its old row
+	assert [row[:2] for row in records[1:]] == [['NCT03', 'third'], ['NCT02', 'second (amended)'], ['NCT01', 'first']]
+	assert records[2][2] == np.datetime64('2024-06-01')
+	assert len(store) == 3
+
+def test_terms_keep_their_own_studies(store, monkeypatch):
+	monkeypatch.setattr(ctgov_store, 'get_ctgov_records', FakeRecords(
+		ct_output([('NCT01', 'first', '2024-01-10')]),
+		ct_output([('NCT02', 'second', '2024-02-01')]),
+	))
+	store.sync('ketamine', fields)
+	records = store.sync('esketamine', fields)
+	assert [row[0] for row in records[1:]] == ['NCT02']
+
+def test_unavailable_serves_last_sync(store, monkeypatch):
+	monkeypatch.setattr(ctgov_store, 'get_ctgov_records', FakeRecords(
+		ct_output([('NCT01', 'first', '2024-01-10')]),
+		UpstreamUnavailable('clinicaltrials.gov'),
+		UpstreamUnavailable('clinicaltrials.gov'),
+	))
+	store.sync('ketamine', fields)
+	assert [row[0] for row in store.sync('ketamine', fields)[1:]] == ['NCT01']
+	# nothing stored to fall back on
+	with pytest.raises(UpstreamUnavailable):
+		store.sync('esketamine', fields)
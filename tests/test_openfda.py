@@ -0,0 +1,95 @@
+import random
+import pytest
+from benchmarks.openfda_store import synthetic_result, write_download
+from utils import openfda_store
+from utils.openfda_store import OpenFDAStore
+from utils.openfda_flatten import FlattenPlan, openfda_schemas, flatten_results, flatten_records, OpenFDATables
+
+def drugsfda_results(n_results):
+	rng = random.Random(0)
+	return [synthetic_result('drugsfda', r_index, rng) for r_index in range(n_results)]
+
+def test_plan_prefixes_taken_names():
+	plan = FlattenPlan(openfda_schemas['drugsfda'])
+	columns = [column for column, _ in plan.columns]
+	assert columns[:4] == ['application_number', 'sponsor_name', 'openfda_application_number', 'brand_name']
+	assert len(columns) == len(set(columns))
+	products = dict(plan.children['products'])
+	assert products['products_brand_name'] == ('brand_name',)
+	assert products['products_route'] == ('route',)
+	assert products['dosage_form'] == ('dosage_form',)
+	# label sections are all top-level, nothing to prefix
+	plan = FlattenPlan(openfda_schemas['label'])
+	assert [column for column, _ in plan.columns][4:6] == ['application_number', 'brand_name']
+
+def test_plan_compiles_unknown_fields():
+	plan = FlattenPlan(openfda_schemas['drugsfda'])
+	plan.add_unknown('sponsor_address', {'city': 'Boston', 'brand_name': 'x'})
+	columns = [column for column, _ in plan.columns]
+	assert columns[-2:] == ['city', 'sponsor_address_brand_name']
+	assert 'sponsor_address' in plan.known
+
+def test_flatten_results_keeps_every_item():
+	results = drugsfda_results(3)
+	results[1]['products'].append(dict(results[1]['products'][0], brand_name='SECOND'))
+	tables = flatten_results(results, 'drugsfda')
+	assert tables['results']['application_number'] == ['NDA000000', 'NDA000001', 'NDA000002']
+	assert tables['results']['openfda_application_number'] == [['NDA000000'], ['NDA000001'], ['NDA000002']]
+	assert tables['products']['result_index'] == [0, 1, 1, 2]
+	assert tables['products']['products_brand_name'] == ['BRAND0', 'BRAND1', 'SECOND', 'BRAND2']
+	collected = OpenFDATables()
+	collected.add('drugsfda', tables, 'nce-1')
+	collected.add('drugsfda', flatten_results(drugsfda_results(1), 'drugsfda'), 'nce-2')
+	frames = collected.to_frames()
+	assert list(frames['drugsfda']['result_index']) == [0, 1, 2, 3]
+	assert list(frames['drugsfda_products']['nce_id']) == ['nce-1']*4 + ['nce-2']
+
+def test_flatten_records_keep_old_names():
+	# the later field wins, as in the old get_fda_api_data loop
+	record = flatten_records(drugsfda_results(1), 'drugsfda')[0]
+	assert record['brand_name'] == 'BRAND0'
+	assert record['application_number'] == ['NDA000000']
+	assert record['submission_type'] == 'ORIG'
+	assert not any(key.startswith(('openfda_', 'products_')) for key in record)
+
+@pytest.fixture
+def downloads(tmp_path):
+	paths = {}
+	for dataset in ['drugsfda', 'label']:
+		paths[dataset] = str(tmp_path / f'{dataset}.json.zip')
+		write_download(paths[dataset], dataset, 300)
+	return paths
+
+def test_ingest_and_lookup(tmp_path, downloads):
+	store = OpenFDAStore(str(tmp_path / 'openfda'))
+	for dataset, path in downloads.items():
+		assert store.ingest(dataset, [path], partition_rows=100) == 300
+	assert len(store) == 600
+	record = store.first('drugsfda', 'brand3')
+	assert record['brand_name'] == 'BRAND3'
+	assert record['active_ingredients'][0]['name'] == 'GENERIC 3'
+	assert [record['id'] for record in store.lookup('label', 'generic 5')] == ['label-5']
+	assert store.first('drugsfda', 'NDA000250', key_type='application')['brand_name'] == 'BRAND250'
+	assert store.first('drugsfda', 'nothing') is None
+	# a fresh store reads the manifest back
+	reopened = OpenFDAStore(str(tmp_path / 'openfda'))
+	assert reopened.first('label', 'BRAND7')['id'] == 'label-7'
+	frames = list(reopened.iter_frames('drugsfda', ['application_number', 'brand_name', 'missing']))
+	assert sum(len(df) for df in frames) == 300
+	assert list(frames[0].columns) == ['application_number', 'brand_name', 'missing']
+
+def test_failed_ingest_keeps_stored_dataset(tmp_path, downloads, monkeypatch):
+	store = OpenFDAStore(str(tmp_path / 'openfda'))
+	store.ingest('drugsfda', [downloads['drugsfda']], partition_rows=100)
+	iter_zip_results = openfda_store.iter_zip_results
+	def truncated(path):
+		for r_index, result in enumerate(iter_zip_results(path)):
+			if r_index == 150:
+				raise IOError('truncated download')
+			yield result
+	monkeypatch.setattr(openfda_store, 'iter_zip_results', truncated)
+	with pytest.raises(IOError):
+		store.ingest('drugsfda', [downloads['drugsfda']], partition_rows=100)
+	reopened = OpenFDAStore(str(tmp_path / 'openfda'))
+	assert reopened.manifest['drugsfda']['n_rows'] == 300
+	assert reopened.first('drugsfda', 'BRAND250')['brand_name'] == 'BRAND250'
@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.webpage_scraping import test_connection, read_url
+
+# worker threads for blocking fetch/parse work; per-host limits are enforced
+# by the shared fetch path (utils.rate_limiter), so this only bounds the total
+max_workers = 32
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+	global _executor
+	with _executor_lock:
+		if _executor is None:
+			_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch')
+	return _executor
+
+async def run_blocking(func, *args, **kwargs):
+	'''
+	Run a blocking function (fetch + parse) on the fetch thread pool
+	'''
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+async def fetch_async(url, **kwargs):
+	return await run_blocking(test_connection, url, **kwargs)
+
+async def read_url_async(url, **kwargs):
+	return await run_blocking(read_url, url, **kwargs)
+
+async def map_async(func, items, *args, **kwargs):
+	'''
+	Apply a blocking func to every item concurrently, keeping the input order
+	'''
+	return await asyncio.gather(*[run_blocking(func, item, *args, **kwargs) for item in items])
+
+# separate pool for fanning out the independent calls of one task; tasks already
+# running on the fetch pool can wait on it without starving their own pool
+fan_out_workers = 16
+_fan_out_executor = None
+
+def fan_out(calls):
+	'''
+	Run {key: (func, *args)} blocking calls concurrently and return {key: result}
+	'''
+	global _fan_out_executor
+	with _executor_lock:
+		if _fan_out_executor is None:
+			_fan_out_executor = ThreadPoolExecutor(max_workers=fan_out_workers, thread_name_prefix='fan_out')
+	futures = {key: _fan_out_executor.submit(*call) for key, call in calls.items()}
+	return {key: future.result() for key, future in futures.items()}
+
+def run_sync(coroutine):
+	'''
+	Run a coroutine to completion from sync code. Inside a running event loop
+	(e.g. Jupyter) it runs on a helper thread with its own loop.
+	'''
+	try:
+		asyncio.get_running_loop()
+	except RuntimeError:
+		return asyncio.run(coroutine)
+	result = {}
+	def runner():
+		try:
+			result['value'] = asyncio.run(coroutine)
+		except BaseException as e:
+			result['error'] = e
+	thread = threading.Thread(target=runner)
+	thread.start()
+	thread.join()
+	if 'error' in result:
+		raise result['error']
+	return result['value']
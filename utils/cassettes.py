@@ -0,0 +1,125 @@
+import os
+import json
+import base64
+import hashlib
+import urllib.parse
+import threading
+import contextlib
+import requests
+from requests.structures import CaseInsensitiveDict
+from utils.http_cache import normalize_url
+
+# headers kept with each recorded response
+recorded_headers = ['content-type', 'etag', 'last-modified', 'retry-after']
+
+def interaction_key(url, method='GET', data=None):
+	key = f'{method.upper()} {normalize_url(url)}'
+	# POSTed lists are keyed by a hash of the form body
+	if data:
+		if isinstance(data, dict):
+			data = urllib.parse.urlencode(data)
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		key += ' ' + hashlib.sha256(data).hexdigest()[:16]
+	return key
+
+class Cassette:
+	'''
+	Recorded HTTP interactions stored as JSON lines (one response per request key).
+	In 'record' mode responses are appended as they arrive; in 'replay' mode
+	requests are answered from the file and never reach the network.
+	'''
+	def __init__(self, path, mode='replay'):
+		if mode not in ['record', 'replay']:
+			raise ValueError(f'Unknown cassette mode: {mode}')
+		self.path = path
+		self.mode = mode
+		self.lock = threading.Lock()
+		self.interactions = load_interactions(path) if os.path.exists(path) else {}
+		self.misses = []
+
+	def play(self, url, method='GET', data=None):
+		interaction = self.interactions.get(interaction_key(url, method, data))
+		if interaction is None:
+			print(f'  Not in cassette: {normalize_url(url)}')
+			self.misses.append(url)
+			response = requests.models.Response()
+			response.status_code = 504
+			response._content = b''
+			response.url = url
+			response.reason = 'Not in cassette'
+			return response
+		return interaction_to_response(interaction)
+
+	def record(self, url, response, method='GET', data=None):
+		interaction = response_to_interaction(url, response, method, data)
+		with self.lock:
+			self.interactions[interaction['key']] = interaction
+			if os.path.dirname(self.path):
+				os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			with open(self.path, 'a') as f:
+				f.write(json.dumps(interaction) + '\n')
+
+def response_to_interaction(url, response, method='GET', data=None):
+	content = response.content or b''
+	try:
+		body, body_b64 = content.decode('utf-8'), False
+	except UnicodeDecodeError:
+		body, body_b64 = base64.b64encode(content).decode('ascii'), True
+	return {
+		'key': interaction_key(url, method, data),
+		'url': normalize_url(url),
+		'status_code': response.status_code,
+		'headers': {h: response.headers[h] for h in recorded_headers if h in response.headers},
+		'encoding': response.encoding,
+		'body': body,
+		'body_b64': body_b64,
+	}
+
+def interaction_body(interaction):
+	if interaction['body_b64']:
+		return base64.b64decode(interaction['body'])
+	return interaction['body'].encode('utf-8')
+
+def interaction_to_response(interaction):
+	response = requests.models.Response()
+	response.status_code = interaction['status_code']
+	response._content = interaction_body(interaction)
+	response.headers = CaseInsensitiveDict(interaction['headers'])
+	response.encoding = interaction['encoding']
+	response.url = interaction['url']
+	return response
+
+def load_interactions(path):
+	# later lines win, so re-recording a request replaces it
+	interactions = {}
+	with open(path, 'r') as f:
+		for line in f:
+			if line.strip():
+				interaction = json.loads(line)
+				interactions[interaction['key']] = interaction
+	return interactions
+
+_cassette = None
+
+def get_cassette():
+	return _cassette
+
+def set_cassette(path, mode='replay'):
+	'''
+	Record to / replay from a cassette for every request made through test_connection
+	(pass path=None to turn cassettes off)
+	'''
+	global _cassette
+	_cassette = Cassette(path, mode) if path is not None else None
+	return _cassette
+
+@contextlib.contextmanager
+def use_cassette(path, mode='replay'):
+	global _cassette
+	previous = _cassette
+	cassette = set_cassette(path, mode)
+	try:
+		yield cassette
+	finally:
+		_cassette = previous
@@ -0,0 +1,114 @@
+import time
+import threading
+import requests
+
+breaker_config = {
+	# consecutive failed requests (after retries) before the circuit opens
+	'failure_threshold': 3,
+	# seconds to wait before letting a trial request through (half-open)
+	'recovery_timeout': 60,
+}
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+	'''
+	Raised by read_url (and by .json() on an unavailable response) when a host is down
+	'''
+	def __init__(self, host, message=None):
+		self.host = host
+		super().__init__(message or f'Upstream unavailable: {host}')
+
+class UnavailableResponse(requests.models.Response):
+	'''
+	Fast result for requests to a host whose circuit is open (or that just failed)
+	'''
+	upstream_unavailable = True
+
+	def __init__(self, url, host):
+		super().__init__()
+		self.status_code = 503
+		self._content = b''
+		self.url = url
+		self.host = host
+		self.reason = f'Upstream unavailable: {host}'
+
+	def json(self, **kwargs):
+		raise UpstreamUnavailable(self.host)
+
+def is_unavailable(response):
+	return getattr(response, 'upstream_unavailable', False)
+
+class CircuitBreaker:
+	'''
+	closed    : requests flow, consecutive failures are counted
+	open      : requests fail fast until recovery_timeout has passed
+	half_open : one trial request is let through; success closes, failure re-opens
+	'''
+	def __init__(self, host, failure_threshold=3, recovery_timeout=60):
+		self.host = host
+		self.failure_threshold = failure_threshold
+		self.recovery_timeout = recovery_timeout
+		self.state = 'closed'
+		self.failures = 0
+		self.opened_at = None
+		self.trial_in_flight = False
+		self.lock = threading.Lock()
+
+	def allow_request(self):
+		with self.lock:
+			if self.state == 'closed':
+				return True
+			if self.state == 'open' and time.monotonic() - self.opened_at >= self.recovery_timeout:
+				self.state = 'half_open'
+				self.trial_in_flight = False
+			if self.state == 'half_open' and not self.trial_in_flight:
+				self.trial_in_flight = True
+				return True
+			return False
+
+	def record_success(self):
+		with self.lock:
+			if self.state != 'closed':
+				print(f'  Circuit closed: {self.host} is back')
+			self.state = 'closed'
+			self.failures = 0
+			self.trial_in_flight = False
+
+	def record_failure(self):
+		with self.lock:
+			self.failures += 1
+			self.trial_in_flight = False
+			if self.state == 'half_open' or self.failures >= self.failure_threshold:
+				if self.state != 'open':
+					print(f'  Circuit open: {self.host} unavailable, failing fast for {self.recovery_timeout}s...')
+				self.state = 'open'
+				self.opened_at = time.monotonic()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(host):
+	with _breakers_lock:
+		breaker = _breakers.get(host)
+		if breaker is None:
+			breaker = CircuitBreaker(host, breaker_config['failure_threshold'], breaker_config['recovery_timeout'])
+			_breakers[host] = breaker
+	return breaker
+
+def configure_breakers(failure_threshold=None, recovery_timeout=None):
+	if failure_threshold is not None:
+		breaker_config['failure_threshold'] = failure_threshold
+	if recovery_timeout is not None:
+		breaker_config['recovery_timeout'] = recovery_timeout
+	with _breakers_lock:
+		_breakers.clear()
+
+def upstream_available(host):
+	'''
+	False while the host's circuit is open (callers can skip whole sections)
+	'''
+	with _breakers_lock:
+		breaker = _breakers.get(host)
+	if breaker is None:
+		return True
+	with breaker.lock:
+		return breaker.state != 'open' or time.monotonic() - breaker.opened_at >= breaker.recovery_timeout
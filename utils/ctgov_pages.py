@@ -0,0 +1,184 @@
+import json
+import urllib.parse
+import numpy as np
+import pandas as pd
+from utils.webpage_scraping import test_connection
+from utils.circuit_breaker import is_unavailable, UpstreamUnavailable
+from utils.row_accumulator import RowAccumulator
+
+ctgov_page_config = {
+	'base_url': 'https://clinicaltrials.gov/api/v2/studies',
+	'page_size': 1000,
+	# stop after this many pages per search (None follows every next-page token)
+	'max_pages': None,
+	# column name -> v2 data pieces (the columns of the old csv output)
+	'fields_path': 'databases/pytrials_fields.csv',
+}
+
+# decoded columns that aren't strings
+ctgov_dtypes = {
+	'Enrollment': 'Int64',
+	'Phases': 'category',
+	'Start Date': 'datetime64[ns]',
+	'Primary Completion Date': 'datetime64[ns]',
+	'Completion Date': 'datetime64[ns]',
+	'First Posted': 'datetime64[ns]',
+	'Results First Posted': 'datetime64[ns]',
+	'Last Update Posted': 'datetime64[ns]',
+}
+
+_field_pieces = {}
+
+def ctgov_field_pieces(fields):
+	'''
+	The v2 data pieces (e.g. NCTId, BriefTitle) needed for the given column names
+	'''
+	if not _field_pieces:
+		pytrial_fields = pd.read_csv(ctgov_page_config['fields_path'])
+		for column, pieces in zip(pytrial_fields['Column Name'], pytrial_fields['Included Data Fields']):
+			_field_pieces[column] = pieces.split('|')
+	pieces = ['NCTId']
+	for field in fields:
+		pieces += _field_pieces.get(field, [])
+	return list(dict.fromkeys(pieces))
+
+def ctgov_query_term(search_expr):
+	# search_expr URL-encoded for query.term ('+' stays, it stands for a space as in ctgov_term)
+	return urllib.parse.quote(search_expr, safe='+')
+
+def ctgov_page_url(search_expr, fields, page_size=None, page_token=None, filter_expr=None):
+	# JSON study search projected onto the pieces behind fields (gzip comes from the session headers)
+	page_size = page_size or ctgov_page_config['page_size']
+	url = f"{ctgov_page_config['base_url']}?format=json&query.term={ctgov_query_term(search_expr)}&markupFormat=legacy&fields={'|'.join(ctgov_field_pieces(fields))}&pageSize={page_size}"
+	if filter_expr:
+		url += f'&filter.advanced={urllib.parse.quote(filter_expr, safe="")}'
+	if page_token:
+		url += f'&pageToken={urllib.parse.quote(page_token, safe="")}'
+	return url
+
+def study_value(study, path):
+	# nested lookup, e.g. study_value(study, 'protocolSection.statusModule.overallStatus')
+	value = study
+	for key in path.split('.'):
+		if not isinstance(value, dict):
+			return None
+		value = value.get(key)
+	return value
+
+def joined(values, sep='|'):
+	values = [value for value in values if value]
+	return sep.join(values) if values else None
+
+def ctgov_date(value):
+	# '2024-07' or '2024-07-15' -> datetime64 (first of the month when there's no day)
+	return np.datetime64(value, 'D') if value else np.datetime64('NaT')
+
+def study_outcomes(outcomes):
+	return joined([joined([outcome.get('measure'), outcome.get('description'), outcome.get('timeFrame')], ', ') for outcome in outcomes or []])
+
+def study_design(design):
+	design = design or {}
+	masking = design.get('maskingInfo', {})
+	who_masked = masking.get('whoMasked')
+	masking_value = masking.get('masking')
+	if masking_value and who_masked:
+		masking_value += f" ({', '.join(who_masked)})"
+	return joined([f'{label}: {value}' for label, value in [
+		('Allocation', design.get('allocation')),
+		('Intervention Model', design.get('interventionModel')),
+		('Masking', masking_value),
+		('Primary Purpose', design.get('primaryPurpose')),
+	] if value])
+
+def study_documents(nct_id, documents):
+	return joined([
+		f"{document.get('label')}, https://cdn.clinicaltrials.gov/large-docs/{nct_id[-2:]}/{nct_id}/{document.get('filename')}"
+		for document in documents or []
+	])
+
+# column -> value decoded from one study (same text as the csv format, typed where ctgov_dtypes says so)
+ctgov_columns = {
+	'NCT Number': lambda s, p: study_value(p, 'identificationModule.nctId'),
+	'Study Title': lambda s, p: study_value(p, 'identificationModule.briefTitle'),
+	'Study URL': lambda s, p: f"https://clinicaltrials.gov/study/{study_value(p, 'identificationModule.nctId')}",
+	'Acronym': lambda s, p: study_value(p, 'identificationModule.acronym'),
+	'Study Status': lambda s, p: study_value(p, 'statusModule.overallStatus'),
+	'Brief Summary': lambda s, p: study_value(p, 'descriptionModule.briefSummary'),
+	'Study Results': lambda s, p: 'YES' if s.get('hasResults') else 'NO',
+	'Conditions': lambda s, p: joined(study_value(p, 'conditionsModule.conditions') or []),
+	'Interventions': lambda s, p: joined([f"{i.get('type')}: {i.get('name')}" for i in study_value(p, 'armsInterventionsModule.interventions') or []]),
+	'Primary Outcome Measures': lambda s, p: study_outcomes(study_value(p, 'outcomesModule.primaryOutcomes')),
+	'Secondary Outcome Measures': lambda s, p: study_outcomes(study_value(p, 'outcomesModule.secondaryOutcomes')),
+	'Other Outcome Measures': lambda s, p: study_outcomes(study_value(p, 'outcomesModule.otherOutcomes')),
+	'Sponsor': lambda s, p: study_value(p, 'sponsorCollaboratorsModule.leadSponsor.name'),
+	'Collaborators': lambda s, p: joined([c.get('name') for c in study_value(p, 'sponsorCollaboratorsModule.collaborators') or []]),
+	'Sex': lambda s, p: study_value(p, 'eligibilityModule.sex'),
+	'Age': lambda s, p: joined(study_value(p, 'eligibilityModule.stdAges') or [], ', '),
+	'Phases': lambda s, p: joined(study_value(p, 'designModule.phases') or []),
+	'Enrollment': lambda s, p: study_value(p, 'designModule.enrollmentInfo.count'),
+	'Funder Type': lambda s, p: study_value(p, 'sponsorCollaboratorsModule.leadSponsor.class'),
+	'Study Type': lambda s, p: study_value(p, 'designModule.studyType'),
+	'Study Design': lambda s, p: study_design(study_value(p, 'designModule.designInfo')),
+	'Other IDs': lambda s, p: joined([study_value(p, 'identificationModule.orgStudyIdInfo.id')] + [i.get('id') for i in study_value(p, 'identificationModule.secondaryIdInfos') or []]),
+	'Start Date': lambda s, p: ctgov_date(study_value(p, 'statusModule.startDateStruct.date')),
+	'Primary Completion Date': lambda s, p: ctgov_date(study_value(p, 'statusModule.primaryCompletionDateStruct.date')),
+	'Completion Date': lambda s, p: ctgov_date(study_value(p, 'statusModule.completionDateStruct.date')),
+	'First Posted': lambda s, p: ctgov_date(study_value(p, 'statusModule.studyFirstPostDateStruct.date')),
+	'Results First Posted': lambda s, p: ctgov_date(study_value(p, 'statusModule.resultsFirstPostDateStruct.date')),
+	'Last Update Posted': lambda s, p: ctgov_date(study_value(p, 'statusModule.lastUpdatePostDateStruct.date')),
+	'Locations': lambda s, p: joined([joined([l.get('facility'), l.get('city'), l.get('state'), l.get('zip'), l.get('country')], ', ') for l in study_value(p, 'contactsLocationsModule.locations') or []]),
+	'Study Documents': lambda s, p: study_documents(study_value(p, 'identificationModule.nctId'), study_value(s, 'documentSection.largeDocumentModule.largeDocs')),
+}
+
+def study_row(study, fields):
+	protocol = study.get('protocolSection', {})
+	return [ctgov_columns[field](study, protocol) if field in ctgov_columns else None for field in fields]
+
+def iter_ctgov_pages(search_expr, fields, page_size=None, max_pages=-1, filter_expr=None):
+	'''
+	Yield each page of a CT.gov study search as records ([header] + rows), decoded
+	from the v2 JSON and following nextPageToken until the last page.
+	filter_expr: an Essie filter.advanced expression, e.g. AREA[LastUpdatePostDate]RANGE[2024-01-01,MAX]
+	'''
+	if max_pages == -1:
+		max_pages = ctgov_page_config['max_pages']
+	fields = list(fields)
+	page_token = None
+	n_pages = 0
+	while True:
+		response = test_connection(ctgov_page_url(search_expr, fields, page_size, page_token, filter_expr))
+		if is_unavailable(response):
+			raise UpstreamUnavailable(response.host)
+		response.raise_for_status()
+		content = json.loads(response.content)
+		yield [fields] + [study_row(study, fields) for study in content.get('studies', [])]
+		n_pages += 1
+		page_token = content.get('nextPageToken')
+		if not page_token:
+			return
+		if max_pages is not None and n_pages >= max_pages:
+			print(f'  WARNING: {search_expr} truncated after {n_pages} pages')
+			return
+
+def get_ctgov_records(search_expr, fields, page_size=None, max_pages=-1, filter_expr=None):
+	'''
+	All pages of a search as one list of records ([header] + rows)
+	'''
+	ct_output = None
+	for page in iter_ctgov_pages(search_expr, fields, page_size, max_pages, filter_expr):
+		if ct_output is None:
+			ct_output = page
+		else:
+			ct_output += page[1:]
+	return ct_output
+
+def ctgov_schema(columns):
+	# {column: dtype} for a RowAccumulator (strings stay object)
+	return {column: ctgov_dtypes.get(column, object) for column in columns}
+
+def records_to_frame(records, extra_columns={}):
+	# records ([header] + rows) -> typed DataFrame, with constant columns (e.g. Drug Name) in front
+	rows = RowAccumulator(ctgov_schema(list(extra_columns.keys()) + records[0]))
+	for row in records[1:]:
+		rows.append(list(extra_columns.values()) + row)
+	return rows.to_frame()
@@ -1,84 +1,337 @@
+import re
+import requests
 import pandas as pd
-from pytrials.client import ClinicalTrials
+from collections import defaultdict, Counter
+from utils.async_fetch import map_async, run_sync
 from utils.drug_search import read_pytrials_fields
+from utils.row_accumulator import RowAccumulator, MergingRowAccumulator, as_set
+from utils.synonym_ranking import rank_synonyms, classify_synonym
+from utils.ctgov_pages import get_ctgov_records, iter_ctgov_pages, ctgov_page_url, ctgov_query_term, records_to_frame, ctgov_schema, ctgov_page_config
+from utils.partitions import PartitionWriter, iter_partitions
+from utils.ctgov_store import get_ctgov_store
+from utils.ctgov_snapshot import get_ctgov_snapshot
+from utils.circuit_breaker import UpstreamUnavailable
 
-
-def flatten(items, seqtypes=(list, tuple)):
-	for i, x in enumerate(items):
-		while i < len(items) and isinstance(items[i], seqtypes):
-			items[i:i+1] = items[i]
-	return items
-
-def flatten_remove_duplicates(messy_list):
-	clean_list = []
-	for item in messy_list:
-		# flatten list
-		flattened_item = flatten(item)
-		# remove duplicates
-		clean_item = list(set(flattened_item))
-		clean_list.append(clean_item)
-	return clean_list
+merge_columns = ['Drug Name', 'Search Term']
 
 def clean_ctgov_df(ctgov_df):
-	# drop rows with the same 'NCT Number' but combine the 'Search Term' fields and keep the first for all other fields
-	agg_dict = {field: 'first' for field in ctgov_df.columns if field not in ['Drug Name', 'Search Term']}
-	# combine 'Search Term' fields but don't have duplicates
-	agg_dict['Drug Name'] = list
-	agg_dict['Search Term'] = list
-	ctgov_df = ctgov_df.groupby('NCT Number', as_index=False).agg(agg_dict)
+	'''
+	One row per 'NCT Number' (first row's values), with the drug names and search
+	terms of all its rows merged into lists without duplicates
+	'''
+	# hash-keyed merge of the two list columns; the other columns come from each trial's first row
+	merged = {}
+	for nct_number, drug_names, search_terms in zip(ctgov_df['NCT Number'].values, ctgov_df['Drug Name'].values, ctgov_df['Search Term'].values):
+		if nct_number not in merged:
+			merged[nct_number] = (set(), set())
+		merged[nct_number][0].update(as_set(drug_names))
+		merged[nct_number][1].update(as_set(search_terms))
+	ctgov_df = ctgov_df.drop_duplicates(subset='NCT Number').reset_index(drop=True)
+	ctgov_df = ctgov_df[merge_columns + [column for column in ctgov_df.columns if column not in merge_columns]]
+	for m_index, column in enumerate(merge_columns):
+		ctgov_df[column] = [sorted(merged[nct_number][m_index], key=str) for nct_number in ctgov_df['NCT Number'].values]
 	print('Number of rows in ctgov_df after dropping duplicates:', len(ctgov_df))
-	# move 'Search Term' to the first column
-	ctgov_df = ctgov_df[['Drug Name', 'Search Term'] + [col for col in ctgov_df.columns if col not in ['Drug Name', 'Search Term']]]
-	# for each row, if there are duplicates in 'Drug Name' and 'Search Term' lists, keep only the first and flatten the lists
-	drug_names = ctgov_df['Drug Name'].values
-	search_terms = ctgov_df['Search Term'].values
-	ctgov_df['Drug Name'] = flatten_remove_duplicates(drug_names)
-	ctgov_df['Search Term'] = flatten_remove_duplicates(search_terms)
 	return ctgov_df
 
-def parse_ctgov_synonyms(pubchem_df, ctgov_df, ct, drug_name, ct_fields):
+def ctgov_term(synonym):
+	return synonym.lower().replace(' ', '+')
+
+def drug_synonyms(pubchem_df, drug_name):
+	drug_row = pubchem_df[pubchem_df['drug_name'] == drug_name]
+	synonyms = drug_row.compound_synonyms.values[0]
+	if synonyms is None:
+		return None, []
+	if isinstance(synonyms, str):
+		synonyms = [synonyms]
+	# the searched names themselves are always kept
+	names = [drug_name, drug_row.active_ingredient.values[0]]
+	return synonyms, [name for name in dict.fromkeys(names) if name in synonyms]
+
+def ctgov_synonym_terms(pubchem_df, drug_name, budget=-1, excluded_classes=None):
+	'''
+	Ranked, de-duplicated search terms for a drug (see utils.synonym_ranking;
+	budget=None and excluded_classes=[] search every synonym)
+	'''
+	synonyms, names = drug_synonyms(pubchem_df, drug_name)
+	if synonyms is None:
+		# print(f'No synonyms found for {drug_name}...')
+		return None
+	ranked_synonyms = rank_synonyms(synonyms, budget=budget, excluded_classes=excluded_classes, keep=names)
+	print(f'Number of synonyms for {drug_name}: {len(synonyms)} (searching {len(ranked_synonyms)})')
+	return [ctgov_term(synonym) for synonym in ranked_synonyms]
+
+def ctgov_nct_numbers(ct_output):
+	if ct_output is None or len(ct_output) < 2 or 'NCT Number' not in ct_output[0]:
+		return set()
+	nct_index = ct_output[0].index('NCT Number')
+	return set([row[nct_index] for row in ct_output[1:]])
+
+def evaluate_synonym_pruning(pubchem_df, budget=-1, excluded_classes=None):
+	'''
+	Query every synonym of every drug once and report how many trials the
+	pruned term list (budget/excluded_classes) finds compared with the full set,
+	and which synonym classes found the trials that were lost
+	'''
+	ct_fields = read_pytrials_fields()
+	stats_rows = RowAccumulator(['drug_name', 'n_synonyms', 'n_terms', 'n_trials_full', 'n_trials_pruned', 'n_trials_lost', 'lost_by_class'])
+	for drug_name in pubchem_df['drug_name'].values:
+		synonyms, names = drug_synonyms(pubchem_df, drug_name)
+		if synonyms is None:
+			continue
+		all_synonyms = rank_synonyms(synonyms, budget=None, excluded_classes=[], keep=names)
+		pruned_terms = set([ctgov_term(synonym) for synonym in rank_synonyms(synonyms, budget=budget, excluded_classes=excluded_classes, keep=names)])
+		ct_outputs = run_sync(map_async(lambda synonym: query_ctgov_synonym(ctgov_term(synonym), ct_fields), all_synonyms))
+		full_trials, pruned_trials = set(), set()
+		trial_classes = defaultdict(set)
+		for synonym, ct_output in zip(all_synonyms, ct_outputs):
+			nct_numbers = ctgov_nct_numbers(ct_output)
+			full_trials |= nct_numbers
+			if ctgov_term(synonym) in pruned_terms:
+				pruned_trials |= nct_numbers
+			for nct_number in nct_numbers:
+				trial_classes[nct_number].add(classify_synonym(synonym))
+		lost_trials = full_trials - pruned_trials
+		lost_by_class = Counter([synonym_class for nct_number in lost_trials for synonym_class in trial_classes[nct_number]])
+		print(f'  {drug_name}: {len(pruned_terms)}/{len(all_synonyms)} terms, {len(pruned_trials)}/{len(full_trials)} trials ({len(lost_trials)} lost)')
+		stats_rows.append([drug_name, len(synonyms), len(pruned_terms), len(full_trials), len(pruned_trials), len(lost_trials), dict(lost_by_class)])
+	stats_df = stats_rows.to_frame()
+	if len(stats_df) > 0:
+		print(f'Terms searched: {stats_df["n_terms"].sum()} (all synonyms: {stats_df["n_synonyms"].sum()})')
+		print(f'Trials lost: {stats_df["n_trials_lost"].sum()}/{stats_df["n_trials_full"].sum()}')
+	return stats_df
+
+def query_ctgov_synonym(synonym, ct_fields, incremental=False, local=False):
+	try:
+		if local and get_ctgov_snapshot() is not None:
+			# answered from the ingested bulk export (utils.ctgov_snapshot)
+			ct_output = get_ctgov_snapshot().search(synonym, ct_fields)
+		elif incremental and get_ctgov_store() is not None:
+			# only the studies updated since the last sync, merged into the stored ones
+			ct_output = get_ctgov_store().sync(synonym, ct_fields)
+		else:
+			# every page of the study fields search (not only the first 1000 studies)
+			ct_output = get_ctgov_records(synonym, ct_fields)
+	except UpstreamUnavailable:
+		# the host is down: callers skip the whole section instead of reporting no trials
+		raise
+	except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+		# print(f'  Error parsing {synonym}...')
+		return None
+	return ct_output
+
+def ctgov_accumulator(ct_fields, dedup=False):
+	# typed like the decoded pages; columns the fields list doesn't know about are added as they show up
+	schema = ctgov_schema(merge_columns + list(ct_fields))
+	if dedup:
+		# one row per trial as rows come in, with the drugs/search terms that found it merged
+		return MergingRowAccumulator(schema, key='NCT Number', merge_columns=merge_columns, extend_columns=True)
+	return RowAccumulator(schema, extend_columns=True)
+
+def add_ctgov_rows(ctgov_rows, drug_name, synonym, ct_output):
+	if ct_output is None:
+		# print(f'    No clinical trials found for {synonym}...')
+		return ctgov_rows, 0
+	# print(f'    Number of clinical trials found for {synonym}: {len(ct_output)}')
+	row_header = ['Drug Name', 'Search Term'] + ct_output[0]
+	# add all rows to the accumulator
+	for row in ct_output[1:]:
+		ctgov_rows.append(dict(zip(row_header, [drug_name, synonym] + row)))
+	return ctgov_rows, len(ct_output[1:])
+
+def parse_ctgov_synonyms(pubchem_df, ctgov_rows, drug_name, ct_fields, incremental=False, local=False):
 	if drug_name not in pubchem_df['drug_name'].values:
 		# print(f'{drug_name} not found in pubchem_df...')
-		return None
-	synonyms = pubchem_df[pubchem_df['drug_name'] == drug_name].compound_synonyms.values[0]
+		return ctgov_rows
+	synonyms = ctgov_synonym_terms(pubchem_df, drug_name)
 	if synonyms is None:
-		# print(f'No synonyms found for {drug_name}...')
-		return ctgov_df
-	print(f'Number of synonyms for {drug_name}: {len(synonyms)}')
-	synonyms = [synonym.lower() for synonym in synonyms]
-	synonyms = [synonym.replace(' ', '+') for synonym in synonyms]
+		return ctgov_rows
 	ct_gov_count = 0
 	for synonym in synonyms:
-		try:
-			# get the NCTId, Condition and Brief title fields from 1000 studies related to Coronavirus and Covid, in csv format.
-			ct_output = ct.get_study_fields(
-				search_expr=synonym,
-				fields=ct_fields,
-				max_studies=1000,
-				fmt="csv",
-			)
-			if ct_output is None:
-				# print(f'    No clinical trials found for {synonym}...')
-				continue
-			# print(f'    Number of clinical trials found for {synonym}: {len(ct_output)}')
-			row_header = ['Drug Name', 'Search Term'] + ct_output[0]
-			# add all rows to the dataframe
-			for row in ct_output[1:]:
-				ctgov_df = pd.concat([ctgov_df, pd.DataFrame([drug_name, synonym] + row, index=row_header).T], ignore_index=True)
-				ct_gov_count += 1
-		except:
-			# print(f'  Error parsing {drug_name} - {synonym}...')
-			continue
+		ct_output = query_ctgov_synonym(synonym, ct_fields, incremental, local)
+		ctgov_rows, n_rows = add_ctgov_rows(ctgov_rows, drug_name, synonym, ct_output)
+		ct_gov_count += n_rows
 	print(f'    CTs found: {ct_gov_count}')
-	return ctgov_df
+	return ctgov_rows
 
-def get_ctgov_synonyms(pubchem_df):
+def get_ctgov_synonyms(pubchem_df, concurrent=False, batch=False, incremental=False, local=False, dedup=False):
+	'''
+	incremental: sync each search through the local trial store (utils.ctgov_store),
+	requesting only studies updated since the term was last searched
+	local: answer from the ingested snapshot (utils.ctgov_snapshot) without any request
+	dedup: one row per NCT Number, with 'Drug Name'/'Search Term' lists of every match
+	(merged as rows come in, see clean_ctgov_df for an existing DataFrame)
+	'''
+	if batch:
+		return run_sync(get_ctgov_synonyms_batched(pubchem_df, incremental, local, dedup))
+	if concurrent:
+		return run_sync(get_ctgov_synonyms_async(pubchem_df, incremental, local, dedup))
 	ct_fields = read_pytrials_fields()
-	ct = ClinicalTrials()
 	# create a dataframe
-	ctgov_df = pd.DataFrame(columns=['Drug Name', 'Search Term'] + list(ct_fields))
+	ctgov_rows = ctgov_accumulator(ct_fields, dedup)
 	for d_index, drug in enumerate(pubchem_df['drug_name'].values):
-		ctgov_df = parse_ctgov_synonyms(pubchem_df, ctgov_df, ct, drug, ct_fields)
-	# clean the dataframe
-	# ctgov_df = clean_ctgov_df(ctgov_df)
-	return ctgov_df
\ No newline at end of file
+		ctgov_rows = parse_ctgov_synonyms(pubchem_df, ctgov_rows, drug, ct_fields, incremental, local)
+	ctgov_df = ctgov_rows.to_frame()
+	return ctgov_df
+
+async def get_ctgov_synonyms_async(pubchem_df, incremental=False, local=False, dedup=False):
+	'''
+	Same as get_ctgov_synonyms, but every (drug, synonym) query runs concurrently (bounded per host)
+	'''
+	ct_fields = read_pytrials_fields()
+	ctgov_rows = ctgov_accumulator(ct_fields, dedup)
+	searches = []
+	for drug in pubchem_df['drug_name'].values:
+		synonyms = ctgov_synonym_terms(pubchem_df, drug)
+		if synonyms is not None:
+			searches += [(drug, synonym) for synonym in synonyms]
+	ct_outputs = await map_async(lambda search: query_ctgov_synonym(search[1], ct_fields, incremental, local), searches)
+	for (drug, synonym), ct_output in zip(searches, ct_outputs):
+		ctgov_rows, _ = add_ctgov_rows(ctgov_rows, drug, synonym, ct_output)
+	print(f'    CTs found: {len(ctgov_rows)}')
+	return ctgov_rows.to_frame()
+
+# OR-batched searches: several synonyms per study fields request
+ctgov_batch_config = {
+	'max_url_length': 4000,
+	'max_terms': 25,
+}
+
+def ctgov_or_expression(terms):
+	# quoted phrases OR-ed together (ctgov_page_url encodes it)
+	return ' OR '.join(['"' + term.replace('+', ' ').replace('"', '') + '"' for term in terms])
+
+def ctgov_url_length(ct_fields, search_expr=''):
+	# longest page URL (with a page token) for the search
+	return len(ctgov_page_url(search_expr, ct_fields, page_token='x'*64))
+
+def plan_ctgov_batches(terms, max_expression_length, max_terms=25):
+	'''
+	Pack ranked terms, in order, into OR expressions no longer than max_expression_length
+	(a term that is too long on its own gets a batch to itself)
+	'''
+	batches = []
+	batch = []
+	for term in terms:
+		candidate = batch + [term]
+		if batch and (len(candidate) > max_terms or len(ctgov_query_term(ctgov_or_expression(candidate))) > max_expression_length):
+			batches.append(batch)
+			batch = [term]
+		else:
+			batch = candidate
+	if batch:
+		batches.append(batch)
+	return batches
+
+def term_pattern(term):
+	# whole-word match, any run of spaces/hyphens between words
+	words = [re.escape(word) for word in re.split(r'[\s+\-]+', term.lower()) if word]
+	return re.compile(r'(?<![a-z0-9])' + r'[\s\-]+'.join(words) + r'(?![a-z0-9])')
+
+def attribute_ctgov_rows(terms, ct_output):
+	'''
+	Assign each returned trial to the batch terms found in its fields; trials matched
+	through fields that weren't fetched go to the batch's first-ranked term.
+	Returns ({term: [rows]}, number of fallback rows)
+	'''
+	patterns = {term: term_pattern(term) for term in terms}
+	term_rows = {term: [] for term in terms}
+	n_fallback = 0
+	for row in ct_output[1:]:
+		row_text = ' '.join([value for value in row if isinstance(value, str)]).lower()
+		matched = [term for term in terms if patterns[term].search(row_text)]
+		if len(matched) == 0:
+			matched = [terms[0]]
+			n_fallback += 1
+		for term in matched:
+			term_rows[term].append(row)
+	return term_rows, n_fallback
+
+def query_ctgov_batch(terms, ct_fields, incremental=False, local=False):
+	'''
+	Run one OR batch (every page). Returns (terms, ct_output).
+	'''
+	return terms, query_ctgov_synonym(ctgov_or_expression(terms), ct_fields, incremental, local)
+
+async def get_ctgov_synonyms_batched(pubchem_df, incremental=False, local=False, dedup=False):
+	'''
+	Same rows as get_ctgov_synonyms (one per trial and matching search term), with each
+	drug's ranked terms packed into OR expressions under the URL length limit
+	'''
+	ct_fields = read_pytrials_fields()
+	ctgov_rows = ctgov_accumulator(ct_fields, dedup)
+	max_expression_length = ctgov_batch_config['max_url_length'] - ctgov_url_length(ct_fields)
+	searches = []
+	n_terms = 0
+	for drug in pubchem_df['drug_name'].values:
+		terms = ctgov_synonym_terms(pubchem_df, drug)
+		if terms is not None:
+			n_terms += len(terms)
+			searches += [(drug, batch) for batch in plan_ctgov_batches(terms, max_expression_length, ctgov_batch_config['max_terms'])]
+	print(f'  Searching {n_terms} terms in {len(searches)} OR-batched requests...')
+	batch_outputs = await map_async(lambda search: query_ctgov_batch(search[1], ct_fields, incremental, local), searches)
+	n_fallback = 0
+	for (drug, _), (terms, ct_output) in zip(searches, batch_outputs):
+		if ct_output is None or len(ct_output) < 2:
+			continue
+		term_rows, n_batch_fallback = attribute_ctgov_rows(terms, ct_output)
+		n_fallback += n_batch_fallback
+		for term in terms:
+			if term_rows[term]:
+				add_ctgov_rows(ctgov_rows, drug, term, [ct_output[0]] + term_rows[term])
+	print(f'    CTs found: {len(ctgov_rows)} ({n_fallback} attributed to the first term of their batch)')
+	return ctgov_rows.to_frame()
+
+def stream_ctgov_synonyms(pubchem_df, out_dir, batch=False, incremental=False, local=False):
+	'''
+	Same rows as get_ctgov_synonyms (OR-batched if batch), written page by page as
+	partitions under out_dir so memory stays flat however many trials match.
+	Read them back with iter_ctgov_chunks. Returns the number of rows written.
+	'''
+	ct_fields = read_pytrials_fields()
+	writer = PartitionWriter(out_dir)
+	max_expression_length = ctgov_batch_config['max_url_length'] - ctgov_url_length(ct_fields)
+	searches = []
+	for drug in pubchem_df['drug_name'].values:
+		terms = ctgov_synonym_terms(pubchem_df, drug)
+		if terms is None:
+			continue
+		if batch:
+			searches += [(drug, terms_batch, ctgov_or_expression(terms_batch)) for terms_batch in plan_ctgov_batches(terms, max_expression_length, ctgov_batch_config['max_terms'])]
+		else:
+			searches += [(drug, [term], term) for term in terms]
+	def stream_search(search):
+		drug, terms, search_expr = search
+		try:
+			for page in iter_search_pages(search_expr, ct_fields, incremental, local):
+				if len(page) < 2:
+					continue
+				term_rows, _ = attribute_ctgov_rows(terms, page)
+				for term in terms:
+					if term_rows[term]:
+						writer.write(records_to_frame([page[0]] + term_rows[term], {'Drug Name': drug, 'Search Term': term}))
+		except UpstreamUnavailable:
+			raise
+		except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+			# same as query_ctgov_synonym: a failed search contributes no rows
+			return
+	print(f'  Streaming {len(searches)} searches to {out_dir}...')
+	run_sync(map_async(stream_search, searches))
+	print(f'    CTs found: {writer.n_rows} ({writer.n_partitions} partitions)')
+	return writer.n_rows
+
+def iter_search_pages(search_expr, ct_fields, incremental=False, local=False):
+	if local and get_ctgov_snapshot() is not None:
+		ct_output = get_ctgov_snapshot().search(search_expr, ct_fields)
+	elif incremental and get_ctgov_store() is not None:
+		ct_output = get_ctgov_store().sync(search_expr, ct_fields)
+	else:
+		yield from iter_ctgov_pages(search_expr, ct_fields)
+		return
+	# the snapshot's or synced studies, in pages like a remote search
+	page_size = ctgov_page_config['page_size']
+	for p_index in range(1, len(ct_output), page_size):
+		yield [ct_output[0]] + ct_output[p_index:p_index + page_size]
+
+def iter_ctgov_chunks(out_dir, columns=None):
+	# the streamed rows, one partition (DataFrame) at a time
+	return iter_partitions(out_dir, columns)
@@ -0,0 +1,243 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import zipfile
+import argparse
+import threading
+from utils.ctgov_pages import ctgov_columns, study_row
+from utils.ctgov_store import encode_value, decode_row
+
+ctgov_snapshot_config = {
+	'path': os.path.join('databases', 'ctgov_snapshot.sqlite'),
+	# studies per insert transaction while ingesting
+	'batch_size': 2000,
+}
+
+# columns with an inverted index (search terms are matched against these)
+indexed_columns = {
+	'Conditions': 'condition',
+	'Interventions': 'intervention',
+	'Sponsor': 'sponsor',
+}
+
+def tokenize(text):
+	return re.findall(r'[a-z0-9]+', text.lower()) if text else []
+
+def phrase_pattern(words):
+	# the words in order, separated by anything that isn't a letter or digit
+	return re.compile(r'(?<![a-z0-9])' + r'[^a-z0-9]+'.join([re.escape(word) for word in words]) + r'(?![a-z0-9])')
+
+def search_phrases(search_expr):
+	'''
+	A search term as sent to CT.gov ('acetyl+salicylic', or an OR expression
+	of quoted phrases) -> list of phrases, each a list of words
+	'''
+	expression = search_expr.replace('+', ' ')
+	phrases = [phrase.strip().strip('"') for phrase in re.split(r'\s+OR\s+', expression)]
+	return [tokenize(phrase) for phrase in phrases if tokenize(phrase)]
+
+class CTGovSnapshot:
+	'''
+	A local copy of the CT.gov bulk study export in sqlite: studies by NCT number
+	and an inverted index (token -> studies) over conditions, interventions and
+	sponsor, so searches don't need a round trip
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.executescript('''
+			CREATE TABLE IF NOT EXISTS studies (
+				nct_number TEXT PRIMARY KEY,
+				last_update TEXT,
+				record TEXT
+			);
+			CREATE TABLE IF NOT EXISTS postings (
+				token TEXT,
+				field TEXT,
+				nct_number TEXT,
+				PRIMARY KEY (token, field, nct_number)
+			) WITHOUT ROWID;
+			CREATE TABLE IF NOT EXISTS snapshot_info (
+				key TEXT PRIMARY KEY,
+				value TEXT
+			);
+		''')
+		self.db.commit()
+
+	def put_studies(self, studies, update=False):
+		'''
+		Add decoded studies: [{column: value}] (update: they may already be stored,
+		so their old index entries are dropped first)
+		'''
+		study_rows = []
+		postings = []
+		for record in studies:
+			nct_number = record['NCT Number']
+			study_rows.append((nct_number, record.get('Last Update Posted'), json.dumps(record)))
+			for column, field in indexed_columns.items():
+				postings += [(token, field, nct_number) for token in set(tokenize(record.get(column)))]
+		with self.lock:
+			if update:
+				self.db.executemany('DELETE FROM postings WHERE nct_number = ?', [(study[0],) for study in study_rows])
+			self.db.executemany('INSERT OR REPLACE INTO studies VALUES (?, ?, ?)', study_rows)
+			self.db.executemany('INSERT OR IGNORE INTO postings VALUES (?, ?, ?)', postings)
+			self.db.commit()
+
+	def ingest_zip(self, zip_path, batch_size=None, replace=False):
+		'''
+		Stream the per-study JSON files of a bulk export zip into the store
+		(one study in memory at a time, inserted in batches). replace=True
+		clears the old snapshot first; otherwise studies are updated in place.
+		'''
+		batch_size = batch_size or ctgov_snapshot_config['batch_size']
+		columns = list(ctgov_columns.keys())
+		with self.lock:
+			if replace:
+				self.db.execute('DELETE FROM studies')
+				self.db.execute('DELETE FROM postings')
+				self.db.commit()
+			update = self.db.execute('SELECT 1 FROM studies LIMIT 1').fetchone() is not None
+		start_time = time.time()
+		n_studies = 0
+		batch = []
+		with zipfile.ZipFile(zip_path) as archive:
+			for member in archive.infolist():
+				if member.is_dir() or not member.filename.endswith('.json'):
+					continue
+				with archive.open(member) as f:
+					study = json.load(f)
+				batch.append({column: encode_value(value) for column, value in zip(columns, study_row(study, columns))})
+				if len(batch) >= batch_size:
+					self.put_studies(batch, update)
+					n_studies += len(batch)
+					batch = []
+					print(f'  {n_studies} studies ingested...', end='\r')
+		if batch:
+			self.put_studies(batch, update)
+			n_studies += len(batch)
+		with self.lock:
+			self.db.executemany('INSERT OR REPLACE INTO snapshot_info VALUES (?, ?)', [
+				('source', os.path.basename(zip_path)),
+				('ingested_at', time.strftime('%Y-%m-%d %H:%M:%S')),
+			])
+			self.db.commit()
+		print(f'Ingested {n_studies} studies from {zip_path} in {time.time() - start_time:.1f}s')
+		return n_studies
+
+	def get_study(self, nct_number):
+		'''
+		Decoded study {column: value} for an NCT number, or None
+		'''
+		with self.lock:
+			row = self.db.execute('SELECT record FROM studies WHERE nct_number = ?', (nct_number,)).fetchone()
+		if row is None:
+			return None
+		columns = list(ctgov_columns.keys())
+		return dict(zip(columns, decode_row(json.loads(row[0]), columns)))
+
+	def token_studies(self, token, fields=None):
+		fields = fields or list(indexed_columns.values())
+		with self.lock:
+			rows = self.db.execute(
+				f'SELECT nct_number FROM postings WHERE token = ? AND field IN ({",".join("?"*len(fields))})',
+				[token] + fields).fetchall()
+		return set([row[0] for row in rows])
+
+	def find(self, search_expr, fields=None):
+		'''
+		NCT numbers of the studies matching any phrase of search_expr in the indexed
+		columns (fields: 'condition', 'intervention' and/or 'sponsor'; default all)
+		'''
+		nct_numbers = set()
+		for words in search_phrases(search_expr):
+			candidates = None
+			for word in words:
+				postings = self.token_studies(word, fields)
+				candidates = postings if candidates is None else candidates & postings
+				if not candidates:
+					break
+			if not candidates:
+				continue
+			if len(words) > 1:
+				# the words are all there; keep the studies that have them as a phrase
+				pattern = phrase_pattern(words)
+				candidates = set([nct_number for nct_number, record in self.records(candidates)
+					if any(pattern.search(str(record.get(column) or '').lower()) for column in indexed_columns)])
+			nct_numbers |= candidates
+		return nct_numbers
+
+	def records(self, nct_numbers):
+		nct_numbers = list(nct_numbers)
+		records = []
+		with self.lock:
+			for s_index in range(0, len(nct_numbers), 500):
+				chunk = nct_numbers[s_index:s_index + 500]
+				records += self.db.execute(
+					f'SELECT nct_number, record FROM studies WHERE nct_number IN ({",".join("?"*len(chunk))}) ORDER BY last_update DESC',
+					chunk).fetchall()
+		return [(nct_number, json.loads(record)) for nct_number, record in records]
+
+	def search(self, search_expr, fields):
+		'''
+		Same shape as ctgov_pages.get_ctgov_records: [fields] + rows
+		'''
+		nct_numbers = self.find(search_expr)
+		fields = list(fields)
+		return [fields] + [decode_row(record, fields) for _, record in self.records(nct_numbers)]
+
+	def info(self):
+		with self.lock:
+			return dict(self.db.execute('SELECT key, value FROM snapshot_info').fetchall())
+
+	def __len__(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM studies').fetchone()[0]
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+def configure_ctgov_snapshot(path=None, batch_size=None):
+	global _snapshot
+	for key, value in [('path', path), ('batch_size', batch_size)]:
+		if value is not None:
+			ctgov_snapshot_config[key] = value
+	with _snapshot_lock:
+		_snapshot = None
+
+def get_ctgov_snapshot(create=False):
+	'''
+	Process-wide snapshot, or None if nothing has been ingested (unless create)
+	'''
+	global _snapshot
+	if not create and not os.path.exists(ctgov_snapshot_config['path']):
+		return None
+	with _snapshot_lock:
+		if _snapshot is None:
+			_snapshot = CTGovSnapshot(ctgov_snapshot_config['path'])
+	return _snapshot
+
+if __name__ == '__main__':
+	# python -m utils.ctgov_snapshot --ingest AllPublicJSON.zip
+	parser = argparse.ArgumentParser(description='Ingest or query a local ClinicalTrials.gov snapshot')
+	parser.add_argument('--ingest', type=str, default=None, help='bulk export zip (per-study JSON files)')
+	parser.add_argument('--replace', action='store_true', help='drop the old snapshot before ingesting')
+	parser.add_argument('--search', type=str, default=None, help='search term to look up locally')
+	parser.add_argument('--nct', type=str, default=None, help='NCT number to look up')
+	parser.add_argument('--path', type=str, default=None, help='snapshot path (default databases/ctgov_snapshot.sqlite)')
+	args = parser.parse_args()
+	configure_ctgov_snapshot(path=args.path)
+	snapshot = get_ctgov_snapshot(create=True)
+	if args.ingest:
+		snapshot.ingest_zip(args.ingest, replace=args.replace)
+	print(f'{len(snapshot)} studies {snapshot.info()}')
+	if args.search:
+		start_time = time.perf_counter()
+		nct_numbers = snapshot.find(args.search)
+		print(f'{args.search}: {len(nct_numbers)} studies in {(time.perf_counter() - start_time)*1000:.1f} ms')
+	if args.nct:
+		print(snapshot.get_study(args.nct))
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import datetime
+import threading
+import numpy as np
+from utils.ctgov_pages import get_ctgov_records, ctgov_date, ctgov_dtypes
+from utils.circuit_breaker import UpstreamUnavailable
+
+ctgov_store_config = {
+	'path': os.path.join('databases', 'ctgov_store.sqlite'),
+	# days re-requested before the last sync (Last Update Posted only has day resolution)
+	'overlap_days': 1,
+	'enabled': True,
+}
+
+date_columns = [column for column, dtype in ctgov_dtypes.items() if dtype.startswith('datetime64')]
+
+def encode_value(value):
+	# row value -> JSON (dates as YYYY-MM-DD, NaT as null)
+	if isinstance(value, np.datetime64):
+		return None if np.isnat(value) else str(value.astype('datetime64[D]'))
+	if isinstance(value, np.integer):
+		return int(value)
+	return value
+
+def decode_row(record, fields):
+	return [ctgov_date(record.get(field)) if field in date_columns else record.get(field) for field in fields]
+
+class CTGovStore:
+	'''
+	Trials by NCT number (with Last Update Posted) in sqlite, and for each search
+	term the trials it returned and when it was last synced, so a repeat search
+	only asks CT.gov for studies updated since then
+	'''
+	def __init__(self, path, overlap_days=1):
+		self.path = path
+		self.overlap_days = overlap_days
+		self.lock = threading.Lock()
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.executescript('''
+			CREATE TABLE IF NOT EXISTS studies (
+				nct_number TEXT PRIMARY KEY,
+				last_update TEXT,
+				record TEXT
+			);
+			CREATE TABLE IF NOT EXISTS term_studies (
+				term TEXT,
+				nct_number TEXT,
+				PRIMARY KEY (term, nct_number)
+			);
+			CREATE TABLE IF NOT EXISTS term_syncs (
+				term TEXT PRIMARY KEY,
+				fields TEXT,
+				synced_on TEXT,
+				synced_at REAL
+			);
+		''')
+		self.db.commit()
+
+	def last_sync(self, term, fields):
+		'''
+		Date of the last sync of term with these fields, or None (never synced)
+		'''
+		with self.lock:
+			row = self.db.execute('SELECT fields, synced_on FROM term_syncs WHERE term = ?', (term,)).fetchone()
+		if row is None or json.loads(row[0]) != list(fields):
+			return None
+		return row[1]
+
+	def put_records(self, term, ct_output, fields):
+		'''
+		Upsert the studies of a search result ([header] + rows) and link them to term
+		'''
+		header = ct_output[0]
+		nct_index = header.index('NCT Number')
+		update_index = header.index('Last Update Posted') if 'Last Update Posted' in header else None
+		studies = []
+		for row in ct_output[1:]:
+			record = {column: encode_value(value) for column, value in zip(header, row)}
+			last_update = record.get('Last Update Posted') if update_index is not None else None
+			studies.append((row[nct_index], last_update, json.dumps(record)))
+		with self.lock:
+			self.db.executemany('INSERT OR REPLACE INTO studies VALUES (?, ?, ?)', studies)
+			self.db.executemany('INSERT OR IGNORE INTO term_studies VALUES (?, ?)', [(term, study[0]) for study in studies])
+			self.db.commit()
+		return len(studies)
+
+	def mark_synced(self, term, fields, synced_on):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO term_syncs VALUES (?, ?, ?, ?)', (term, json.dumps(list(fields)), synced_on, time.time()))
+			self.db.commit()
+
+	def term_records(self, term, fields):
+		'''
+		Stored studies for a term as records ([header] + rows), newest update first
+		'''
+		with self.lock:
+			rows = self.db.execute('''
+				SELECT studies.record FROM term_studies
+				JOIN studies ON studies.nct_number = term_studies.nct_number
+				WHERE term_studies.term = ?
+				ORDER BY studies.last_update DESC''', (term,)).fetchall()
+		fields = list(fields)
+		return [fields] + [decode_row(json.loads(row[0]), fields) for row in rows]
+
+	def sync(self, term, fields):
+		'''
+		Bring term up to date (a full search the first time, then only studies with
+		Last Update Posted since the previous sync) and return all its stored studies
+		'''
+		fields = list(fields)
+		if 'Last Update Posted' not in fields:
+			fields.append('Last Update Posted')
+		synced_on = datetime.date.today().isoformat()
+		last_sync = self.last_sync(term, fields)
+		filter_expr = None
+		if last_sync is not None:
+			since = datetime.date.fromisoformat(last_sync) - datetime.timedelta(days=self.overlap_days)
+			filter_expr = f'AREA[LastUpdatePostDate]RANGE[{since.isoformat()},MAX]'
+		try:
+			ct_output = get_ctgov_records(term, fields, filter_expr=filter_expr)
+		except UpstreamUnavailable:
+			if last_sync is None:
+				raise
+			# serve what was stored at the last sync
+			print(f'    {term}: CT.gov unavailable, using studies synced on {last_sync}')
+			return self.term_records(term, fields)
+		n_updated = self.put_records(term, ct_output, fields) if ct_output is not None else 0
+		self.mark_synced(term, fields, synced_on)
+		records = self.term_records(term, fields)
+		print(f'    {term}: {n_updated} new/updated studies ({len(records) - 1} stored)')
+		return records
+
+	def __len__(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM studies').fetchone()[0]
+
+	def n_terms(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM term_syncs').fetchone()[0]
+
+_store = None
+_store_lock = threading.Lock()
+
+def configure_ctgov_store(path=None, overlap_days=None, enabled=None):
+	global _store
+	for key, value in [('path', path), ('overlap_days', overlap_days), ('enabled', enabled)]:
+		if value is not None:
+			ctgov_store_config[key] = value
+	with _store_lock:
+		_store = None
+
+def get_ctgov_store():
+	'''
+	Process-wide store, or None if turned off
+	'''
+	global _store
+	if not ctgov_store_config['enabled']:
+		return None
+	with _store_lock:
+		if _store is None:
+			_store = CTGovStore(ctgov_store_config['path'], ctgov_store_config['overlap_days'])
+	return _store
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Inspect the local ClinicalTrials.gov store')
+	parser.add_argument('--path', type=str, default=None, help='store path (default databases/ctgov_store.sqlite)')
+	args = parser.parse_args()
+	configure_ctgov_store(path=args.path)
+	store = get_ctgov_store()
+	print(f'{len(store)} studies, {store.n_terms()} synced search terms')
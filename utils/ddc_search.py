@@ -13,34 +13,37 @@ from bs4 import BeautifulSoup
 import matplotlib.pyplot as plt
 from collections import defaultdict
 from utils.webpage_scraping import test_connection
+from utils.async_fetch import map_async, run_sync
+from utils.circuit_breaker import is_unavailable
 from utils.pickle_dataframes import pickle_dataframe
+from utils.row_accumulator import RowAccumulator
 from utils.drug_search import clean_drug_name
 from utils.fda_sponsors import fda_sponsor_list, rename_sponsors
 
-def scrape_drug_links(save_df=False):
-	'''
-	Scrape drugs.com for all drug links
-	'''
-	base_link = 'https://www.drugs.com'
-	alphabet = list(string.ascii_lowercase) + ['0-9']
+def scrape_letter_links(letter, base_link='https://www.drugs.com'):
+	print('  Scraping drugs starting with letter:', letter)
+	url = f'{base_link}/alpha/{letter}.html'
+	response = test_connection(url)
+	if is_unavailable(response):
+		print(f'    Skipped (drugs.com unavailable): {letter}')
+		return [], []
+	soup = BeautifulSoup(response.text, "html.parser")
+	# get table from tag '<ul class="ddc-list-column-2">'
+	table = soup.find_all("ul", class_="ddc-list-column-2")[0]
+	# get all links
+	links = table.find_all("a")
+	# get hrefs for the links
+	link_hrefs = [link["href"] for link in links]
+	# get all text from the links
+	drug_names = [link.get_text() for link in links]
+	print(f'    Number of drugs starting with {letter}: {len(links)}')
+	drug_url_list = [base_link + link for link in link_hrefs]
+	return drug_names, drug_url_list
+
+def drug_links_to_df(letter_links, save_df=False):
 	drug_urls = defaultdict(dict)
-	print(f'Scraping drug links from {base_link}...')
-	for letter in alphabet:
-		print('  Scraping drugs starting with letter:', letter)
-		url = f'{base_link}/alpha/{letter}.html'
-		response = test_connection(url)
-		soup = BeautifulSoup(response.text, "html.parser")
-		# get table from tag '<ul class="ddc-list-column-2">'
-		table = soup.find_all("ul", class_="ddc-list-column-2")[0]
-		# get all links
-		links = table.find_all("a")
-		# get hrefs for the links
-		link_hrefs = [link["href"] for link in links]
-		# get all text from the links
-		drug_names = [link.get_text() for link in links]
-		print(f'    Number of drugs starting with {letter}: {len(links)}')
-		drug_url_list = [base_link + link for link in link_hrefs]
-		# insert list into dictionary
+	# insert list into dictionary
+	for drug_names, drug_url_list in letter_links:
 		for i, drug_name in enumerate(drug_names):
 			drug_urls[drug_name] = drug_url_list[i]
 	# convert to dataframe
@@ -49,9 +52,31 @@ def scrape_drug_links(save_df=False):
 		pickle_dataframe(df_drugs, 'databases/ddc_drugs.pkl')
 	return df_drugs
 
+def scrape_drug_links(save_df=False, concurrent=False):
+	'''
+	Scrape drugs.com for all drug links
+	'''
+	if concurrent:
+		return run_sync(scrape_drug_links_async(save_df=save_df))
+	base_link = 'https://www.drugs.com'
+	alphabet = list(string.ascii_lowercase) + ['0-9']
+	print(f'Scraping drug links from {base_link}...')
+	letter_links = [scrape_letter_links(letter, base_link) for letter in alphabet]
+	return drug_links_to_df(letter_links, save_df)
+
+async def scrape_drug_links_async(save_df=False):
+	base_link = 'https://www.drugs.com'
+	alphabet = list(string.ascii_lowercase) + ['0-9']
+	print(f'Scraping drug links from {base_link} concurrently...')
+	letter_links = await map_async(scrape_letter_links, alphabet, base_link)
+	return drug_links_to_df(letter_links, save_df)
+
 def scrape_drug_class(base_link, drug_class, drug_class_url):
 	print(f'   Scraping drug class: {drug_class}...')
 	response = test_connection(drug_class_url)
+	if is_unavailable(response):
+		print(f'    Skipped (drugs.com unavailable): {drug_class}')
+		return None
 	soup = BeautifulSoup(response.text, "html.parser")
 	# find all tables
 	tables = soup.find_all("table", class_="data-list")
@@ -89,13 +114,13 @@ def scrape_drug_class(base_link, drug_class, drug_class_url):
 	print(f'    Number of drugs in class: {len(drug_dict)}')
 	return drug_dict
 
-def scrape_drug_classes(save_df=False):
-	df_drug_classes = pd.DataFrame(columns=['drug_name', 'generic_name', 'drug_link', 'drug_class',  'drug_class_description', 'drug_class_url'])
-	base_link = 'https://www.drugs.com'
-	drug_class_suffix = '/drug-classes.html'
+def get_drug_classes(base_link='https://www.drugs.com', drug_class_suffix='/drug-classes.html'):
 	# get all drug classes
 	print(f'Scraping drug links from {base_link+drug_class_suffix}...')
 	response = test_connection(base_link+drug_class_suffix)
+	if is_unavailable(response):
+		print(f'  Skipped (drugs.com unavailable)')
+		return defaultdict(str)
 	soup = BeautifulSoup(response.text, "html.parser")
 	# get table from <div class="ddc-grid"
 	table = soup.find_all("div", class_="ddc-grid")[0]
@@ -106,27 +131,47 @@ def scrape_drug_classes(save_df=False):
 	for link in links:
 		drug_classes_dict[link.get_text()] = base_link + link["href"]
 	print(f'  Number of drug classes: {len(drug_classes_dict)}')
+	return drug_classes_dict
+
+def drug_classes_to_df(drug_classes_dict, drug_dicts, save_df=False):
+	drug_class_rows = RowAccumulator(['drug_name', 'generic_name', 'drug_link', 'drug_class',  'drug_class_description', 'drug_class_url'])
 	# convert to dataframe
-	for d_index, (drug_class, drug_class_url) in enumerate(drug_classes_dict.items()):
-		drug_dict = scrape_drug_class(base_link, drug_class, drug_class_url)
+	for (drug_class, drug_class_url), drug_dict in zip(drug_classes_dict.items(), drug_dicts):
 		if drug_dict is None:
 			continue
 		for drug_name, drug_info in drug_dict.items():
 			# add to dataframe
-			df = pd.DataFrame({
-				"drug_name": [drug_name],
-				"generic_name": [drug_info['generic_name']],
-				"drug_link": [drug_info['drug_link']],
-				"drug_class": [drug_class],
-				"drug_class_description": [None],
-				"drug_class_url": [drug_class_url]
+			drug_class_rows.append({
+				"drug_name": drug_name,
+				"generic_name": drug_info['generic_name'],
+				"drug_link": drug_info['drug_link'],
+				"drug_class": drug_class,
+				"drug_class_description": None,
+				"drug_class_url": drug_class_url
 			})
-			df_drug_classes = pd.concat([df_drug_classes, df], ignore_index=True)
+	df_drug_classes = drug_class_rows.to_frame()
 	print(f' Total number of drugs in drug classes: {len(df_drug_classes)}')
 	if save_df:
 		pickle_dataframe(df_drug_classes, 'databases/ddc_drug_classes.pkl')
 	return df_drug_classes
 
+def scrape_drug_classes(save_df=False, concurrent=False):
+	if concurrent:
+		return run_sync(scrape_drug_classes_async(save_df=save_df))
+	base_link = 'https://www.drugs.com'
+	drug_classes_dict = get_drug_classes(base_link)
+	drug_dicts = [scrape_drug_class(base_link, drug_class, drug_class_url) for drug_class, drug_class_url in drug_classes_dict.items()]
+	return drug_classes_to_df(drug_classes_dict, drug_dicts, save_df)
+
+async def scrape_drug_classes_async(save_df=False):
+	'''
+	Same as scrape_drug_classes, but the drug class pages are crawled concurrently
+	'''
+	base_link = 'https://www.drugs.com'
+	drug_classes_dict = get_drug_classes(base_link)
+	drug_dicts = await map_async(lambda drug_class: scrape_drug_class(base_link, *drug_class), list(drug_classes_dict.items()))
+	return drug_classes_to_df(drug_classes_dict, drug_dicts, save_df)
+
 
 def get_drug_subtitle(soup, info_headers):
 	# get all <b> tags from <p class="drug_subtitle>"
@@ -198,6 +243,9 @@ def scrape_drug_info(drug, info_headers):
 	url  = drug['drug_link']
 	print(f'  Scraping drug info from {url}...')
 	response = test_connection(url)
+	if is_unavailable(response):
+		print(f'    Skipped (drugs.com unavailable): {url}')
+		return drug
 	soup = BeautifulSoup(response.text, 'html.parser')
 	# get drug name
 	try:
@@ -237,11 +285,15 @@ def scrape_drug_info(drug, info_headers):
 		drug[header] = drug_info[header]
 	return drug
 
-def scrape_drugs(df, df_name='ddc_drugs', save_df=False, verbose=True):
+drug_info_headers = ['Generic name', 'Brand names', 'Dosage form', 'Drug class', 'uses', 'side-effects', 'warnings', 'before_taking', 'dosage', 'avoid', 'interactions', 'storage', 'ingredients', 'manufacturer']
+
+def scrape_drugs(df, df_name='ddc_drugs', save_df=False, verbose=True, concurrent=False):
 	'''
 	Scrape drug name, active ingredient, and description for all drug urls
 	'''
-	info_headers = ['Generic name', 'Brand names', 'Dosage form', 'Drug class', 'uses', 'side-effects', 'warnings', 'before_taking', 'dosage', 'avoid', 'interactions', 'storage', 'ingredients', 'manufacturer']
+	if concurrent:
+		return run_sync(scrape_drugs_async(df, df_name=df_name, save_df=save_df))
+	info_headers = drug_info_headers
 	for header in info_headers:
 		df[header] = None
 	for d_index, (drug_row, drug) in enumerate(df.iterrows()):
@@ -252,6 +304,21 @@ def scrape_drugs(df, df_name='ddc_drugs', save_df=False, verbose=True):
 		pickle_dataframe(df, f'databases/{df_name}.pkl')
 	return df
 
+async def scrape_drugs_async(df, df_name='ddc_drugs', save_df=False):
+	'''
+	Same as scrape_drugs, but the drug pages are scraped concurrently
+	'''
+	info_headers = drug_info_headers
+	for header in info_headers:
+		df[header] = None
+	print(f'Scraping {len(df)} drugs concurrently...')
+	drugs = await map_async(scrape_drug_info, [drug for _, drug in df.iterrows()], info_headers)
+	for d_index, drug in enumerate(drugs):
+		df.iloc[d_index] = drug
+	if save_df:
+		pickle_dataframe(df, f'databases/{df_name}.pkl')
+	return df
+
 # see overlap between dataframes
 def combine_fda_ddc(df_1, df_2, field_1='fda_drug_name', field_2='active_ingredient', sponsor_field='fda_2_sponsor', manufacturer_field='ddc_manufacturer'):
 	print(f'Finding overlap between {field_1} in dataframes...')
@@ -6,8 +6,11 @@ import pandas as pd
 import warnings
 import matplotlib.pyplot as plt
 from collections import defaultdict, Counter
-from pytrials.client import ClinicalTrials
 from utils.fda_sponsors import fda_sponsor_list, rename_sponsors
+from utils.row_accumulator import RowAccumulator
+from utils.ctgov_pages import get_ctgov_records, ctgov_schema
+from utils.ctgov_store import get_ctgov_store
+from utils.ctgov_snapshot import get_ctgov_snapshot
 # supress SettingWithCopyWarning in pandas
 pd.options.mode.chained_assignment = None  # default='warn'
 
@@ -320,22 +323,24 @@ def read_pytrials_fields(verbose=False):
 		[print(f'  {field}') for field in ct_fields]
 	return ct_fields
 
-def ctgov_search(search_term):
+def ctgov_search(search_term, incremental=False, local=False):
 	ct_fields = read_pytrials_fields()
-	ct = ClinicalTrials()
 	print(f'Searching CT for {search_term}...')
-	ct_output = ct.get_study_fields(
-		search_expr=search_term,
-			fields=ct_fields,
-			max_studies=1000,
-			fmt="csv",
-		)
+	if local and get_ctgov_snapshot() is not None:
+		# answered from the ingested bulk export (python -m utils.ctgov_snapshot --ingest)
+		ct_output = get_ctgov_snapshot().search(search_term, ct_fields)
+	elif incremental and get_ctgov_store() is not None:
+		# only the studies updated since the last search for this term, merged into the stored ones
+		ct_output = get_ctgov_store().sync(search_term, ct_fields)
+	else:
+		# every page, not only the first 1000 studies
+		ct_output = get_ctgov_records(search_term, ct_fields)
 	if ct_output is None:
 		print(f'  No CT results.')
 	# convert to dataframe
 	columns = ['search_term'] + ct_output[0]
-	data_df = pd.DataFrame(columns=columns)
+	data_rows = RowAccumulator(ctgov_schema(columns))
 	print(f'  Number of CTs found: {len(ct_output)}')
 	for row in ct_output[1:]:
-		data_df = pd.concat([data_df, pd.DataFrame([search_term] + row, index=columns).T], ignore_index=True)
-	return data_df
\ No newline at end of file
+		data_rows.append([search_term] + row)
+	return data_rows.to_frame()
\ No newline at end of file
@@ -1,35 +1,33 @@
+import asyncio
+import urllib.parse
 import pandas as pd
 from collections import defaultdict
 from utils.webpage_scraping import test_connection
+from utils.async_fetch import fetch_async, map_async, run_sync, fan_out
+from utils.circuit_breaker import is_unavailable
 from utils.pickle_dataframes import pickle_dataframe
+from utils.row_accumulator import RowAccumulator
 from utils.api_keys import fda_api_key
+from utils.openfda_flatten import flatten_results, flatten_records, result_dataset
+from utils.openfda_store import get_openfda_store, openfda_datasets, fda_name_key, fda_result_names
 
-def parse_fda_api_dict(api_results, key, fda_api_dict, drug):
-	if type(api_results[0][key]) == list:
-		if type(api_results[0][key][0]) == dict:
-			for app_key in api_results[0][key][0].keys():
-				fda_api_dict[drug][app_key] = api_results[0][key][0][app_key]
-	elif type(api_results[0][key]) == str:
-		fda_api_dict[drug][key] = api_results[0][key]
-
-def get_fda_api_data(drug_key, api_results, fda_api_dict=None):
+def get_fda_api_data(drug_key, api_results, fda_api_dict=None, tables=None, dataset=None):
+	'''
+	Flatten a page of openFDA results (utils.openfda_flatten) and add the first one
+	to fda_api_dict[drug_key]: its fields plus those of its first product/submission.
+	Fields the drug already has (e.g. from an earlier endpoint) are kept.
+	tables: an OpenFDATables that collects every result, product and submission
+	'''
 	if fda_api_dict == None:
 		fda_api_dict = defaultdict(lambda: defaultdict(list))
-	for key in api_results[0].keys():
-		if type(api_results[0][key]) == list:
-			if type(api_results[0][key][0]) == dict:
-				for app_key in api_results[0][key][0].keys():
-					fda_api_dict[drug_key][app_key] = api_results[0][key][0][app_key]
-			else:
-				fda_api_dict[drug_key][key] = api_results[0][key]
-		elif type(api_results[0][key]) == str:
-			fda_api_dict[drug_key][key] = api_results[0][key]
-		elif type(api_results[0][key]) == dict:
-			for app_key in api_results[0][key].keys():
-				fda_api_dict[drug_key][app_key] = api_results[0][key][app_key]
-		else:
-			print(api_results[0][key])
-			break
+	if not api_results:
+		return fda_api_dict
+	dataset = dataset or result_dataset(api_results[0])
+	if tables is not None:
+		tables.add(dataset, flatten_results(api_results, dataset), drug_key)
+	for key, value in flatten_records(api_results[:1], dataset)[0].items():
+		if key not in fda_api_dict[drug_key]:
+			fda_api_dict[drug_key][key] = value
 	return fda_api_dict
 
 # convert fda_api_dict to a dataframe
@@ -37,69 +35,265 @@ def fda_api_dict_to_df(fda_api_dict, save_df=False, save_path='databases/fda_api
 	if len(fda_api_dict) == 0:
 		print('WARNING: fda_api_dict is empty...')
 		return None
-	columns = list(fda_api_dict[list(fda_api_dict.keys())[0]].keys())
-	fda_api_df = pd.DataFrame(columns=columns)
+	# one row per drug, columns in order of first appearance (drugs without API data leave theirs empty)
+	fda_api_rows = RowAccumulator(extend_columns=True)
 	fda_api_drug_count = 0
-	nce_ids = list(fda_api_dict.keys())
-	for n_index, nce_id in enumerate(nce_ids):
-		if fda_api_dict[nce_id]['brand_name'] == None:
-			data = [None for i in range(len(columns)-1)]
-		else:
-			data = [fda_api_dict[n_index][key] for key in columns]
+	for nce_id in fda_api_dict.keys():
+		fda_api_rows.append(dict(fda_api_dict[nce_id]))
+		if fda_api_dict[nce_id].get('brand_name') is not None:
 			fda_api_drug_count += 1
-		if len(data) != len(columns):
-			print(f'Error: {nce_id} - {len(data)} != {len(columns)}')
-		fda_api_df = pd.concat([fda_api_df, pd.DataFrame([data], columns=columns)], ignore_index=True)
+	fda_api_df = fda_api_rows.to_frame()
 	print(f'Number of drugs in fda_api_df: {fda_api_drug_count}')
 	if save_df:
 		pickle_dataframe(fda_api_df, save_path)
 	return fda_api_df
 
-def search_fda_api(search_term):
-	fda_api_dict = defaultdict(lambda: defaultdict(list))
-	open_fda_urls = [
-		f'https://api.fda.gov/drug/drugsfda.json?api_key={fda_api_key}&search={search_term}',
-		f'https://api.fda.gov/drug/label.json?api_key={fda_api_key}&search={search_term}'
+def open_fda_urls(drug):
+	return [
+		f'https://api.fda.gov/drug/drugsfda.json?api_key={fda_api_key}&search={drug}',
+		f'https://api.fda.gov/drug/label.json?api_key={fda_api_key}&search={drug}'
 	]
+
+def fetch_fda_urls(urls):
+	# drugsfda and label at the same time (per-host limits still apply in test_connection)
+	responses = fan_out({u_index: (test_connection, url) for u_index, url in enumerate(urls)})
+	return [responses[u_index] for u_index in range(len(urls))]
+
+def search_fda_api(search_term, local=False, tables=None):
+	if local and get_openfda_store() is not None:
+		return search_fda_store(search_term)
+	fda_api_dict = defaultdict(lambda: defaultdict(list))
+	urls = open_fda_urls(search_term)
+	return add_fda_responses(fda_api_dict, search_term, search_term, urls, fetch_fda_urls(urls), tables)
+
+async def search_fda_api_many(terms, local=False, tables=None):
+	'''
+	search_fda_api for many terms at once (e.g. the indication, target and mechanism
+	terms of company_search): every drugsfda and label request is in flight together,
+	bounded by the openFDA host limits, so the wait is about the slowest call.
+	Returns one fda_api_dict keyed by term, e.g.
+	run_sync(search_fda_api_many(company_search['indication'] + company_search['target']))
+	'''
+	terms = list(dict.fromkeys([terms] if isinstance(terms, str) else terms))
+	fda_api_dict = defaultdict(lambda: defaultdict(list))
+	for term in terms:
+		# terms without results keep an empty entry
+		fda_api_dict[term]
+	if local and get_openfda_store() is not None:
+		for term in terms:
+			fda_api_dict = add_fda_store_records(fda_api_dict, term, term)
+		return fda_api_dict
+	term_urls = [open_fda_urls(term) for term in terms]
+	responses = await asyncio.gather(*[fetch_async(url) for urls in term_urls for url in urls])
+	for t_index, (term, urls) in enumerate(zip(terms, term_urls)):
+		fda_api_dict = add_fda_responses(fda_api_dict, term, term, urls, responses[2*t_index:2*t_index+2], tables)
+	return fda_api_dict
+
+def add_fda_drug_row(fda_api_dict, fda_drug_df, drug_id, id_col='nce_id'):
+	# all all the fields to the fda_api_dict
+	fda_drug_row = fda_drug_df[fda_drug_df[id_col] == drug_id]
+	drug = fda_drug_row['drug_name'].iloc[0]
+	for col in fda_drug_row.columns:
+		fda_api_dict[drug_id][col] = fda_drug_row[col].iloc[0]
+	return drug
+
+def fda_response_json(response):
+	'''
+	Decoded openFDA body, or None when there isn't one (e.g. the empty 504 of an
+	offline cache or cassette miss). 404 is openFDA's JSON answer for no matches.
+	'''
+	if response is None or response.status_code not in (200, 404):
+		return None
+	try:
+		return response.json()
+	except ValueError:
+		return None
+
+def add_fda_responses(fda_api_dict, drug_id, drug, urls, responses, tables=None):
 	fda_drug_page_found = False
-	for url in open_fda_urls:
-		response = test_connection(url)
-		api_response = response.json()
+	for url, response in zip(urls, responses):
+		if is_unavailable(response):
+			print(f'  Skipped (openFDA unavailable): {drug}...')
+			continue
+		api_response = fda_response_json(response)
+		if api_response is None:
+			print(f'  Skipped (no openFDA response {getattr(response, "status_code", None)}): {drug}...')
+			continue
 		if 'results' in api_response.keys():
 			api_results = api_response['results']
-			fda_api_dict = get_fda_api_data(search_term, api_results, fda_api_dict)
+			fda_api_dict = get_fda_api_data(drug_id, api_results, fda_api_dict, tables)
 			print(f'  Data found: {url}')
 			fda_drug_page_found = True
 		else:
-			print(f'  No results: {search_term}...')
+			print(f'  No results: {drug}...')
 	if fda_drug_page_found == False:
-		print(f'  Missing: {search_term}...')
+		print(f'  Missing: {drug}...')
 	return fda_api_dict
 
-def scrape_fda_data(fda_drug_df, id_col='nce_id'):
+def scrape_fda_data(fda_drug_df, id_col='nce_id', concurrent=False, batch=False, local=False, tables=None):
+	'''
+	tables: an OpenFDATables (utils.openfda_flatten) to also keep every result with its products and submissions
+	batch: look drugs up batch_size at a time with OR-ed openfda name searches (see scrape_fda_data_batched)
+	local: answer from the ingested bulk downloads (utils.openfda_store) without any request
+	'''
+	if local and get_openfda_store() is not None:
+		return scrape_fda_store(fda_drug_df, id_col=id_col)
+	if batch:
+		return scrape_fda_data_batched(fda_drug_df, id_col=id_col, tables=tables)
+	if concurrent:
+		return run_sync(scrape_fda_data_async(fda_drug_df, id_col=id_col, tables=tables))
 	fda_api_dict = defaultdict(lambda: defaultdict(list))
 	for d_index, drug_id in enumerate(fda_drug_df[id_col].values):
-		# all all the fields to the fda_api_dict
-		fda_drug_row = fda_drug_df[fda_drug_df[id_col] == drug_id]
-		drug = fda_drug_row['drug_name'].iloc[0]
-		for col in fda_drug_row.columns:
-			fda_api_dict[drug_id][col] = fda_drug_row[col].iloc[0]
+		drug = add_fda_drug_row(fda_api_dict, fda_drug_df, drug_id, id_col)
 		print(f'Getting FDA API data for {drug}...({d_index+1}/{len(fda_drug_df)})')
-		open_fda_urls = [
-			f'https://api.fda.gov/drug/drugsfda.json?api_key={fda_api_key}&search={drug}',
-			f'https://api.fda.gov/drug/label.json?api_key={fda_api_key}&search={drug}'
-		]
+		urls = open_fda_urls(drug)
+		responses = fetch_fda_urls(urls)
+		fda_api_dict = add_fda_responses(fda_api_dict, drug_id, drug, urls, responses, tables)
+	return fda_api_dict
+
+async def scrape_fda_data_async(fda_drug_df, id_col='nce_id', tables=None):
+	'''
+	Same as scrape_fda_data, but all openFDA requests are issued concurrently (bounded per host)
+	'''
+	fda_api_dict = defaultdict(lambda: defaultdict(list))
+	drug_ids = list(fda_drug_df[id_col].values)
+	drugs = [add_fda_drug_row(fda_api_dict, fda_drug_df, drug_id, id_col) for drug_id in drug_ids]
+	print(f'Getting FDA API data for {len(drugs)} drugs concurrently...')
+	drug_urls = [open_fda_urls(drug) for drug in drugs]
+	responses = await asyncio.gather(*[fetch_async(url) for urls in drug_urls for url in urls])
+	for d_index, (drug_id, drug, urls) in enumerate(zip(drug_ids, drugs, drug_urls)):
+		print(f'FDA API data for {drug}...({d_index+1}/{len(drugs)})')
+		fda_api_dict = add_fda_responses(fda_api_dict, drug_id, drug, urls, responses[2*d_index:2*d_index+2], tables)
+	return fda_api_dict
+
+# OR-batched openFDA searches: many drugs per request, paged with skip
+fda_batch_config = {
+	'batch_size': 25,
+	# results per page (the openFDA maximum)
+	'limit': 1000,
+	# openFDA refuses skip beyond 25000
+	'max_skip': 25000,
+}
+fda_endpoints = ['drug/drugsfda.json', 'drug/label.json']
+
+def fda_endpoint_dataset(endpoint):
+	# 'drug/drugsfda.json' -> 'drugsfda'
+	return endpoint.split('/')[-1].split('.')[0]
+
+def fda_batch_search(drugs):
+	# (openfda.brand_name:("a"+OR+"b")+OR+openfda.generic_name:("a"+OR+"b"))
+	names = '+OR+'.join(['"' + urllib.parse.quote(str(drug).replace('"', ''), safe='') + '"' for drug in drugs])
+	return f'(openfda.brand_name:({names})+OR+openfda.generic_name:({names}))'
+
+def fetch_fda_batch(endpoint, drugs):
+	'''
+	First result of endpoint for each drug name (by fda_name_key), paging with skip
+	until every drug has one, the results run out, or a page matches no new drug
+	(names without any result would otherwise page through the whole OR query).
+	Returns ({name key: result}, n_requests)
+	'''
+	pending = set([fda_name_key(drug) for drug in drugs])
+	found = {}
+	limit = fda_batch_config['limit']
+	skip = 0
+	n_requests = 0
+	while pending and skip <= fda_batch_config['max_skip']:
+		url = f'https://api.fda.gov/{endpoint}?api_key={fda_api_key}&search={fda_batch_search(drugs)}&limit={limit}&skip={skip}'
+		response = test_connection(url)
+		n_requests += 1
+		if is_unavailable(response):
+			print(f'  Skipped (openFDA unavailable): {endpoint} batch of {len(drugs)}...')
+			break
+		api_response = fda_response_json(response)
+		if api_response is None:
+			print(f'  Skipped (no openFDA response {getattr(response, "status_code", None)}): {endpoint} batch of {len(drugs)}...')
+			break
+		results = api_response.get('results', [])
+		n_pending = len(pending)
+		for result in results:
+			for name in fda_result_names(result) & pending:
+				found[name] = result
+				pending.remove(name)
+		total = api_response.get('meta', {}).get('results', {}).get('total', 0)
+		skip += limit
+		if len(results) < limit or skip >= total or len(pending) == n_pending:
+			break
+	return found, n_requests
+
+def scrape_fda_data_batched(fda_drug_df, id_col='nce_id', tables=None):
+	'''
+	Same fda_api_dict as scrape_fda_data, with drugs resolved batch_size at a time:
+	one openfda brand/generic name search per batch and endpoint (plus skip pages),
+	and each result assigned back to its drug id by name
+	'''
+	fda_api_dict = defaultdict(lambda: defaultdict(list))
+	drug_ids = list(fda_drug_df[id_col].values)
+	drugs = [add_fda_drug_row(fda_api_dict, fda_drug_df, drug_id, id_col) for drug_id in drug_ids]
+	names = list(dict.fromkeys([drug for drug in drugs if fda_name_key(drug)]))
+	batch_size = fda_batch_config['batch_size']
+	searches = [(endpoint, names[b_index:b_index + batch_size]) for endpoint in fda_endpoints for b_index in range(0, len(names), batch_size)]
+	print(f'Getting FDA API data for {len(drugs)} drugs in {len(searches)} batched searches...')
+	batch_outputs = run_sync(map_async(lambda search: fetch_fda_batch(*search), searches))
+	endpoint_results = defaultdict(dict)
+	n_requests = 0
+	for (endpoint, _), (found, batch_requests) in zip(searches, batch_outputs):
+		endpoint_results[endpoint].update(found)
+		n_requests += batch_requests
+	for d_index, (drug_id, drug) in enumerate(zip(drug_ids, drugs)):
 		fda_drug_page_found = False
-		for url in open_fda_urls:
-			response = test_connection(url)
-			api_response = response.json()
-			if 'results' in api_response.keys():
-				api_results = api_response['results']
-				fda_api_dict = get_fda_api_data(drug_id, api_results, fda_api_dict)
-				print(f'  Data found: {url}')
+		for endpoint in fda_endpoints:
+			result = endpoint_results[endpoint].get(fda_name_key(drug))
+			if result is not None:
+				fda_api_dict = get_fda_api_data(drug_id, [result], fda_api_dict, tables, fda_endpoint_dataset(endpoint))
 				fda_drug_page_found = True
-			else:
-				print(f'  No results: {drug}...')
 		if fda_drug_page_found == False:
 			print(f'  Missing: {drug}...')
-	return fda_api_dict
\ No newline at end of file
+	n_found = len(set(endpoint_results['drug/drugsfda.json']) | set(endpoint_results['drug/label.json']))
+	print(f'  {n_found}/{len(names)} drugs found with {n_requests} openFDA requests')
+	return fda_api_dict
+
+# answers from the local openFDA store (python -m utils.openfda_store --ingest ...)
+def add_fda_store_records(fda_api_dict, drug_id, drug):
+	'''
+	First stored drugsfda and label result for a drug name (what results[0] of the
+	API searches would give), already flattened by utils.openfda_flatten
+	'''
+	store = get_openfda_store()
+	fda_drug_page_found = False
+	for dataset in openfda_datasets:
+		record = store.first(dataset, drug)
+		if record is not None:
+			for key, value in record.items():
+				if key not in fda_api_dict[drug_id]:
+					fda_api_dict[drug_id][key] = value
+			fda_drug_page_found = True
+	if fda_drug_page_found == False:
+		print(f'  Missing: {drug}...')
+	return fda_api_dict
+
+def search_fda_store(search_term):
+	fda_api_dict = defaultdict(lambda: defaultdict(list))
+	return add_fda_store_records(fda_api_dict, search_term, search_term)
+
+def scrape_fda_store(fda_drug_df, id_col='nce_id'):
+	fda_api_dict = defaultdict(lambda: defaultdict(list))
+	for drug_id in fda_drug_df[id_col].values:
+		drug = add_fda_drug_row(fda_api_dict, fda_drug_df, drug_id, id_col)
+		fda_api_dict = add_fda_store_records(fda_api_dict, drug_id, drug)
+	print(f'FDA data for {len(fda_api_dict)} drugs from the local openFDA store')
+	return fda_api_dict
+
+def fda_store_df(dataset='drugsfda', columns=None, save_df=False, save_path='databases/fda_store_df.pkl'):
+	'''
+	Every stored result of a dataset (e.g. all approved drugs, not only the NCEs)
+	as one DataFrame, read a partition at a time (columns: only these fields)
+	'''
+	store = get_openfda_store()
+	if store is None:
+		print('WARNING: no local openFDA store (python -m utils.openfda_store --ingest ...)')
+		return None
+	fda_df = pd.concat(list(store.iter_frames(dataset, columns)), ignore_index=True)
+	print(f'Number of {dataset} results: {len(fda_df)}')
+	if save_df:
+		pickle_dataframe(fda_df, save_path)
+	return fda_df
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import urllib.parse
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# time-to-live (seconds) before a cached response is revalidated, per host
+day = 24*60*60
+host_ttl = {
+	'pubchem.ncbi.nlm.nih.gov': 30*day,
+	'pubmed.ncbi.nlm.nih.gov': 30*day,
+	'eutils.ncbi.nlm.nih.gov': 1*day,
+	'api.fda.gov': 7*day,
+	'www.drugs.com': 7*day,
+	'clinicaltrials.gov': 1*day,
+	'api.semanticscholar.org': 7*day,
+}
+
+cache_config = {
+	'cache_dir': os.path.join('databases', 'http_cache'),
+	'max_size': 2e9, # bytes
+	'default_ttl': 1*day,
+	# 'default' : serve fresh entries, revalidate stale ones, fetch misses
+	# 'offline' : cache-only, never touch the network
+	# 'off'     : bypass the cache entirely
+	'mode': 'default',
+}
+
+# status codes worth keeping (PubChem answers unknown names with a 404)
+cacheable_status_codes = [200, 404]
+# headers kept with the body
+stored_headers = ['content-type', 'etag', 'last-modified', 'retry-after']
+
+def normalize_url(url):
+	'''
+	URL without the api_key parameter, so keys never end up in cache/cassette keys
+	'''
+	url_split = urllib.parse.urlsplit(url)
+	query = '&'.join([param for param in url_split.query.split('&') if not param.startswith('api_key=')])
+	return urllib.parse.urlunsplit(url_split._replace(query=query))
+
+def cache_key(url, method='GET', data=None):
+	'''
+	Request key: method + URL without the api_key parameter (+ body for POSTs)
+	'''
+	key = f'{method.upper()} {normalize_url(url)}'
+	if data:
+		if isinstance(data, dict):
+			data = urllib.parse.urlencode(sorted(data.items()))
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		key += ' ' + hashlib.sha256(data).hexdigest()
+	return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+	'''
+	Content-addressed on-disk cache of HTTP responses.
+	Bodies are stored once per sha256 under <cache_dir>/objects, and a sqlite
+	index maps request keys to bodies, validators and access times (for LRU eviction).
+	'''
+	def __init__(self, cache_dir, max_size=2e9, default_ttl=day, mode='default'):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		self.default_ttl = default_ttl
+		self.mode = mode
+		self.lock = threading.Lock()
+		os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+		self.db = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), check_same_thread=False)
+		self.db.execute('''
+			CREATE TABLE IF NOT EXISTS responses (
+				key TEXT PRIMARY KEY,
+				url TEXT,
+				host TEXT,
+				status_code INTEGER,
+				headers TEXT,
+				encoding TEXT,
+				body_hash TEXT,
+				size INTEGER,
+				fetched_at REAL,
+				last_access REAL
+			)''')
+		self.db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+		self.db.commit()
+		self.total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+	def object_path(self, body_hash):
+		return os.path.join(self.cache_dir, 'objects', body_hash[:2], body_hash)
+
+	def ttl(self, host):
+		return host_ttl.get(host, self.default_ttl)
+
+	def lookup(self, url, method='GET', data=None):
+		key = cache_key(url, method, data)
+		with self.lock:
+			row = self.db.execute(
+				'SELECT key, url, host, status_code, headers, encoding, body_hash, size, fetched_at FROM responses WHERE key = ?',
+				(key,)).fetchone()
+			if row is None:
+				return None
+			entry = dict(zip(['key', 'url', 'host', 'status_code', 'headers', 'encoding', 'body_hash', 'size', 'fetched_at'], row))
+			try:
+				with open(self.object_path(entry['body_hash']), 'rb') as f:
+					entry['content'] = f.read()
+			except FileNotFoundError:
+				self._delete(key)
+				self.db.commit()
+				return None
+			self.db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+			self.db.commit()
+		entry['headers'] = json.loads(entry['headers'])
+		return entry
+
+	def is_fresh(self, entry):
+		return time.time() - entry['fetched_at'] < self.ttl(entry['host'])
+
+	def revalidation_headers(self, entry):
+		'''
+		Conditional request headers (If-None-Match / If-Modified-Since) for a stale entry
+		'''
+		headers = {}
+		if entry is None:
+			return headers
+		if 'etag' in entry['headers']:
+			headers['If-None-Match'] = entry['headers']['etag']
+		if 'last-modified' in entry['headers']:
+			headers['If-Modified-Since'] = entry['headers']['last-modified']
+		return headers
+
+	def refresh(self, entry):
+		'''
+		Mark a revalidated (304) entry as freshly fetched
+		'''
+		with self.lock:
+			self.db.execute('UPDATE responses SET fetched_at = ? WHERE key = ?', (time.time(), entry['key']))
+			self.db.commit()
+		entry['fetched_at'] = time.time()
+
+	def store(self, url, response, method='GET', data=None):
+		if response.status_code not in cacheable_status_codes:
+			return
+		content = response.content
+		body_hash = hashlib.sha256(content).hexdigest()
+		path = self.object_path(body_hash)
+		if not os.path.exists(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			tmp_path = f'{path}.{threading.get_ident()}.tmp'
+			with open(tmp_path, 'wb') as f:
+				f.write(content)
+			os.replace(tmp_path, path)
+		headers = {h: response.headers[h] for h in stored_headers if h in response.headers}
+		key = cache_key(url, method, data)
+		now = time.time()
+		with self.lock:
+			old_hash = self._delete(key, remove_object=False)
+			self.db.execute(
+				'INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+				(key, normalize_url(url), urllib.parse.urlsplit(url).netloc.lower(), response.status_code, json.dumps(headers),
+				 response.encoding, body_hash, len(content), now, now))
+			self.total_size += len(content)
+			if old_hash is not None and old_hash != body_hash:
+				self._remove_unused_object(old_hash)
+			if self.total_size > self.max_size:
+				self._evict()
+			self.db.commit()
+
+	def _delete(self, key, remove_object=True):
+		row = self.db.execute('SELECT body_hash, size FROM responses WHERE key = ?', (key,)).fetchone()
+		if row is None:
+			return None
+		body_hash, size = row
+		self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+		self.total_size -= size
+		if remove_object:
+			self._remove_unused_object(body_hash)
+		return body_hash
+
+	def _remove_unused_object(self, body_hash):
+		# only remove the body once no other request points at it
+		in_use = self.db.execute('SELECT 1 FROM responses WHERE body_hash = ? LIMIT 1', (body_hash,)).fetchone()
+		if in_use is None and os.path.exists(self.object_path(body_hash)):
+			os.remove(self.object_path(body_hash))
+
+	def _evict(self):
+		# drop least recently used entries until 90% of the size cap
+		target_size = 0.9*self.max_size
+		rows = self.db.execute('SELECT key FROM responses ORDER BY last_access ASC').fetchall()
+		for (key,) in rows:
+			if self.total_size <= target_size:
+				break
+			self._delete(key)
+
+	def clear(self):
+		with self.lock:
+			for (key,) in self.db.execute('SELECT key FROM responses').fetchall():
+				self._delete(key)
+			self.db.commit()
+
+	def to_response(self, entry):
+		response = requests.models.Response()
+		response.status_code = entry['status_code']
+		response._content = entry['content']
+		response.headers = CaseInsensitiveDict(entry['headers'])
+		response.encoding = entry['encoding']
+		response.url = entry['url']
+		response.from_cache = True
+		return response
+
+	def miss_response(self, url):
+		'''
+		Response for a miss in offline mode (504, as for Cache-Control: only-if-cached)
+		'''
+		response = requests.models.Response()
+		response.status_code = 504
+		response._content = b''
+		response.url = url
+		response.reason = 'Not in offline cache'
+		response.from_cache = True
+		return response
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def configure_cache(cache_dir=None, max_size=None, default_ttl=None, mode=None, ttl=None):
+	'''
+	Update cache settings; ttl is a {host: seconds} dict merged into host_ttl
+	'''
+	global _cache
+	for key, value in [('cache_dir', cache_dir), ('max_size', max_size), ('default_ttl', default_ttl), ('mode', mode)]:
+		if value is not None:
+			cache_config[key] = value
+	if ttl is not None:
+		host_ttl.update(ttl)
+	with _cache_lock:
+		_cache = None
+
+def set_cache_mode(mode):
+	'''
+	mode: 'default', 'offline' (cache-only) or 'off'
+	'''
+	if mode not in ['default', 'offline', 'off']:
+		raise ValueError(f'Unknown cache mode: {mode}')
+	configure_cache(mode=mode)
+
+def get_cache():
+	'''
+	Process-wide cache, or None if caching is turned off
+	'''
+	global _cache
+	if cache_config['mode'] == 'off':
+		return None
+	with _cache_lock:
+		if _cache is None:
+			_cache = ResponseCache(
+				cache_config['cache_dir'],
+				max_size=cache_config['max_size'],
+				default_ttl=cache_config['default_ttl'],
+				mode=cache_config['mode'],
+			)
+	return _cache
@@ -0,0 +1,254 @@
+import threading
+import pandas as pd
+
+# openfda annotations shared by drugsfda and label results (each a list of strings)
+openfda_fields = [
+	'application_number', 'brand_name', 'generic_name', 'manufacturer_name', 'product_ndc',
+	'product_type', 'route', 'substance_name', 'rxcui', 'spl_id', 'spl_set_id', 'package_ndc',
+	'nui', 'pharm_class_epc', 'pharm_class_cs', 'pharm_class_pe', 'pharm_class_moa', 'unii',
+	'is_original_packager', 'upc',
+]
+
+# result structure per dataset (from the openFDA field yaml files):
+# 'string' a value, ['string'] a list kept as is, {...} a nested object flattened
+# into its parent row, [{...}] a child table with one row per item.
+# '*' is the kind of any other top-level field (label sections are all lists of strings).
+openfda_schemas = {
+	'drugsfda': {
+		'application_number': 'string',
+		'sponsor_name': 'string',
+		'openfda': {field: ['string'] for field in openfda_fields},
+		'products': [{
+			'product_number': 'string',
+			'reference_drug': 'string',
+			'brand_name': 'string',
+			'active_ingredients': [{'name': 'string', 'strength': 'string'}],
+			'reference_standard': 'string',
+			'dosage_form': 'string',
+			'route': 'string',
+			'marketing_status': 'string',
+			'te_code': 'string',
+		}],
+		'submissions': [{
+			'submission_type': 'string',
+			'submission_number': 'string',
+			'submission_status': 'string',
+			'submission_status_date': 'string',
+			'review_priority': 'string',
+			'submission_class_code': 'string',
+			'submission_class_code_description': 'string',
+			'submission_public_notes': 'string',
+			'application_docs': [{'id': 'string', 'url': 'string', 'date': 'string', 'type': 'string'}],
+		}],
+	},
+	'label': {
+		'id': 'string',
+		'set_id': 'string',
+		'version': 'string',
+		'effective_time': 'string',
+		'openfda': {field: ['string'] for field in openfda_fields},
+		'*': ['string'],
+	},
+}
+
+def result_dataset(result):
+	# Drugs@FDA results carry an application number and products, labels don't
+	return 'drugsfda' if 'products' in result or 'submissions' in result else 'label'
+
+class FlattenPlan:
+	'''
+	Columns of one dataset compiled from its schema: for the result table a
+	(column, path) per value, and for each child table (products, submissions)
+	the same over its items. Table column names are the field names, prefixed
+	with their parent when an earlier field already took the name (so
+	openfda.application_number is openfda_application_number, never an
+	overwrite of application_number).
+
+	record_map keeps the bare field names of the old get_fda_api_data rows
+	instead: a later field overwrites an earlier one of the same name (for
+	drugsfda, brand_name and route are the first product's strings and
+	application_number the openfda list).
+
+	columns, children, known and record_map are replaced (never mutated) when a
+	field is compiled, so readers take a consistent snapshot without the lock.
+	'''
+	def __init__(self, schema):
+		self.default = schema.get('*')
+		self.taken = set()
+		self.columns = ()
+		self.children = {}
+		self.known = frozenset()
+		# {field: name | {sub field: ...} | ('child', {item field: ...})} for flatten_records
+		self.record_map = {}
+		self.lock = threading.Lock()
+		for key, kind in schema.items():
+			if key != '*':
+				self.add_field(key, kind)
+
+	def column_name(self, path):
+		column = path[-1] if path[-1] not in self.taken else '_'.join(path)
+		self.taken.add(column)
+		return column
+
+	def compile_columns(self, kind, path):
+		if isinstance(kind, dict):
+			columns = []
+			for key, sub_kind in kind.items():
+				columns += self.compile_columns(sub_kind, path + (key,))
+			return columns
+		return [(self.column_name(path), path)]
+
+	def add_field(self, key, kind):
+		if isinstance(kind, list) and kind and isinstance(kind[0], dict):
+			child_columns = []
+			for child_key, child_kind in kind[0].items():
+				child_columns += self.compile_columns(child_kind, (key, child_key))
+			# paths within an item
+			children = dict(self.children)
+			children[key] = tuple([(column, path[1:]) for column, path in child_columns])
+			self.children = children
+			record_map = dict(self.record_map)
+			record_map[key] = ('child', path_map([(path[-1], path[1:]) for column, path in child_columns]))
+		else:
+			columns = self.compile_columns(kind, (key,))
+			self.columns = self.columns + tuple(columns)
+			record_map = dict(self.record_map)
+			record_map.update(path_map([(path[-1], path) for column, path in columns]))
+		self.record_map = record_map
+		self.known = self.known | {key}
+
+	def snapshot(self):
+		return self.columns, self.children
+
+	def add_unknown(self, key, value):
+		# a field missing from the schema: compiled once, on first sight
+		with self.lock:
+			if key in self.known:
+				return
+			if self.default is not None:
+				kind = self.default
+			elif isinstance(value, dict):
+				kind = {sub_key: 'string' for sub_key in value}
+			elif isinstance(value, list) and value and isinstance(value[0], dict):
+				kind = [{sub_key: 'string' for sub_key in value[0]}]
+			else:
+				kind = 'string'
+			self.add_field(key, kind)
+
+def path_map(columns):
+	# [(column, path)] -> nested {key: column or {key: ...}}
+	mapping = {}
+	for column, path in columns:
+		level = mapping
+		for key in path[:-1]:
+			level = level.setdefault(key, {})
+		level[path[-1]] = column
+	return mapping
+
+def map_record(item, mapping, record):
+	# walks the fields the item has in its own order (like the old nested loops), so later ones win
+	for key, value in item.items():
+		target = mapping.get(key)
+		if target is None or value is None:
+			continue
+		if type(target) is str:
+			record[target] = value
+		elif type(target) is dict:
+			if isinstance(value, dict):
+				map_record(value, target, record)
+		elif value and isinstance(value, list) and isinstance(value[0], dict):
+			map_record(value[0], target[1], record)
+	return record
+
+def parent_objects(parents, path):
+	# the objects at path for every item (memoized in parents, {} where missing)
+	if path not in parents:
+		values = parent_objects(parents, path[:-1])
+		parents[path] = [child if isinstance(child, dict) else {} for child in (value.get(path[-1]) for value in values)]
+	return parents[path]
+
+def column_values(items, columns):
+	# {column: values} for compiled (column, path) columns, one list comprehension per column
+	parents = {(): items}
+	return {column: [value.get(path[-1]) for value in parent_objects(parents, path[:-1])] for column, path in columns}
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+def flatten_plan(dataset):
+	with _plans_lock:
+		if dataset not in _plans:
+			_plans[dataset] = FlattenPlan(openfda_schemas[dataset])
+		return _plans[dataset]
+
+def flatten_results(results, dataset=None):
+	'''
+	A page of openFDA results -> {table: {column: values}}, with every result in
+	'results' and every product/submission in a child table keyed by result_index
+	(the result's position in the page)
+	'''
+	if not results:
+		return {'results': {}}
+	plan = flatten_plan(dataset or result_dataset(results[0]))
+	unknown = set().union(*[result.keys() for result in results]) - plan.known
+	for key in unknown:
+		plan.add_unknown(key, next(result[key] for result in results if key in result))
+	columns, children = plan.snapshot()
+	tables = {'results': column_values(results, columns)}
+	for child, columns in children.items():
+		result_indices = []
+		items = []
+		for r_index, result in enumerate(results):
+			for item in result.get(child) or []:
+				result_indices.append(r_index)
+				items.append(item if isinstance(item, dict) else {})
+		tables[child] = {'result_index': result_indices}
+		tables[child].update(column_values(items, columns))
+	return tables
+
+def flatten_records(results, dataset=None):
+	'''
+	One flat record per result with its first product and submission, under the
+	bare field names of the old get_fda_api_data rows (see FlattenPlan), None
+	values left out
+	'''
+	if not results:
+		return []
+	plan = flatten_plan(dataset or result_dataset(results[0]))
+	unknown = set().union(*[result.keys() for result in results]) - plan.known
+	for key in unknown:
+		plan.add_unknown(key, next(result[key] for result in results if key in result))
+	record_map = plan.record_map
+	return [map_record(result, record_map, {}) for result in results]
+
+class OpenFDATables:
+	'''
+	Flattened results collected across searches: per dataset a results table and
+	its child tables, every row tagged with the drug it was searched for
+	'''
+	def __init__(self, key_column='nce_id'):
+		self.key_column = key_column
+		self.pages = {}
+		self.n_results = {}
+
+	def add(self, dataset, tables, drug_key):
+		offset = self.n_results.get(dataset, 0)
+		n_results = len(next(iter(tables['results'].values()))) if tables['results'] else 0
+		for table, columns in tables.items():
+			name = dataset if table == 'results' else f'{dataset}_{table}'
+			page = dict(columns)
+			n_rows = len(next(iter(columns.values()))) if columns else 0
+			page[self.key_column] = [drug_key]*n_rows
+			if table == 'results':
+				page['result_index'] = list(range(offset, offset + n_rows))
+			else:
+				page['result_index'] = [offset + r_index for r_index in columns['result_index']]
+			self.pages.setdefault(name, []).append(page)
+		self.n_results[dataset] = offset + n_results
+
+	def to_frames(self):
+		# {table: DataFrame}, e.g. drugsfda, drugsfda_products, drugsfda_submissions, label
+		frames = {}
+		for name, pages in self.pages.items():
+			frames[name] = pd.concat([pd.DataFrame(page) for page in pages], ignore_index=True)
+		return frames
@@ -0,0 +1,326 @@
+import io
+import os
+import re
+import json
+import shutil
+import time
+import zipfile
+import argparse
+import threading
+from collections import defaultdict, OrderedDict
+from utils.partitions import PartitionWriter, read_partition, read_row_group
+from utils.row_accumulator import RowAccumulator
+from utils.openfda_flatten import flatten_records
+
+openfda_store_config = {
+	'path': os.path.join('databases', 'openfda'),
+	# flattened results per partition while ingesting
+	'partition_rows': 5000,
+	# rows per Parquet row group: a lookup reads only the row group of its result
+	'row_group_rows': 100,
+	# row groups (or pickle partitions) kept in memory, least recently used dropped first
+	'cache_size': 64,
+	# characters read from a zipped JSON file at a time
+	'chunk_size': 1 << 20,
+}
+openfda_datasets = ['drugsfda', 'label']
+
+def fda_name_key(name):
+	return re.sub(r'\s+', ' ', str(name)).strip().lower()
+
+def fda_result_names(result):
+	# every name a result can be matched to a drug by
+	openfda = result.get('openfda', {})
+	names = openfda.get('brand_name', []) + openfda.get('generic_name', [])
+	names += [product.get('brand_name') for product in result.get('products', []) if product.get('brand_name')]
+	return set([fda_name_key(name) for name in names])
+
+def fda_result_applications(result):
+	applications = [result['application_number']] if result.get('application_number') else []
+	return set(applications + result.get('openfda', {}).get('application_number', []))
+
+def iter_json_array(f, key='results', chunk_size=None):
+	'''
+	Yield the items of the top-level key array of a JSON document one at a time
+	(json.JSONDecoder.raw_decode over a sliding text buffer, so a bulk file
+	is never loaded whole)
+	'''
+	chunk_size = chunk_size or openfda_store_config['chunk_size']
+	decoder = json.JSONDecoder()
+	start_pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+	buffer = ''
+	# find the start of the array ("results" also names a dict in meta)
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			return
+		buffer += chunk
+		match = start_pattern.search(buffer)
+		if match:
+			buffer = buffer[match.end():]
+			break
+		buffer = buffer[-(len(key) + 16):]
+	pos = 0
+	eof = False
+	while True:
+		# skip separators
+		while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+			pos += 1
+		if pos >= len(buffer):
+			if eof:
+				return
+			chunk = f.read(chunk_size)
+			buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+			continue
+		if buffer[pos] == ']':
+			return
+		try:
+			item, end = decoder.raw_decode(buffer, pos)
+		except json.JSONDecodeError:
+			# the item runs past the buffer
+			if eof:
+				raise
+			chunk = f.read(chunk_size)
+			buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+			continue
+		yield item
+		pos = end
+
+def zip_dataset(zip_path):
+	# drug-label-0001-of-0013.json.zip -> 'label' (None if the name doesn't say)
+	match = re.match(r'drug-(\w+?)-\d+-of-\d+', os.path.basename(zip_path))
+	return match.group(1) if match and match.group(1) in openfda_datasets else None
+
+def iter_zip_results(zip_path, chunk_size=None):
+	'''
+	Results of every JSON file in an openFDA bulk download zip
+	'''
+	with zipfile.ZipFile(zip_path) as archive:
+		for member in archive.infolist():
+			if member.is_dir() or not member.filename.endswith('.json'):
+				continue
+			with archive.open(member) as f:
+				yield from iter_json_array(io.TextIOWrapper(f, encoding='utf-8'), 'results', chunk_size)
+
+def encode_nested_columns(df):
+	'''
+	Columns holding lists/dicts -> JSON strings (so any partition can be Parquet).
+	Returns the encoded column names.
+	'''
+	json_columns = []
+	for column in df.columns:
+		if any(isinstance(value, (list, dict)) for value in df[column].values):
+			df[column] = [json.dumps(value) if value is not None else None for value in df[column].values]
+			json_columns.append(column)
+	return json_columns
+
+def decode_nested_columns(df, json_columns):
+	for column in json_columns:
+		if column in df.columns:
+			df[column] = [json.loads(value) if isinstance(value, str) else value for value in df[column].values]
+	return df
+
+class OpenFDAStore:
+	'''
+	openFDA bulk downloads (Drugs@FDA and drug labels), flattened by
+	utils.openfda_flatten (a result with its first product/submission), as numbered partitions per dataset plus an index from
+	application number and brand/generic name to (partition, row)
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.block_cache = OrderedDict()
+		self.manifest = {}
+		self.index = {}
+		self.load()
+
+	def manifest_path(self):
+		return os.path.join(self.path, 'manifest.json')
+
+	def load(self):
+		if not os.path.exists(self.manifest_path()):
+			return
+		with open(self.manifest_path()) as f:
+			self.manifest = json.load(f)
+		for dataset in self.manifest:
+			with open(os.path.join(self.path, dataset, 'index.json')) as f:
+				self.index[dataset] = json.load(f)
+
+	def ingest(self, dataset, zip_paths, partition_rows=None):
+		'''
+		Stream one dataset's bulk zip files into partitions (replacing what was
+		stored for it); memory is bounded by partition_rows flattened results.
+		The new partitions are written next to the old ones and swapped in once
+		complete, so a failed ingest leaves the stored dataset as it was.
+		'''
+		partition_rows = partition_rows or openfda_store_config['partition_rows']
+		row_group_rows = openfda_store_config['row_group_rows']
+		out_dir = os.path.join(self.path, dataset)
+		tmp_dir = out_dir + '.tmp'
+		# leftovers of an interrupted ingest
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+		writer = PartitionWriter(tmp_dir)
+		partitions = {}
+		index = defaultdict(list)
+		start_time = time.time()
+		def write_partition(results):
+			# the page is flattened in one pass with the dataset's compiled plan
+			rows = RowAccumulator(extend_columns=True)
+			rows.extend(flatten_records(results, dataset))
+			row_keys = [
+				[f'application:{application}' for application in fda_result_applications(result)] +
+				[f'name:{name}' for name in fda_result_names(result)]
+				for result in results]
+			df = rows.to_frame()
+			json_columns = encode_nested_columns(df)
+			partition = os.path.basename(writer.write(df, row_group_rows))
+			partitions[partition] = {'n_rows': len(df), 'row_group_rows': row_group_rows, 'columns': list(df.columns), 'json_columns': json_columns}
+			for r_index, keys in enumerate(row_keys):
+				for key in keys:
+					index[key].append([partition, r_index])
+		results = []
+		for zip_path in zip_paths:
+			for result in iter_zip_results(zip_path):
+				results.append(result)
+				if len(results) >= partition_rows:
+					write_partition(results)
+					results = []
+					print(f'  {dataset}: {writer.n_rows} results ingested...', end='\r')
+		if results:
+			write_partition(results)
+		with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+			json.dump(index, f)
+		with self.lock:
+			self.manifest[dataset] = {
+				'partitions': partitions,
+				'n_rows': writer.n_rows,
+				'sources': [os.path.basename(zip_path) for zip_path in zip_paths],
+				'ingested_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+			}
+			self.index[dataset] = dict(index)
+			self.block_cache = OrderedDict()
+			with open(self.manifest_path() + '.tmp', 'w') as f:
+				json.dump(self.manifest, f, indent=1)
+			os.replace(self.manifest_path() + '.tmp', self.manifest_path())
+			# swap the new partitions in, then drop the old ones
+			if os.path.exists(out_dir):
+				shutil.rmtree(out_dir + '.old', ignore_errors=True)
+				os.replace(out_dir, out_dir + '.old')
+			os.replace(tmp_dir, out_dir)
+			shutil.rmtree(out_dir + '.old', ignore_errors=True)
+		print(f'Ingested {writer.n_rows} {dataset} results ({writer.n_partitions} partitions) in {time.time() - start_time:.1f}s')
+		return writer.n_rows
+
+	def block(self, dataset, partition, r_index):
+		'''
+		(raw rows, offset of r_index in them): the row group holding r_index for
+		Parquet partitions, the whole partition for pickled ones; kept in an LRU cache
+		'''
+		path = os.path.join(self.path, dataset, partition)
+		row_group_rows = self.manifest[dataset]['partitions'][partition].get('row_group_rows')
+		if path.endswith('.parquet') and row_group_rows:
+			key, offset = (dataset, partition, r_index // row_group_rows), r_index % row_group_rows
+		else:
+			key, offset = (dataset, partition, None), r_index
+		with self.lock:
+			df = self.block_cache.get(key)
+			if df is not None:
+				self.block_cache.move_to_end(key)
+				return df, offset
+		df = read_row_group(path, key[2]) if key[2] is not None else read_partition(path)
+		with self.lock:
+			self.block_cache[key] = df
+			while len(self.block_cache) > openfda_store_config['cache_size']:
+				self.block_cache.popitem(last=False)
+		return df, offset
+
+	def record(self, dataset, partition, r_index):
+		# one flattened result (only its own JSON columns are decoded)
+		json_columns = self.manifest[dataset]['partitions'][partition]['json_columns']
+		df, offset = self.block(dataset, partition, r_index)
+		row = df.iloc[offset]
+		record = {}
+		for key, value in row.items():
+			if value is None or (isinstance(value, float) and value != value):
+				continue
+			record[key] = json.loads(value) if key in json_columns else value
+		return record
+
+	def locations(self, dataset, key, key_type='name'):
+		if key_type == 'name':
+			key = fda_name_key(key)
+		return self.index.get(dataset, {}).get(f'{key_type}:{key}', [])
+
+	def lookup(self, dataset, key, key_type='name'):
+		'''
+		Flattened records of dataset for a brand/generic name (key_type='name') or an
+		application number (key_type='application'), in ingest order
+		'''
+		return [self.record(dataset, partition, r_index) for partition, r_index in self.locations(dataset, key, key_type)]
+
+	def first(self, dataset, key, key_type='name'):
+		# what results[0] of an API search would have been
+		locations = self.locations(dataset, key, key_type)
+		return self.record(dataset, *locations[0]) if locations else None
+
+	def iter_frames(self, dataset, columns=None):
+		'''
+		Decoded partitions of a dataset one at a time (e.g. to build fda_api_df
+		for every approved drug without holding the raw downloads)
+		'''
+		for partition, info in self.manifest.get(dataset, {}).get('partitions', {}).items():
+			# a field missing from a partition (no result in it had it) comes back empty
+			present = [column for column in columns if column in info['columns']] if columns is not None else None
+			df = read_partition(os.path.join(self.path, dataset, partition), present)
+			if columns is not None:
+				df = df.reindex(columns=columns)
+			yield decode_nested_columns(df, info['json_columns'])
+
+	def __len__(self):
+		return sum([info['n_rows'] for info in self.manifest.values()])
+
+_store = None
+_store_lock = threading.Lock()
+
+def configure_openfda_store(path=None, partition_rows=None, chunk_size=None, row_group_rows=None, cache_size=None):
+	global _store
+	for key, value in [('path', path), ('partition_rows', partition_rows), ('chunk_size', chunk_size),
+			('row_group_rows', row_group_rows), ('cache_size', cache_size)]:
+		if value is not None:
+			openfda_store_config[key] = value
+	with _store_lock:
+		_store = None
+
+def get_openfda_store(create=False):
+	'''
+	Process-wide store, or None if nothing has been ingested (unless create)
+	'''
+	global _store
+	if not create and not os.path.exists(os.path.join(openfda_store_config['path'], 'manifest.json')):
+		return None
+	with _store_lock:
+		if _store is None:
+			_store = OpenFDAStore(openfda_store_config['path'])
+	return _store
+
+if __name__ == '__main__':
+	# python -m utils.openfda_store --dataset label --ingest drug-label-0001-of-0013.json.zip ...
+	parser = argparse.ArgumentParser(description='Ingest or query the local openFDA store')
+	parser.add_argument('--dataset', choices=openfda_datasets, default=None, help='dataset of the --ingest files (default: from the file names)')
+	parser.add_argument('--ingest', nargs='+', default=None, help='bulk download zip files (https://open.fda.gov/data/downloads/)')
+	parser.add_argument('--search', type=str, default=None, help='brand/generic name to look up')
+	parser.add_argument('--path', type=str, default=None, help='store path (default databases/openfda)')
+	args = parser.parse_args()
+	if args.ingest and args.dataset is None:
+		datasets = set([zip_dataset(zip_path) for zip_path in args.ingest])
+		if len(datasets) != 1 or None in datasets:
+			parser.error('--ingest needs --dataset unless every file is named like drug-<dataset>-0001-of-0001.json.zip')
+		args.dataset = datasets.pop()
+	configure_openfda_store(path=args.path)
+	store = get_openfda_store(create=True)
+	if args.ingest:
+		store.ingest(args.dataset, args.ingest)
+	print(f'{len(store)} results: ' + ', '.join([f'{dataset} {info["n_rows"]}' for dataset, info in store.manifest.items()]))
+	if args.search:
+		for dataset in store.manifest:
+			print(f'{dataset}: {len(store.lookup(dataset, args.search))} results for {args.search}')
@@ -0,0 +1,64 @@
+import os
+import glob
+import threading
+import pandas as pd
+
+def parquet_available():
+	try:
+		import pyarrow
+	except ImportError:
+		return False
+	return True
+
+class PartitionWriter:
+	'''
+	Writes DataFrame chunks as numbered partitions under out_dir
+	(Parquet when pyarrow is installed, pickle otherwise)
+	'''
+	def __init__(self, out_dir):
+		self.out_dir = out_dir
+		self.extension = 'parquet' if parquet_available() else 'pkl'
+		self.lock = threading.Lock()
+		self.n_partitions = 0
+		self.n_rows = 0
+		os.makedirs(out_dir, exist_ok=True)
+		# start from an empty directory so old partitions aren't read back
+		for path in partition_paths(out_dir):
+			os.remove(path)
+
+	def write(self, df, row_group_size=None):
+		'''
+		row_group_size: rows per Parquet row group, so single rows can be read back
+		without the whole partition (see read_row_group)
+		'''
+		if len(df) == 0:
+			return None
+		with self.lock:
+			path = os.path.join(self.out_dir, f'part-{self.n_partitions:05d}.{self.extension}')
+			self.n_partitions += 1
+			self.n_rows += len(df)
+		if self.extension == 'parquet':
+			df.to_parquet(path, index=False, row_group_size=row_group_size)
+		else:
+			df.to_pickle(path)
+		return path
+
+def partition_paths(out_dir):
+	return sorted(glob.glob(os.path.join(out_dir, 'part-*.parquet')) + glob.glob(os.path.join(out_dir, 'part-*.pkl')))
+
+def read_partition(path, columns=None):
+	if path.endswith('.parquet'):
+		return pd.read_parquet(path, columns=columns)
+	df = pd.read_pickle(path)
+	return df[columns] if columns is not None else df
+
+def read_row_group(path, row_group, columns=None):
+	import pyarrow.parquet as pq
+	return pq.ParquetFile(path).read_row_group(row_group, columns=columns).to_pandas()
+
+def iter_partitions(out_dir, columns=None):
+	'''
+	Yield the partitions under out_dir one DataFrame at a time
+	'''
+	for path in partition_paths(out_dir):
+		yield read_partition(path, columns)
@@ -0,0 +1,34 @@
+import io
+import xml.etree.ElementTree as ET
+
+def local_name(tag):
+	# '{http://pubchem.ncbi.nlm.nih.gov/pug_rest}Synonym' -> 'Synonym'
+	return tag.rsplit('}', 1)[-1]
+
+def iter_information(content, fields=None):
+	'''
+	The <Information> records of a PUG REST XML response body as {field: [values]},
+	e.g. {'CID': ['2244'], 'Synonym': ['aspirin', ...]}, parsed incrementally
+	without building a tree: elements are cleared as soon as they are read, and
+	stopping early skips parsing the rest. The body itself is already in memory
+	(responses are cached, recorded and shared whole), so only the parse is saved.
+	'''
+	if not content:
+		return
+	record = {}
+	try:
+		for _, element in ET.iterparse(io.BytesIO(content), events=('end',)):
+			name = local_name(element.tag)
+			if name == 'Information':
+				yield record
+				record = {}
+				element.clear()
+			elif fields is None or name in fields:
+				record.setdefault(name, []).append(element.text or '')
+				element.clear()
+	except ET.ParseError:
+		# error pages (and empty or truncated bodies) just end the records
+		return
+
+def first_information(content, fields=None):
+	return next(iter_information(content, fields), None)
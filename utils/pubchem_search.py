@@ -4,15 +4,21 @@ import sys
 import time
 import tqdm
 import string
+import itertools
+import functools
 import datetime
 import requests
 import textwrap
 import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
 import matplotlib.pyplot as plt
 from collections import defaultdict
 from utils.webpage_scraping import test_connection
+from utils.async_fetch import map_async, run_sync, fan_out
+from utils.circuit_breaker import upstream_available
+from utils.pubchem_store import get_store
+from utils.pubchem_parsing import iter_information, first_information
+from utils.row_accumulator import RowAccumulator
 from utils.pickle_dataframes import pickle_dataframe
 from utils.drug_search import clean_drug_name
 from utils.fda_sponsors import fda_sponsor_list, rename_sponsors
@@ -21,6 +27,18 @@ import warnings
 pd.options.mode.chained_assignment = None  # default='warn'
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+pubchem_host = 'pubchem.ncbi.nlm.nih.gov'
+# PubChem answers: found, or a definite 'no such name' (anything else says nothing about the drug)
+pubchem_answer_status_codes = [200, 404]
+
+def record_status(statuses, response):
+	# collect the status codes of a record's lookups (None when the host was unavailable)
+	if statuses is not None:
+		statuses.append(getattr(response, 'status_code', None))
+
+def statuses_answered(statuses):
+	return all(status in pubchem_answer_status_codes for status in statuses)
+
 def combine_values(list_1, list_2):
 	combine_flag = True
 	if (list_1 == None and list_2 == None) or (list_1 == [None] and list_2 == [None]):
@@ -39,12 +57,13 @@ def combine_values(list_1, list_2):
 	return final_list
 
 # access pubchem API
-def get_pubchem_cid(drug):
+def get_pubchem_cid(drug, statuses=None):
 	'''
 	Get PubChem CID for a drug name
 	'''
 	base_url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{drug}/cids/JSON'
 	response = test_connection(base_url)
+	record_status(statuses, response)
 	if response.status_code == 404:
 		return None
 	try:
@@ -59,12 +78,13 @@ def get_pubchem_cid(drug):
 	# print(f'  PubChem CID for {drug}: {cid}')
 	return cid
 
-def get_pubchem_sid(drug):
+def get_pubchem_sid(drug, statuses=None):
 	'''
 	Get PubChem SID for a drug name
 	'''
 	base_url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/substance/name/{drug}/sids/JSON'
 	response = test_connection(base_url)
+	record_status(statuses, response)
 	if response.status_code == 404:
 		return None
 	try:
@@ -79,60 +99,85 @@ def get_pubchem_sid(drug):
 	# print(f'  PubChem SID for {drug}: {sid}')
 	return sid
 
-def get_pubchem_synonyms(drug, search_type='compound'):
+def get_pubchem_synonyms(drug, search_type='compound', statuses=None):
 	base_url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/{search_type}/name/{drug}/synonyms/XML'
 	response = test_connection(base_url)
-	soup = BeautifulSoup(response.text, features='lxml')
-	synonyms_soup = soup.find_all("information")
-	if len(synonyms_soup) == 0:
+	record_status(statuses, response)
+	information = first_information(response.content, ['Synonym'])
+	if information is None:
 		return [drug]
-	synonyms = synonyms_soup[0].find_all("synonym")
-	synonyms = [drug] + [synonym.get_text() for synonym in synonyms]
+	synonyms = [drug] + information.get('Synonym', [])
 	# print(f'  Synonyms for {drug}: {synonyms}')
 	return synonyms
 
-def get_pubchem_description(drug):
+def get_pubchem_description(drug, statuses=None):
 	base_url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{drug}/description/XML'
 	response = test_connection(base_url)
-	soup = BeautifulSoup(response.text, features='lxml')
-	description_soup = soup.find_all("information")
-	if len(description_soup) < 2:
+	record_status(statuses, response)
+	# the first record is the title, only parse as far as the second
+	description_info = list(itertools.islice(iter_information(response.content, ['Description']), 2))
+	if len(description_info) < 2:
 		# print(f'  No description found for {drug}')
 		return None
-	try:
-		description = description_soup[1].find("description").get_text()
-		# print(f'  Description for {drug}: {description}')
-	except:
-		description = None
-		# print(f'  No description found for {drug}')
+	description = description_info[1].get('Description', [None])[0]
+	# print(f'  Description for {drug}: {description}')
 	return description
 
-def pubmed_cid_search(cid):
+def pubmed_cid_search(cid, statuses=None):
 	base_url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/xrefs/PubMedID/XML'
 	response = test_connection(base_url)
-	soup = BeautifulSoup(response.text, features='lxml')
-	pmids_soup = soup.find_all("information")
-	if len(pmids_soup) == 0:
+	record_status(statuses, response)
+	information = first_information(response.content, ['PubMedID'])
+	if information is None:
 		return None
-	pmids = pmids_soup[0].find_all("pubmedid")
-	pmids = [pmid.get_text() for pmid in pmids]
+	pmids = information.get('PubMedID', [])
+	return pmids
+
+# PMIDs are assigned in increasing order, so the largest are the most recent;
+# keep only the top_n most recent per compound (None keeps all)
+pmid_config = {
+	'top_n': 1000,
+}
+
+def pmid_array(pmids, top_n=-1):
+	'''
+	Sorted, de-duplicated int32 array of PMIDs (int64 if they ever outgrow it),
+	capped to the top_n most recent (default pmid_config['top_n'])
+	'''
+	if top_n == -1:
+		top_n = pmid_config['top_n']
+	pmids = np.unique(np.asarray(pmids, dtype=np.int64))
+	if top_n is not None and len(pmids) > top_n:
+		pmids = pmids[len(pmids)-top_n:]
+	if len(pmids) == 0 or pmids[-1] < 2**31:
+		pmids = pmids.astype(np.int32)
 	return pmids
 
+def iter_pmid_pages(pubmed_ids, page_size=20):
+	'''
+	Most recent PMIDs first, page_size at a time
+	'''
+	if pubmed_ids is None:
+		return
+	for end in range(len(pubmed_ids), 0, -page_size):
+		yield [int(pmid) for pmid in pubmed_ids[max(0, end-page_size):end][::-1]]
+
 def get_pubchem_pmids(cids):
 	if cids == None:
 		return None
 	pubmed_ids = []
 	if type(cids) == list:
+		cid_pmids = fan_out({cid: (pubmed_cid_search, cid) for cid in cids})
 		for cid in cids:
-			pmids = pubmed_cid_search(cid)
+			pmids = cid_pmids[cid]
 			if pmids != None:
 				pubmed_ids += pmids
 	else:
 		pubmed_ids = pubmed_cid_search(cids)
 	# remove duplicates
 	if pubmed_ids != None:
-		pubmed_ids = [pubmed_id for pubmed_id in set(pubmed_ids)]
-		len_pubmed_ids = [len(pubmed_ids) if type(pubmed_ids) == list else 0][0]
+		pubmed_ids = pmid_array(pubmed_ids)
+		len_pubmed_ids = len(pubmed_ids)
 	else:
 		len_pubmed_ids = 0
 	# print(f'  PubMed IDs for {cids}: {len_pubmed_ids}')
@@ -141,15 +186,106 @@ def get_pubchem_pmids(cids):
 def get_pubchem_patents(drug):
 	base_url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{drug}/xrefs/PatentID/XML'
 	response = test_connection(base_url)
-	soup = BeautifulSoup(response.text, features='lxml')
-	patents_soup = soup.find_all("information")
-	if len(patents_soup) == 0:
+	information = first_information(response.content, ['PatentID'])
+	if information is None:
 		return None
-	patents = patents_soup[0].find_all("patentid")
-	patents = [patent.get_text() for patent in patents]
+	patents = information.get('PatentID', [])
 	print(f'  Patents for {drug}: {patents}')
 	return patents
 
+# batched PUG REST lookups: identifiers are POSTed as comma-separated lists
+pubchem_rest = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug'
+
+def chunk_list(values, chunk_size):
+	return [values[i:i+chunk_size] for i in range(0, len(values), chunk_size)]
+
+def post_pubchem_information(url, id_type, ids, chunk_size=50, statuses=None):
+	'''
+	POST chunks of CIDs/SIDs to a PUG REST operation and return all InformationList records
+	'''
+	information = []
+	for chunk in chunk_list(sorted(set(ids)), chunk_size):
+		response = test_connection(url, data={id_type: ','.join([str(i) for i in chunk])})
+		record_status(statuses, response)
+		if response.status_code != 200:
+			continue
+		try:
+			information += response.json()['InformationList']['Information']
+		except:
+			# print(f'  Error: {response.text}')
+			continue
+	return information
+
+def get_pubchem_ids_batch(names, statuses=None):
+	'''
+	Resolve each unique name to its first CID and SID. The name namespace only takes
+	one name per request, so these run concurrently instead of being batched.
+	'''
+	names = list(dict.fromkeys(names))
+	ids = run_sync(map_async(lambda name: (get_pubchem_cid(name, statuses=statuses), get_pubchem_sid(name, statuses=statuses)), names))
+	return dict(zip(names, ids))
+
+def get_pubchem_synonyms_batch(ids, search_type='compound', chunk_size=50, statuses=None):
+	id_type = 'cid' if search_type == 'compound' else 'sid'
+	information = post_pubchem_information(f'{pubchem_rest}/{search_type}/{id_type}/synonyms/JSON', id_type, ids, chunk_size, statuses)
+	return {info[id_type.upper()]: info.get('Synonym', []) for info in information}
+
+def get_pubchem_description_batch(cids, chunk_size=100, statuses=None):
+	information = post_pubchem_information(f'{pubchem_rest}/compound/cid/description/JSON', 'cid', cids, chunk_size, statuses)
+	# the first record per CID is its title, keep the first description
+	descriptions = {}
+	for info in information:
+		if 'Description' in info and info['CID'] not in descriptions:
+			descriptions[info['CID']] = info['Description']
+	return descriptions
+
+def get_pubchem_pmids_batch(cids, chunk_size=10, statuses=None):
+	# xref lists can be huge for well-studied compounds, so keep these chunks small
+	information = post_pubchem_information(f'{pubchem_rest}/compound/cid/xrefs/PubMedID/JSON', 'cid', cids, chunk_size, statuses)
+	return {info['CID']: [str(pmid) for pmid in info.get('PubMedID', [])] for info in information}
+
+def fetch_names_info_batch(names, chunk_size=50):
+	'''
+	Per-name records (see fetch_names_info) built from chunked multi-identifier POSTs
+	'''
+	print(f'Resolving PubChem IDs for {len(names)} names...')
+	statuses = []
+	name_ids = get_pubchem_ids_batch(names, statuses)
+	cids = [cid for cid, sid in name_ids.values() if cid is not None]
+	sids = [sid for cid, sid in name_ids.values() if sid is not None]
+	print(f'Fetching PubChem synonyms/descriptions for {len(set(cids))} CIDs and {len(set(sids))} SIDs...')
+	compound_synonyms = get_pubchem_synonyms_batch(cids, 'compound', chunk_size, statuses)
+	substance_synonyms = get_pubchem_synonyms_batch(sids, 'substance', chunk_size, statuses)
+	descriptions = get_pubchem_description_batch(cids, statuses=statuses)
+	pmids = get_pubchem_pmids_batch(cids, statuses=statuses)
+	# a failed chunk can't be traced to its names, so nothing from this batch is stored
+	if not upstream_available(pubchem_host) or not statuses_answered(statuses):
+		return {name: None for name in names}
+	records = {}
+	for name, (cid, sid) in name_ids.items():
+		records[name] = {
+			'cid': cid,
+			'sid': sid,
+			'compound_synonyms': compound_synonyms.get(cid, []),
+			'substance_synonyms': substance_synonyms.get(sid, []),
+			'description': descriptions.get(cid),
+			'pubmed_ids': pmid_array(pmids[cid]).tolist() if cid in pmids else None,
+		}
+	return records
+
+def search_pubchem_batch(df, save_df=False, chunk_size=50):
+	'''
+	Same pubchem_df as search_pubchem, but synonyms, descriptions and PubMed IDs are
+	fetched with chunked multi-identifier POSTs instead of one GET per name
+	'''
+	drugs = list(zip(df['drug_name'].values, df['active_ingredient'].values))
+	names = list(dict.fromkeys([name for drug in drugs for name in drug]))
+	infos = get_names_info(names, fetch=lambda missing: fetch_names_info_batch(missing, chunk_size))
+	pubchem_rows = RowAccumulator(pubchem_columns, dtype=object)
+	pubchem_rows.extend([drug_info_row(drug_name, active_ingredient, infos) for drug_name, active_ingredient in drugs])
+	pubchem_df = pubchem_rows.to_frame()
+	return finish_pubchem_df(pubchem_df, save_df)
+
 # # some active ingredients have multiple names separated by commas
 # if ',' in active_ingredient:
 # 	active_ingredients = active_ingredient.split(',')
@@ -157,88 +293,180 @@ def get_pubchem_patents(drug):
 # 		active_ingredient_cleaned = active_ingredient.replace('and', '').strip()
 # 		cid = combine_values([get_pubchem_cid(active_ingredient_cleaned)],
 
-# get info for aspirin
-def get_drug_info(drug_name, active_ingredient, pubchem_df):
-	# if drug name is different from active ingredient, get info for both active ingredient and drug name and combine
+
+# per-name lookups: {field: (func, *extra args)}
+name_lookups = {
+	'cid': (get_pubchem_cid,),
+	'sid': (get_pubchem_sid,),
+	'compound_synonyms': (get_pubchem_synonyms,),
+	'substance_synonyms': (get_pubchem_synonyms, 'substance'),
+	'description': (get_pubchem_description,),
+}
+empty_name_info = {
+	'cid': None,
+	'sid': None,
+	'compound_synonyms': [],
+	'substance_synonyms': [],
+	'description': None,
+	'pubmed_ids': None,
+}
+
+def fetch_names_info(names):
+	'''
+	Fetch the PubChem record of each name, all lookups at once (PMIDs wait for the CIDs).
+	Synonyms are kept without the looked-up name, which is added back on read.
+	A record is None unless every one of its lookups was answered (200 or 404),
+	so a transient error or an offline-cache miss never looks like 'not found'.
+	'''
+	statuses = {name: [] for name in names}
+	calls = {(field, name): (functools.partial(func, statuses=statuses[name]), name, *args) for name in names for field, (func, *args) in name_lookups.items()}
+	results = fan_out(calls)
+	cids = {name: results[('cid', name)] for name in names}
+	pmids = fan_out({name: (functools.partial(pubmed_cid_search, statuses=statuses[name]), cid) for name, cid in cids.items() if cid is not None})
+	if not upstream_available(pubchem_host):
+		return {name: None for name in names}
+	records = {}
+	for name in names:
+		if not statuses_answered(statuses[name]):
+			records[name] = None
+			continue
+		records[name] = {
+			'cid': cids[name],
+			'sid': results[('sid', name)],
+			'compound_synonyms': results[('compound_synonyms', name)][1:],
+			'substance_synonyms': results[('substance_synonyms', name)][1:],
+			'description': results[('description', name)],
+			'pubmed_ids': pmid_array(pmids[name]).tolist() if pmids.get(name) is not None else None,
+		}
+	return records
+
+def fetch_name_info(name):
+	return fetch_names_info([name])[name]
+
+def get_names_info(names, fetch=fetch_names_info):
+	'''
+	Per-name records read through the local PubChem store; missing or stale
+	names are fetched together and stored
+	'''
+	store = get_store()
+	records = {name: store.get_fresh(name) if store is not None else None for name in names}
+	missing = [name for name, record in records.items() if record is None]
+	if missing:
+		for name, record in fetch(missing).items():
+			if record is None:
+				# PubChem is down or didn't answer, fall back to whatever we have (nothing is stored)
+				record = (store.get(name) if store is not None else None) or empty_name_info
+			elif store is not None:
+				record = store.put(name, record)
+			records[name] = record
+	return records
+
+def name_values(name, record):
+	return {
+		'cid': record['cid'],
+		'sid': record['sid'],
+		'compound_synonyms': [name] + record['compound_synonyms'],
+		'substance_synonyms': [name] + record['substance_synonyms'],
+		'description': record['description'],
+	}
+
+def drug_info_row(drug_name, active_ingredient, infos):
+	ai_values = name_values(active_ingredient, infos[active_ingredient])
+	# if drug name is different from active ingredient, combine the info for both
 	if drug_name != active_ingredient:
-		# print(f' Searching PubChem CIDs:')
-		cid = combine_values([get_pubchem_cid(active_ingredient)],
-											 	 [get_pubchem_cid(drug_name)])
-		# print(f' Searching PubChem SIDs:')
-		sid = combine_values([get_pubchem_sid(active_ingredient)], 
-											 	 [get_pubchem_sid(drug_name)])
-		# print(f' Searching PubChem Compound Synonyms:')
-		compound_synonyms = combine_values(get_pubchem_synonyms(active_ingredient), 
-																		 	 get_pubchem_synonyms(drug_name))
-		# print(f' Searching PubChem Substance Synonyms:')
-		substance_synonyms = combine_values(get_pubchem_synonyms(active_ingredient, 'substance'), 
-																				get_pubchem_synonyms(drug_name, 'substance'))
-		# print(f' Searching PubChem Descriptions:')
-		description = combine_values([get_pubchem_description(active_ingredient)], 
-															 	 [get_pubchem_description(drug_name)])
+		dn_values = name_values(drug_name, infos[drug_name])
+		values = {
+			'cid': combine_values([ai_values['cid']], [dn_values['cid']]),
+			'sid': combine_values([ai_values['sid']], [dn_values['sid']]),
+			'compound_synonyms': combine_values(ai_values['compound_synonyms'], dn_values['compound_synonyms']),
+			'substance_synonyms': combine_values(ai_values['substance_synonyms'], dn_values['substance_synonyms']),
+			'description': combine_values([ai_values['description']], [dn_values['description']]),
+		}
+		name_infos = [infos[active_ingredient], infos[drug_name]]
 	else:
-		cid = get_pubchem_cid(active_ingredient)
-		sid = get_pubchem_sid(active_ingredient)
-		compound_synonyms = get_pubchem_synonyms(active_ingredient)
-		substance_synonyms = get_pubchem_synonyms(active_ingredient, 'substance')
-		description = get_pubchem_description(active_ingredient)
-	if cid == None:
-		print(f'  No PubChem CID found for {active_ingredient} or {drug_name}')
-	print(f'  CID: {cid} | Synonyms {len(compound_synonyms)}')
-	# print(f' Searching PubChem PubMed IDs:')
-	pubmed_ids = get_pubchem_pmids(cid)
-	pubchem_df = pd.concat([pubchem_df, pd.DataFrame({
-		"drug_name": [drug_name],
-		"active_ingredient": [active_ingredient],
-		"cid": [cid],
-		"sid": [sid],
-		"compound_synonyms": [compound_synonyms],
-		"substance_synonyms": [substance_synonyms],
-		"description": [description],
-		"pubmed_ids": [pubmed_ids],
-		"link": [f'https://pubchem.ncbi.nlm.nih.gov/compound/{cid}']
+		values = ai_values
+		name_infos = [infos[active_ingredient]]
+	cid = values['cid']
+	# same capped, de-duplicated union as get_pubchem_pmids
+	if cid is None:
+		pubmed_ids = None
+	elif type(cid) != list:
+		pubmed_ids = [info['pubmed_ids'] for info in name_infos if info['cid'] == cid][0]
+		pubmed_ids = pmid_array(pubmed_ids) if pubmed_ids is not None else None
+	else:
+		pubmed_ids = []
+		for info in name_infos:
+			if info['pubmed_ids'] != None:
+				pubmed_ids += info['pubmed_ids']
+		pubmed_ids = pmid_array(pubmed_ids)
+	return {
+		"drug_name": drug_name,
+		"active_ingredient": active_ingredient,
+		**values,
+		"pubmed_ids": pubmed_ids,
+		"link": f'https://pubchem.ncbi.nlm.nih.gov/compound/{cid}'
 		# "patents": None
-	})], ignore_index=True)
+	}
+
+def get_drug_info_row(drug_name, active_ingredient):
+	infos = get_names_info(list(dict.fromkeys([active_ingredient, drug_name])))
+	row = drug_info_row(drug_name, active_ingredient, infos)
+	if row['cid'] == None:
+		print(f'  No PubChem CID found for {active_ingredient} or {drug_name}')
+	print(f'  CID: {row["cid"]} | Synonyms {len(row["compound_synonyms"])}')
+	return row
+
+def get_drug_info(drug_name, active_ingredient, pubchem_df):
+	row = get_drug_info_row(drug_name, active_ingredient)
+	pubchem_df = pd.concat([pubchem_df, pd.DataFrame({key: [value] for key, value in row.items()})], ignore_index=True)
 	return pubchem_df
 
+def set_object_values(values, mask, new_values):
+	# per-position assignment, so lists aren't broadcast as a 2D array
+	for v_index, new_value in zip(np.flatnonzero(mask), new_values):
+		values[v_index] = new_value
+
 def convert_float_int(pubchem_df, col_name='cid'):
-	# conver all values in cid to int
-	id_count = 0
-	for i, id in enumerate(pubchem_df[col_name]):
-		# check for None or nan values
-		if id == None or id != id:
-			pubchem_df[col_name].iloc[i] = None
-			continue
-		id_count += 1
-		if type(id) == list:
-			pubchem_df[col_name].iloc[i] = [int(c) for c in id]
-		else:
-			pubchem_df[col_name].iloc[i] = int(id)
-	# print(f'Number of {col_name.upper()}s: {id_count}')
+	# convert all values in col_name to int (or list of ints), missing values to None
+	ids = pd.Series(pubchem_df[col_name].values, dtype=object)
+	is_list = (ids.map(type).values == list).astype(bool)
+	is_scalar = ~is_list & ids.notna().values
+	converted = np.full(len(ids), None, dtype=object)
+	if is_scalar.any():
+		converted[is_scalar] = pd.to_numeric(ids[is_scalar]).astype('int64').tolist()
+	if is_list.any():
+		exploded = ids[is_list].explode()
+		ints = pd.to_numeric(exploded.dropna()).astype('int64')
+		id_lists = ints.groupby(level=0, sort=False).agg(list).reindex(ids.index[is_list])
+		set_object_values(converted, is_list, [id_list if type(id_list) == list else [] for id_list in id_lists.values])
+	pubchem_df[col_name] = converted
+	# print(f'Number of {col_name.upper()}s: {int(is_scalar.sum() + is_list.sum())}')
 	return pubchem_df
 
 # add drug_name and active_ingredient to compound synonyms only if they are not already in the list
 def add_drug_name_active_ingredient(df):
-	for i, row in df.iterrows():
-		compound_synonyms = row['compound_synonyms']
-		if compound_synonyms == None:
-			compound_synonyms = [row['drug_name'], row['active_ingredient']]
-		elif row['drug_name'] not in compound_synonyms:
-			compound_synonyms = [row['drug_name']] + compound_synonyms
-		elif row['active_ingredient'] not in compound_synonyms:
-			compound_synonyms = [row['active_ingredient']] + compound_synonyms
-		df['compound_synonyms'].iloc[i] = compound_synonyms
+	synonyms = pd.Series(df['compound_synonyms'].values, dtype=object)
+	drug_names = df['drug_name'].values
+	active_ingredients = df['active_ingredient'].values
+	is_none = synonyms.map(lambda value: value is None).values.astype(bool)
+	# membership of each row's names in its own synonym list, via one exploded column
+	exploded = synonyms[~is_none].explode()
+	row_index = exploded.index.values
+	has_drug_name = pd.Series(exploded.values == drug_names[row_index]).groupby(row_index).any().reindex(synonyms.index, fill_value=False).values.astype(bool)
+	has_active_ingredient = pd.Series(exploded.values == active_ingredients[row_index]).groupby(row_index).any().reindex(synonyms.index, fill_value=False).values.astype(bool)
+	prepend_drug_name = ~is_none & ~has_drug_name
+	prepend_active_ingredient = ~is_none & has_drug_name & ~has_active_ingredient
+	compound_synonyms = synonyms.values.copy()
+	set_object_values(compound_synonyms, is_none, [[drug_name, active_ingredient] for drug_name, active_ingredient in zip(drug_names[is_none], active_ingredients[is_none])])
+	set_object_values(compound_synonyms, prepend_drug_name, [[drug_name] + values for drug_name, values in zip(drug_names[prepend_drug_name], synonyms.values[prepend_drug_name])])
+	set_object_values(compound_synonyms, prepend_active_ingredient, [[active_ingredient] + values for active_ingredient, values in zip(active_ingredients[prepend_active_ingredient], synonyms.values[prepend_active_ingredient])])
+	df['compound_synonyms'] = compound_synonyms
 	return df
 
 # count the number of drugs that have either a CID or SID
 def count_pubchem_ids(pubchem_df):
-	cid_count = 0
-	sid_count = 0
-	for i, row in pubchem_df.iterrows():
-		if row['cid'] != None:
-			cid_count += 1
-		if row['sid'] != None:
-			sid_count += 1
+	cid_count = pubchem_df['cid'].notna().sum()
+	sid_count = pubchem_df['sid'].notna().sum()
 	print(f'Number of drugs with CID: {cid_count}/{len(pubchem_df)}')
 	print(f'Number of drugs with SID: {sid_count}/{len(pubchem_df)}')
 	# print the drugs missing SID
@@ -249,14 +477,9 @@ def count_pubchem_ids(pubchem_df):
 	else:
 		print(missing_sid[['drug_name', 'active_ingredient']])
 
-# create a pandas dataframe
-def search_pubchem(df, save_df=False):
-	pubchem_df = pd.DataFrame(columns=["drug_name", "active_ingredient", "cid", "sid",  "compound_synonyms", "substance_synonyms", "description", "pubmed_ids", "link"])
-	for d_index, drug_name in enumerate(df['drug_name'].values):
-		active_ingredient = df['active_ingredient'].iloc[d_index]
-		print(f'Getting drug info for {drug_name} ({active_ingredient})...({d_index+1}/{len(df)})')
-		# some drugs have multiple active ingredients separated by commas
-		pubchem_df = get_drug_info(drug_name, active_ingredient, pubchem_df)
+pubchem_columns = ["drug_name", "active_ingredient", "cid", "sid",  "compound_synonyms", "substance_synonyms", "description", "pubmed_ids", "link"]
+
+def finish_pubchem_df(pubchem_df, save_df=False):
 	# convert all cids to int or list of ints
 	pubchem_df = convert_float_int(pubchem_df, 'cid')
 	pubchem_df = convert_float_int(pubchem_df, 'sid')
@@ -265,4 +488,29 @@ def search_pubchem(df, save_df=False):
 	count_pubchem_ids(pubchem_df)
 	if save_df:
 		pickle_dataframe(pubchem_df, 'databases/pubchem_df.pkl')
-	return pubchem_df
\ No newline at end of file
+	return pubchem_df
+
+# create a pandas dataframe
+def search_pubchem(df, save_df=False, concurrent=False, batch=False):
+	if batch:
+		return search_pubchem_batch(df, save_df=save_df)
+	if concurrent:
+		return run_sync(search_pubchem_async(df, save_df=save_df))
+	pubchem_rows = RowAccumulator(pubchem_columns, dtype=object)
+	for d_index, drug_name in enumerate(df['drug_name'].values):
+		active_ingredient = df['active_ingredient'].iloc[d_index]
+		print(f'Getting drug info for {drug_name} ({active_ingredient})...({d_index+1}/{len(df)})')
+		# some drugs have multiple active ingredients separated by commas
+		pubchem_rows.append(get_drug_info_row(drug_name, active_ingredient))
+	return finish_pubchem_df(pubchem_rows.to_frame(), save_df)
+
+async def search_pubchem_async(df, save_df=False):
+	'''
+	Same as search_pubchem, but drugs are looked up concurrently (bounded per host)
+	'''
+	print(f'Getting drug info for {len(df)} drugs concurrently...')
+	drugs = list(zip(df['drug_name'].values, df['active_ingredient'].values))
+	pubchem_rows = RowAccumulator(pubchem_columns, dtype=object)
+	pubchem_rows.extend(await map_async(lambda drug: get_drug_info_row(*drug), drugs))
+	pubchem_df = pubchem_rows.to_frame()
+	return finish_pubchem_df(pubchem_df, save_df)
@@ -0,0 +1,143 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+day = 24*60*60
+store_config = {
+	'path': os.path.join('databases', 'pubchem_store.sqlite'),
+	# records older than this are refetched (names PubChem doesn't know sooner)
+	'max_age': 30*day,
+	'miss_max_age': 7*day,
+	'enabled': True,
+}
+
+def normalize_name(name):
+	return re.sub(r'\s+', ' ', str(name)).strip().lower()
+
+class PubChemStore:
+	'''
+	Per-name PubChem records (CID, SID, synonyms, description, PMIDs) in sqlite,
+	keyed by normalized name, with an in-memory layer for repeat lookups
+	'''
+	def __init__(self, path, max_age=30*day, miss_max_age=7*day):
+		self.path = path
+		self.max_age = max_age
+		self.miss_max_age = miss_max_age
+		self.lock = threading.Lock()
+		self.memory = {}
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute('''
+			CREATE TABLE IF NOT EXISTS names (
+				name TEXT PRIMARY KEY,
+				record TEXT,
+				fetched_at REAL
+			)''')
+		self.db.execute('CREATE INDEX IF NOT EXISTS names_fetched_at ON names (fetched_at)')
+		self.db.commit()
+
+	def get(self, name):
+		'''
+		Stored record for a name (fresh or not), or None
+		'''
+		key = normalize_name(name)
+		record = self.memory.get(key)
+		if record is not None:
+			return record
+		with self.lock:
+			row = self.db.execute('SELECT record, fetched_at FROM names WHERE name = ?', (key,)).fetchone()
+		if row is None:
+			return None
+		record = json.loads(row[0])
+		record['fetched_at'] = row[1]
+		self.memory[key] = record
+		return record
+
+	def age_limit(self, record):
+		return self.max_age if record.get('cid') is not None else self.miss_max_age
+
+	def is_fresh(self, record):
+		return time.time() - record['fetched_at'] < self.age_limit(record)
+
+	def get_fresh(self, name):
+		record = self.get(name)
+		if record is None or not self.is_fresh(record):
+			return None
+		return record
+
+	def put(self, name, record):
+		key = normalize_name(name)
+		record = dict(record, fetched_at=time.time())
+		values = {field: value for field, value in record.items() if field != 'fetched_at'}
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?)', (key, json.dumps(values), record['fetched_at']))
+			self.db.commit()
+		self.memory[key] = record
+		return record
+
+	def stale_names(self):
+		with self.lock:
+			rows = self.db.execute('SELECT name, record, fetched_at FROM names').fetchall()
+		now = time.time()
+		return [name for name, record, fetched_at in rows if now - fetched_at >= self.age_limit(json.loads(record))]
+
+	def refresh_stale(self, fetch, limit=None):
+		'''
+		Refetch only the stale records with fetch(name) -> record (or None to keep the old one)
+		'''
+		names = self.stale_names()[:limit]
+		print(f'Refreshing {len(names)} stale PubChem records...')
+		n_refreshed = 0
+		for name in names:
+			record = fetch(name)
+			if record is not None:
+				self.put(name, record)
+				n_refreshed += 1
+		return n_refreshed
+
+	def __len__(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM names').fetchone()[0]
+
+_store = None
+_store_lock = threading.Lock()
+
+def configure_store(path=None, max_age=None, miss_max_age=None, enabled=None):
+	global _store
+	for key, value in [('path', path), ('max_age', max_age), ('miss_max_age', miss_max_age), ('enabled', enabled)]:
+		if value is not None:
+			store_config[key] = value
+	with _store_lock:
+		_store = None
+
+def get_store():
+	'''
+	Process-wide store, or None if turned off
+	'''
+	global _store
+	if not store_config['enabled']:
+		return None
+	with _store_lock:
+		if _store is None:
+			_store = PubChemStore(store_config['path'], store_config['max_age'], store_config['miss_max_age'])
+	return _store
+
+if __name__ == '__main__':
+	# nightly job: python -m utils.pubchem_store --refresh
+	parser = argparse.ArgumentParser(description='Inspect or refresh the local PubChem store')
+	parser.add_argument('--refresh', action='store_true', help='refetch stale records')
+	parser.add_argument('--limit', type=int, default=None, help='refresh at most this many records')
+	parser.add_argument('--path', type=str, default=None, help='store path (default databases/pubchem_store.sqlite)')
+	args = parser.parse_args()
+	configure_store(path=args.path)
+	store = get_store()
+	print(f'{len(store)} PubChem records, {len(store.stale_names())} stale')
+	if args.refresh:
+		from utils.pubchem_search import fetch_name_info
+		n_refreshed = store.refresh_stale(fetch_name_info, limit=args.limit)
+		print(f'  Refreshed {n_refreshed} records')
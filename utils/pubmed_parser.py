@@ -3,9 +3,11 @@ import re
 import sys
 import time
 import json
+import asyncio
 import string
 import datetime
 import pprint
+import requests
 import pandas as pd
 import numpy as np
 from tqdm.auto import tqdm
@@ -17,6 +19,10 @@ import urllib.request, urllib.parse, urllib.error
 from collections import defaultdict, Counter
 # api_keys.py contains the API key for NCBI Entrez
 from utils.api_keys import ncbi_api_key
+from utils.webpage_scraping import read_url
+from utils.async_fetch import read_url_async, run_sync
+from utils.circuit_breaker import UpstreamUnavailable
+from utils.row_accumulator import RowAccumulator
 
 # Class Instantiation
 ### Called within SalzmanParser to instantiate class objects and attributes
@@ -78,7 +84,7 @@ def PMID_ListGenerator(eSearchList):
 	print('\nGenerating list of PMIDs...')
 	finalList = []
 	for term in eSearchList:
-		r = urllib.request.urlopen(term).read().decode('utf-8')
+		r = read_url(term).decode('utf-8')
 		PMID_List = re.findall('<Id>(.*?)</Id>', r)
 		prefix = 'https://www.ncbi.nlm.nih.gov/pubmed/'
 		resultsList = []
@@ -91,7 +97,20 @@ def PMID_ListGenerator(eSearchList):
 	print(f'  Number of PMIDs: {len(finalList)}')
 	return finalList
 
-def entrezSearch(searchParameters):
+# PMID_ListGenerator_async : same as PMID_ListGenerator, but all esearch queries are sent concurrently
+async def PMID_ListGenerator_async(eSearchList):
+	print('\nGenerating list of PMIDs...')
+	responses = await asyncio.gather(*[read_url_async(term) for term in eSearchList])
+	finalList = []
+	prefix = 'https://www.ncbi.nlm.nih.gov/pubmed/'
+	for term, r in zip(eSearchList, responses):
+		PMID_List = re.findall('<Id>(.*?)</Id>', r.decode('utf-8'))
+		finalList.append([prefix+PMID for PMID in PMID_List])
+		print(f'  {term} : {len(PMID_List)} results')
+	print(f'  Number of PMIDs: {len(finalList)}')
+	return finalList
+
+def entrezSearch(searchParameters, concurrent=False):
 	'''
 	entrezSearch generates resultsList, which is
 	a list of all article URLs for each search term
@@ -99,6 +118,7 @@ def entrezSearch(searchParameters):
 	Args:
 		searchParameters (SearchParameters): SearchParameters object
 		containing search parameters assigned above
+		concurrent (bool): If True, send the esearch queries concurrently
 
 	Returns:
 		resultsList (list): list of all article URLs for each search term
@@ -106,7 +126,10 @@ def entrezSearch(searchParameters):
 	eSearchCore = 'http://eutils.ncbi.nlm.nih.gov/entrez//eutils/esearch.fcgi/?db=&term=&retmax=&retstart='
 	api = ncbi_api_key
 	eSearchLinkList = eSearchLinkGenerator(eSearchCore, searchParameters, api)
-	resultsList = PMID_ListGenerator(eSearchLinkList)
+	if concurrent:
+		resultsList = run_sync(PMID_ListGenerator_async(eSearchLinkList))
+	else:
+		resultsList = PMID_ListGenerator(eSearchLinkList)
 	return resultsList
 
 
@@ -126,7 +149,11 @@ def linksParser(termLinks, searchParameters, searchTerm):
 		searchHash['articleCount'] = articleCount
 		articleCount += 1
 		# Open, read and process link through BeautifulSoup
-		r1 = urllib.request.urlopen(link).read()
+		try:
+			r1 = read_url(link)
+		except UpstreamUnavailable:
+			print(f'  Skipped (PubMed unavailable): {link}')
+			continue
 		soup = BeautifulSoup(r1, "html.parser")
 		# ARTICLE NAME Parser
 		article_title = soup.find('title').text
@@ -164,8 +191,7 @@ def linksParser(termLinks, searchParameters, searchTerm):
 		searchHash['authors'] = author_list
 		searchHash['author_institutions'] = author_institutions
 		searchesHash[PMID] = searchHash
-		# pause for a second to avoid overloading the server
-		time.sleep(1)
+		# requests are paced by the shared per-host rate limiter
 		# AUTHOR AFFILIATION Parser
 		# author_soup = soup.find_all("span", {"class": "authors-list-item"})
 		# for index, author_info in enumerate(author_soup):
@@ -211,7 +237,7 @@ def semantic_scholar_query(PMID):
 	fields_str = ','.join(fields)
 	semantic_scholar_base = 'https://api.semanticscholar.org/graph/v1/paper/PMID:<>?fields=' + fields_str
 	semantic_scholar_url = semantic_scholar_base.replace('<>', PMID)
-	r = urllib.request.urlopen(semantic_scholar_url).read().decode('utf-8')
+	r = read_url(semantic_scholar_url).decode('utf-8')
 	ss_dict = json.loads(r)
 	citation_count = ss_dict['citationCount']
 	ss_weighted_citation_count = ss_dict['influentialCitationCount']
@@ -237,8 +263,17 @@ def semantic_scholar_search(searchesHash, verbose=False):
 		for r_index, PMID in enumerate(searchesHash[query]):
 			try:
 				citation_count, ss_citation_count = semantic_scholar_query(PMID)
-			# maximum requests hit for Semantic Scholar (100 per 5 minutes)			
-			except:
+			except UpstreamUnavailable:
+				print(f'  Skipped (Semantic Scholar unavailable): {PMID}')
+				citation_count = np.nan
+				ss_citation_count = np.nan
+			# paper not indexed, or still throttled (429) after the limiter's retries
+			except requests.HTTPError as e:
+				print(f'  Skipped (Semantic Scholar {e.response.status_code if e.response is not None else "error"}): {PMID}')
+				citation_count = np.nan
+				ss_citation_count = np.nan
+			# response without citation counts
+			except (ValueError, KeyError, TypeError):
 				citation_count = np.nan
 				ss_citation_count = np.nan
 			searchesHash[query][PMID]['citation_count'] = citation_count
@@ -255,8 +290,6 @@ def semantic_scholar_search(searchesHash, verbose=False):
 										prefix='\t'))
 				print(indent(pformat('Semantic Scholar Citation Count: {}'.format(ss_citation_count)),
 										prefix='\t'))
-			# pause for a second to avoid overloading the server
-			time.sleep(1)
 	return searchesHash
 
 
@@ -272,7 +305,7 @@ def construct_dataframe(searchesHash: dict) -> pd.DataFrame:
 		df (pandas dataframe): pandas dataframe containing all article data for each search term
 	"""
 	print('\nConstructing dataframe...')
-	df = pd.DataFrame()
+	author_rows = RowAccumulator(extend_columns=True)
 	for query in searchesHash.keys():
 		for PMID in searchesHash[query].keys():
 			for author in searchesHash[query][PMID]['authors']:
@@ -288,5 +321,6 @@ def construct_dataframe(searchesHash: dict) -> pd.DataFrame:
 				collaborators.remove(author)
 				authorHash_added['collaborators'] = collaborators
 				# append authorHash_added to df
-				df = pd.concat([df, pd.DataFrame([authorHash_added])], ignore_index=True)
+				author_rows.append(authorHash_added)
+	df = author_rows.to_frame()
 	return df
\ No newline at end of file
@@ -0,0 +1,157 @@
+import time
+import random
+import datetime
+import threading
+import email.utils
+from utils.api_keys import fda_api_key, ncbi_api_key
+
+# published quotas as (requests per second, burst size)
+host_rates = {
+	# E-utilities: 10 req/s with an API key, 3 req/s without
+	'eutils.ncbi.nlm.nih.gov': (10, 10) if ncbi_api_key else (3, 3),
+	'pubmed.ncbi.nlm.nih.gov': (3, 3),
+	# PUG REST: no more than 5 requests per second
+	'pubchem.ncbi.nlm.nih.gov': (5, 5),
+	# openFDA: 240 requests per minute per key
+	'api.fda.gov': (240/60, 4) if fda_api_key else (240/60, 1),
+	# Semantic Scholar (unauthenticated): 100 requests per 5 minutes
+	'api.semanticscholar.org': (100/300, 10),
+	# ClinicalTrials.gov v2: ~50 requests per minute
+	'clinicaltrials.gov': (50/60, 5),
+	'www.drugs.com': (2, 2),
+}
+default_rate = (2, 2)
+
+class TokenBucket:
+	'''
+	Thread-safe token bucket. The fill rate backs off when the host pushes back
+	(429/503) and recovers gradually on successful responses.
+	'''
+	def __init__(self, rate, capacity):
+		self.base_rate = rate
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+		self.updated = now
+
+	def acquire(self):
+		'''
+		Block until a token is available; returns the time spent waiting
+		'''
+		waited = 0
+		while True:
+			with self.lock:
+				self._refill()
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return waited
+				wait = (1 - self.tokens)/self.rate
+			time.sleep(wait)
+			waited += wait
+
+	def penalize(self, factor=0.5):
+		with self.lock:
+			self.rate = max(self.base_rate/16, self.rate*factor)
+
+	def reward(self, step=0.1):
+		with self.lock:
+			self.rate = min(self.base_rate, self.rate + step*self.base_rate)
+
+# maximum in-flight requests per host (kept at or below the session pool size)
+host_concurrency = {
+	'eutils.ncbi.nlm.nih.gov': 4,
+	'pubmed.ncbi.nlm.nih.gov': 4,
+	'pubchem.ncbi.nlm.nih.gov': 5,
+	'api.fda.gov': 4,
+	'api.semanticscholar.org': 2,
+	'clinicaltrials.gov': 4,
+	'www.drugs.com': 8,
+}
+default_concurrency = 4
+
+_buckets = {}
+_slots = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(host):
+	with _buckets_lock:
+		bucket = _buckets.get(host)
+		if bucket is None:
+			rate, capacity = host_rates.get(host, default_rate)
+			bucket = TokenBucket(rate, capacity)
+			_buckets[host] = bucket
+	return bucket
+
+def get_host_slots(host):
+	'''
+	Semaphore bounding concurrent requests to a host, shared by threads and the async engine
+	'''
+	with _buckets_lock:
+		slots = _slots.get(host)
+		if slots is None:
+			slots = threading.BoundedSemaphore(host_concurrency.get(host, default_concurrency))
+			_slots[host] = slots
+	return slots
+
+def set_host_concurrency(host, n_requests):
+	host_concurrency[host] = n_requests
+	with _buckets_lock:
+		_slots.pop(host, None)
+
+def set_host_rate(host, rate, capacity=None):
+	'''
+	Override the quota for a host (e.g. after registering a Semantic Scholar key)
+	'''
+	host_rates[host] = (rate, capacity if capacity is not None else max(1, rate))
+	with _buckets_lock:
+		_buckets.pop(host, None)
+
+def parse_retry_after(value):
+	'''
+	Retry-After is either delta-seconds or an HTTP date (None if it can't be
+	parsed, so the computed backoff is used)
+	'''
+	if value is None:
+		return None
+	try:
+		return max(0, float(value))
+	except (TypeError, ValueError):
+		pass
+	try:
+		retry_date = email.utils.parsedate_to_datetime(value)
+		if retry_date.tzinfo is None:
+			# '-0000' or no zone: HTTP dates are UTC
+			retry_date = retry_date.replace(tzinfo=datetime.timezone.utc)
+		return max(0, (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+	except Exception:
+		return None
+
+class RetryPolicy:
+	'''
+	Exponential backoff with full jitter. Client errors (404 etc.) fail fast,
+	throttling and gateway errors are retried, and Retry-After is honored.
+	'''
+	retry_status_codes = [408, 425, 429, 500, 502, 503, 504]
+	throttle_status_codes = [429, 503]
+
+	def __init__(self, max_tries=4, base_delay=0.5, max_delay=20, max_retry_after=120):
+		self.max_tries = max_tries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.max_retry_after = max_retry_after
+
+	def should_retry(self, status_code):
+		return status_code in self.retry_status_codes
+
+	def backoff(self, attempt, retry_after=None):
+		delay = random.uniform(0, min(self.max_delay, self.base_delay*2**attempt))
+		retry_after = parse_retry_after(retry_after)
+		if retry_after is not None:
+			delay = max(delay, min(retry_after, self.max_retry_after))
+		return delay
@@ -0,0 +1,100 @@
+import pandas as pd
+
+class RowAccumulator:
+	'''
+	Column buffers for building a DataFrame one row at a time. Rows are appended
+	to per-column lists and the DataFrame is materialized once by to_frame(),
+	instead of a pd.concat per row (which copies the whole frame every time).
+
+	columns : list of column names, or a {column: dtype} schema
+	          (dtypes are applied once, when the frame is materialized)
+	extend_columns : add columns for unknown keys of dict rows (earlier rows get None)
+	'''
+	def __init__(self, columns=[], dtype=None, extend_columns=False):
+		if isinstance(columns, dict):
+			self.dtypes = dict(columns)
+		else:
+			self.dtypes = {column: dtype for column in columns} if dtype is not None else {}
+		self.columns = list(columns)
+		self.buffers = {column: [] for column in self.columns}
+		self.extend_columns = extend_columns
+		self.n_rows = 0
+
+	def __len__(self):
+		return self.n_rows
+
+	def add_column(self, column):
+		self.columns.append(column)
+		self.buffers[column] = [None]*self.n_rows
+
+	def append(self, row):
+		'''
+		row: {column: value} (missing columns are None) or a sequence in column order
+		'''
+		if isinstance(row, dict):
+			for column in row:
+				if column not in self.buffers:
+					if not self.extend_columns:
+						raise KeyError(f'Unknown column: {column}')
+					self.add_column(column)
+			for column in self.columns:
+				self.buffers[column].append(row.get(column))
+		else:
+			row = list(row)
+			if len(row) != len(self.columns):
+				raise ValueError(f'{len(self.columns)} columns passed, passed data had {len(row)} columns')
+			for column, value in zip(self.columns, row):
+				self.buffers[column].append(value)
+		self.n_rows += 1
+
+	def extend(self, rows):
+		for row in rows:
+			self.append(row)
+
+	def to_frame(self):
+		df = pd.DataFrame({column: self.buffers[column] for column in self.columns}, columns=self.columns)
+		for column, dtype in self.dtypes.items():
+			df[column] = df[column].astype(dtype)
+		return df
+
+def as_set(value):
+	if value is None:
+		return set()
+	if isinstance(value, (list, tuple, set)):
+		return set(value)
+	return set([value])
+
+class MergingRowAccumulator(RowAccumulator):
+	'''
+	RowAccumulator that keeps one row per key (e.g. NCT Number): a hash lookup
+	on append, and a repeated key only adds its merge_columns values to that
+	row's sets (the rest of the repeat is dropped). Sets become sorted lists
+	in to_frame(). Memory scales with unique keys, not appended rows.
+	'''
+	def __init__(self, columns=[], key=None, merge_columns=[], dtype=None, extend_columns=False):
+		super().__init__(columns, dtype, extend_columns)
+		self.key = key
+		self.merge_columns = list(merge_columns)
+		self.index = {}
+		self.n_appended = 0
+
+	def append(self, row):
+		if not isinstance(row, dict):
+			row = list(row)
+			if len(row) != len(self.columns):
+				raise ValueError(f'{len(self.columns)} columns passed, passed data had {len(row)} columns')
+			row = dict(zip(self.columns, row))
+		self.n_appended += 1
+		r_index = self.index.get(row.get(self.key))
+		if r_index is not None:
+			for column in self.merge_columns:
+				self.buffers[column][r_index].update(as_set(row.get(column)))
+			return
+		self.index[row.get(self.key)] = self.n_rows
+		super().append(dict(row, **{column: as_set(row.get(column)) for column in self.merge_columns}))
+
+	def to_frame(self):
+		df = super().to_frame()
+		for column in self.merge_columns:
+			df[column] = [sorted(values, key=str) for values in df[column]]
+		return df
@@ -0,0 +1,140 @@
+import time
+import random
+import argparse
+import threading
+import http.server
+from collections import Counter
+from requests.utils import requote_uri
+from utils.cassettes import load_interactions, interaction_key, interaction_body
+from utils.rate_limiter import TokenBucket
+
+def request_url(request_path):
+	# /https/pubchem.ncbi.nlm.nih.gov/rest/... -> https://pubchem.ncbi.nlm.nih.gov/rest/...
+	# (paths without a scheme segment are https)
+	scheme, _, rest = request_path.lstrip('/').partition('/')
+	if scheme not in ['http', 'https']:
+		scheme, rest = 'https', request_path.lstrip('/')
+	return f'{scheme}://{rest}'
+
+def wire_key(interaction):
+	# interaction key with its URL requoted (the form body hash, if any, stays at the end)
+	method = interaction['key'].split(' ', 1)[0]
+	suffix = interaction['key'][len(f"{method} {interaction['url']}"):]
+	return f"{method} {requote_uri(interaction['url'])}{suffix}"
+
+class StandinServer:
+	'''
+	Local HTTP stand-in for the upstream APIs (PubChem, openFDA, ClinicalTrials.gov,
+	E-utilities, Semantic Scholar, drugs.com) that serves recorded cassettes.
+	Requests arrive as /<scheme>/<host>/<path>?<query> (see webpage_scraping.set_host_override),
+	with configurable latency, error rate and per-host rate limits.
+	'''
+	def __init__(self, cassette_paths, port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0, rate_limit=None, error_status_codes=[502, 503]):
+		if isinstance(cassette_paths, str):
+			cassette_paths = [cassette_paths]
+		self.interactions = {}
+		for path in cassette_paths:
+			self.interactions.update(load_interactions(path))
+		# keyed by the URL as it arrives on the wire (spaces etc. percent-encoded the way requests sends them)
+		self.wire_interactions = {wire_key(interaction): interaction for interaction in self.interactions.values()}
+		self.latency = latency
+		self.latency_jitter = latency_jitter
+		self.error_rate = error_rate
+		# requests per second allowed per host (None = unlimited)
+		self.rate_limit = rate_limit
+		self.error_status_codes = error_status_codes
+		self.buckets = {}
+		self.lock = threading.Lock()
+		self.stats = Counter()
+		server = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def log_message(self, *args):
+				pass
+			def do_GET(self):
+				server.handle(self)
+			def do_POST(self):
+				length = int(self.headers.get('content-length', 0))
+				server.handle(self, method='POST', data=self.rfile.read(length))
+		self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+		self.httpd.daemon_threads = True
+		self.thread = None
+
+	@property
+	def base_url(self):
+		return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+	def bucket(self, host):
+		with self.lock:
+			if host not in self.buckets:
+				self.buckets[host] = TokenBucket(self.rate_limit, max(1, self.rate_limit))
+			return self.buckets[host]
+
+	def try_acquire(self, host):
+		bucket = self.bucket(host)
+		with bucket.lock:
+			bucket._refill()
+			if bucket.tokens >= 1:
+				bucket.tokens -= 1
+				return True
+		return False
+
+	def handle(self, request, method='GET', data=None):
+		url = request_url(request.path)
+		host = url.split('/')[2]
+		self.stats['requests'] += 1
+		if self.latency or self.latency_jitter:
+			time.sleep(max(0, self.latency + random.uniform(-self.latency_jitter, self.latency_jitter)))
+		if self.rate_limit is not None and not self.try_acquire(host):
+			self.stats['throttled'] += 1
+			return self.reply(request, 429, b'', {'retry-after': '1'})
+		if random.random() < self.error_rate:
+			self.stats['errors'] += 1
+			return self.reply(request, random.choice(self.error_status_codes), b'')
+		interaction = self.wire_interactions.get(interaction_key(requote_uri(url), method, data))
+		if interaction is None:
+			self.stats['misses'] += 1
+			return self.reply(request, 404, b'')
+		self.stats['hits'] += 1
+		self.reply(request, interaction['status_code'], interaction_body(interaction), interaction['headers'])
+
+	def reply(self, request, status_code, body, headers={}):
+		request.send_response(status_code)
+		for header, value in headers.items():
+			request.send_header(header, value)
+		request.send_header('content-length', str(len(body)))
+		request.end_headers()
+		request.wfile.write(body)
+
+	def start(self):
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+		print(f'Stand-in server on {self.base_url} ({len(self.interactions)} recorded responses)')
+		return self.base_url
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve recorded cassettes as a local stand-in for the upstream APIs')
+	parser.add_argument('cassettes', nargs='+', help='cassette files (JSON lines) to serve')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--latency', type=float, default=0.0, help='added latency per request (s)')
+	parser.add_argument('--latency_jitter', type=float, default=0.0, help='uniform jitter around the latency (s)')
+	parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests answered with 502/503')
+	parser.add_argument('--rate_limit', type=float, default=None, help='requests per second per host before 429s')
+	args = parser.parse_args()
+	server = StandinServer(
+		args.cassettes,
+		port=args.port,
+		latency=args.latency,
+		latency_jitter=args.latency_jitter,
+		error_rate=args.error_rate,
+		rate_limit=args.rate_limit,
+	)
+	server.start()
+	try:
+		server.thread.join()
+	except KeyboardInterrupt:
+		server.stop()
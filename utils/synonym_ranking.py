@@ -0,0 +1,116 @@
+import re
+from collections import Counter
+
+synonym_config = {
+	# search terms kept per drug (None keeps every synonym)
+	'budget': 10,
+	# classes never searched (CT.gov records don't mention registry numbers)
+	'excluded_classes': ['registry'],
+}
+
+# search order: classes that name the drug in trial records come first
+class_rank = {
+	'inn': 0,
+	'brand': 1,
+	'code': 2,
+	'other': 3,
+	'chemical': 4,
+	'registry': 5,
+}
+
+registry_patterns = [
+	r'^\d{2,7}-\d{2}-\d$',                 # CAS
+	r'^(UNII|CAS|EINECS|EC|NSC|CHEBI|CHEMBL|SCHEMBL|DTXSID|DTXCID|ZINC|AKOS|MFCD|BDBM|NCGC|SMR|MLS|BRN|HSDB|CCRIS|KEGG|DB|CID|SID|HMS|BSPBIO|SPBIO|SPECTRUM|PRESTWICK|TOX21|CHEMDIV|STK|STL|ALBB|BIM|SBI|EN300|Q)[-_: ]?\d',
+	r'^(UNII|CAS|EINECS|EC|NSC|CHEBI|KEGG|WLN|BRN)[-_: ]',
+	r'^D\d{5}$',                           # KEGG drug
+	r'^\d{3}-\d{3}-\d$',                   # EC number
+	r'^(HY|CS|AC|AB|AS|AM|BC|BP|FT|GS|KS|SY|TS|SW|BS|AN|AK|NC|SR|ST)-[A-Z]?\d{3,}',  # vendor catalog codes
+]
+# INN stems (WHO stem book) that mark a capitalized single word as a generic name
+inn_stems = ['mab', 'cept', 'nib', 'tinib', 'ciclib', 'parib', 'lisib', 'pril', 'sartan', 'olol', 'dipine',
+	'azepam', 'azolam', 'oxetine', 'etine', 'triptyline', 'pramine', 'peridol', 'apine', 'idone', 'vir', 'previr',
+	'buvir', 'asvir', 'statin', 'vastatin', 'gliptin', 'gliflozin', 'glutide', 'tide', 'relin', 'parin', 'azole',
+	'conazole', 'prazole', 'oxacin', 'cillin', 'mycin', 'cycline', 'profen', 'coxib', 'fenac', 'amol',
+	'caine', 'tinel', 'stinel', 'setron', 'triptan', 'lukast', 'terol', 'sonide', 'olone', 'semide',
+	'thiazide', 'platin', 'taxel', 'rubicin', 'trexate', 'formin', 'dronate', 'xaban', 'gatran',
+	'grel', 'lutamide', 'strant', 'rozole', 'tecan', 'poetin', 'kinra', 'leukin']
+unii_pattern = r'^(?=.*\d)(?=.*[A-Z])[A-Z0-9]{10}$'
+chemical_pattern = r'[\(\)\[\]\{\}]|\d,\d|\d-[a-z]|[a-z]-\d|(yl|oxy|amino|amide|ic acid|ate|ene|ane|one|ol)\b.*\s|^[a-z]+-\d'
+code_pattern = r'^[A-Za-z]{1,6}[- ]?\d{2,7}[A-Za-z]?(\s?\(.*\))?$'
+salt_words = ['hydrochloride', 'dihydrochloride', 'hcl', 'sodium', 'potassium', 'calcium', 'magnesium', 'mesylate',
+	'maleate', 'fumarate', 'tartrate', 'bitartrate', 'citrate', 'phosphate', 'sulfate', 'succinate', 'acetate',
+	'besylate', 'tosylate', 'hydrobromide', 'bromide', 'chloride', 'monohydrate', 'dihydrate', 'trihydrate',
+	'hydrate', 'anhydrous', 'salt', 'free base', 'base']
+
+def is_unii(synonym):
+	'''
+	Bare UNII: 9 random base-36 characters plus a check character, so letters and
+	digits alternate in at least 4 runs (362O9ITL9D, R16CO5Y76E). Words, acronyms
+	and letter-prefix codes that happen to be 10 uppercase characters don't.
+	'''
+	if not re.search(unii_pattern, synonym):
+		return False
+	return len(re.findall(r'[A-Z]+|\d+', synonym)) >= 4
+
+def has_inn_stem(word):
+	return any(word.lower().endswith(stem) for stem in inn_stems)
+
+def classify_synonym(synonym):
+	'''
+	brand, inn, code (company code name), registry (CAS/UNII/database/vendor IDs),
+	chemical (IUPAC/systematic names) or other
+	'''
+	synonym = synonym.strip()
+	if is_unii(synonym) or any(re.search(pattern, synonym, flags=re.IGNORECASE if pattern.startswith('^(') else 0) for pattern in registry_patterns):
+		return 'registry'
+	if re.search(code_pattern, synonym):
+		return 'code'
+	if len(synonym) > 25 or re.search(chemical_pattern, synonym.lower()):
+		return 'chemical'
+	words = synonym.replace('®', '').replace('™', '').split()
+	if len(words) == 1 and words[0].isalpha():
+		word = words[0]
+		# trademark sign, or a capital after the first letter (NovoLog, ProAir)
+		if '®' in synonym or '™' in synonym or (any(c.isupper() for c in word[1:]) and not word.isupper()):
+			return 'brand'
+		if word.islower() or word.isupper() or has_inn_stem(word):
+			return 'inn'
+		# capitalized without an INN stem (Tylenol, Spravato, Humira)
+		return 'brand'
+	return 'other'
+
+def synonym_key(synonym):
+	'''
+	Near-duplicate key: case, punctuation, trademark signs and salt/hydrate words removed
+	'''
+	key = synonym.lower().replace('®', '').replace('™', '')
+	key = re.sub(r'\b(' + '|'.join(salt_words) + r')\b', ' ', key)
+	return re.sub(r'[^a-z0-9]', '', key)
+
+def rank_synonyms(synonyms, budget=-1, excluded_classes=None, keep=[]):
+	'''
+	Drop near-duplicates and excluded classes, order by class (then PubChem order)
+	and keep at most budget terms (default synonym_config). Terms in keep
+	(e.g. the drug name and active ingredient) always come first.
+	'''
+	if budget == -1:
+		budget = synonym_config['budget']
+	if excluded_classes is None:
+		excluded_classes = synonym_config['excluded_classes']
+	ranked = []
+	seen_keys = set()
+	for s_index, synonym in enumerate(keep + [synonym for synonym in synonyms if synonym not in keep]):
+		key = synonym_key(synonym)
+		if not key or key in seen_keys:
+			continue
+		seen_keys.add(key)
+		synonym_class = classify_synonym(synonym)
+		if synonym in keep:
+			ranked.append((-1, s_index, synonym))
+		elif synonym_class not in excluded_classes:
+			ranked.append((class_rank[synonym_class], s_index, synonym))
+	ranked = [synonym for _, _, synonym in sorted(ranked)]
+	return ranked[:budget] if budget is not None else ranked
+
+def synonym_class_counts(synonyms):
+	return Counter([classify_synonym(synonym) for synonym in synonyms])
@@ -0,0 +1,157 @@
+import json
+import threading
+import urllib.parse
+from collections import Counter, defaultdict
+
+# latency histogram bucket upper bounds (seconds)
+latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf')]
+# path segments that carry a free-form value right after them (PubChem PUG REST namespaces)
+value_namespaces = ['name', 'cid', 'sid', 'aid', 'inchikey', 'smiles', 'formula']
+
+def endpoint_template(url):
+	'''
+	Collapse request-specific parts of a URL into an endpoint template, e.g.
+	/rest/pug/compound/name/aspirin/cids/JSON -> /rest/pug/compound/name/{name}/cids/JSON
+	https://pubmed.ncbi.nlm.nih.gov/31234567   -> /{id}
+	?api_key=..&search=aspirin                 -> ?search
+	'''
+	url_split = urllib.parse.urlsplit(url)
+	segments = url_split.path.split('/')
+	template = []
+	for s_index, segment in enumerate(segments):
+		if s_index > 0 and segments[s_index-1] in value_namespaces:
+			segment = '{' + segments[s_index-1] + '}'
+		elif any(char.isdigit() for char in segment):
+			segment = '{id}.html' if segment.endswith('.html') else '{id}'
+		elif segment.endswith('.html') and s_index > 1:
+			segment = '{page}.html'
+		template.append(segment)
+	template = '/'.join(template)
+	params = sorted(set([param.split('=')[0] for param in url_split.query.split('&') if param]) - set(['api_key']))
+	if params:
+		template += '?' + '&'.join(params)
+	return template
+
+class EndpointStats:
+	def __init__(self):
+		self.count = 0
+		self.errors = 0
+		self.latency_sum = 0.0
+		self.latency_counts = [0]*len(latency_buckets)
+		self.bytes = 0
+		self.retries = 0
+		self.status_codes = Counter()
+		self.cache = Counter()
+
+	def observe(self, elapsed, status_code, n_bytes, retries, cache_status):
+		self.count += 1
+		self.latency_sum += elapsed
+		for b_index, bound in enumerate(latency_buckets):
+			if elapsed <= bound:
+				self.latency_counts[b_index] += 1
+				break
+		self.bytes += n_bytes
+		self.retries += retries
+		self.status_codes[str(status_code)] += 1
+		if status_code == 'error':
+			self.errors += 1
+		if cache_status is not None:
+			self.cache[cache_status] += 1
+
+	def to_dict(self):
+		cumulative = 0
+		histogram = {}
+		for bound, count in zip(latency_buckets, self.latency_counts):
+			cumulative += count
+			histogram['+Inf' if bound == float('inf') else str(bound)] = cumulative
+		return {
+			'count': self.count,
+			'errors': self.errors,
+			'latency_sum': round(self.latency_sum, 6),
+			'latency_mean': round(self.latency_sum/self.count, 6) if self.count else None,
+			'latency_histogram': histogram,
+			'bytes': self.bytes,
+			'retries': self.retries,
+			'status_codes': dict(self.status_codes),
+			'cache': dict(self.cache),
+		}
+
+_stats = defaultdict(EndpointStats)
+_stats_lock = threading.Lock()
+
+def record_request(url, elapsed, response=None):
+	'''
+	Record one request made through test_connection (response=None for a failed request)
+	'''
+	host = urllib.parse.urlsplit(url).netloc.lower()
+	if response is None:
+		status_code, n_bytes, retries, cache_status = 'error', 0, 0, None
+	else:
+		status_code = 'unavailable' if getattr(response, 'upstream_unavailable', False) else response.status_code
+		n_bytes = len(response.content or b'')
+		retries = getattr(response, 'retries', 0)
+		cache_status = getattr(response, 'cache_status', None)
+	with _stats_lock:
+		_stats[(host, endpoint_template(url))].observe(elapsed, status_code, n_bytes, retries, cache_status)
+
+def reset_telemetry():
+	with _stats_lock:
+		_stats.clear()
+
+def telemetry_snapshot():
+	with _stats_lock:
+		return [
+			dict(host=host, endpoint=endpoint, **stats.to_dict())
+			for (host, endpoint), stats in sorted(_stats.items())
+		]
+
+def escape_label(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text(prefix='fda_scraper_http'):
+	'''
+	Snapshot in the Prometheus text exposition format
+	'''
+	lines = [
+		f'# HELP {prefix}_request_duration_seconds Request latency, including cache hits and retries.',
+		f'# TYPE {prefix}_request_duration_seconds histogram',
+	]
+	snapshot = telemetry_snapshot()
+	for stats in snapshot:
+		labels = f'host="{escape_label(stats["host"])}",endpoint="{escape_label(stats["endpoint"])}"'
+		for bound, count in stats['latency_histogram'].items():
+			lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+		lines.append(f'{prefix}_request_duration_seconds_sum{{{labels}}} {stats["latency_sum"]}')
+		lines.append(f'{prefix}_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+	metrics = [
+		('requests_total', 'counter', 'Requests by status code.', lambda stats: [({'status': status}, count) for status, count in stats['status_codes'].items()]),
+		('response_bytes_total', 'counter', 'Response body bytes.', lambda stats: [({}, stats['bytes'])]),
+		('retries_total', 'counter', 'Retried attempts.', lambda stats: [({}, stats['retries'])]),
+		('cache_total', 'counter', 'Response cache results (hit, miss, revalidated, stale, offline_miss, cassette, coalesced).', lambda stats: [({'result': result}, count) for result, count in stats['cache'].items()]),
+	]
+	for name, metric_type, help_text, values in metrics:
+		lines.append(f'# HELP {prefix}_{name} {help_text}')
+		lines.append(f'# TYPE {prefix}_{name} {metric_type}')
+		for stats in snapshot:
+			for extra_labels, value in values(stats):
+				labels = {'host': stats['host'], 'endpoint': stats['endpoint'], **extra_labels}
+				label_str = ','.join([f'{key}="{escape_label(str(label))}"' for key, label in labels.items()])
+				lines.append(f'{prefix}_{name}{{{label_str}}} {value}')
+	return '\n'.join(lines) + '\n'
+
+def write_telemetry(path):
+	'''
+	Write the snapshot to <path>.json and <path>.prom
+	'''
+	with open(f'{path}.json', 'w') as f:
+		json.dump(telemetry_snapshot(), f, indent=2)
+	with open(f'{path}.prom', 'w') as f:
+		f.write(prometheus_text())
+	print(f'  Telemetry written to {path}.json / {path}.prom')
+
+def print_telemetry_summary(top_n=10):
+	snapshot = sorted(telemetry_snapshot(), key=lambda stats: stats['latency_sum'], reverse=True)
+	print('Slowest endpoints (total time):')
+	for stats in snapshot[:top_n]:
+		cache_hits = stats['cache'].get('hit', 0)
+		print(f'  {stats["latency_sum"]:8.1f}s  n={stats["count"]:<5} hits={cache_hits:<5} retries={stats["retries"]:<3} {stats["host"]}{stats["endpoint"]}')
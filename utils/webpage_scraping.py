@@ -1,32 +1,262 @@
 import time
+import threading
+import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
+from utils.http_cache import get_cache, cache_key
+from utils.rate_limiter import get_bucket, get_host_slots, RetryPolicy
+from utils.cassettes import get_cassette
+from utils.telemetry import record_request
+from utils.circuit_breaker import get_breaker, is_unavailable, UnavailableResponse, UpstreamUnavailable
 
-def test_connection(url, sleep_time=20):
-	headers = {"user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.182 Safari/537.36"}
-	# use a while loop to keep trying to connect until it works, for a maximum of 5 times
-	max_tries = 2
-	for i in range(max_tries):
+# default headers for every session (gzip/deflate bodies are decoded transparently by requests)
+default_headers = {
+	"user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.182 Safari/537.36",
+	"accept-encoding": "gzip, deflate",
+	"connection": "keep-alive",
+}
+
+# pool sizes and (connect, read) timeouts shared by all host sessions
+session_config = {
+	'pool_connections': 4,
+	'pool_maxsize': 16,
+	'timeout': (10, 60),
+}
+
+# one keep-alive session per host, shared by every scraper in the process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# {host: base_url} redirects, e.g. to a local stand-in server ('*' matches every host)
+host_overrides = {}
+
+def get_host(url):
+	return urllib.parse.urlsplit(url).netloc.lower()
+
+def set_host_override(host, base_url):
+	'''
+	Send requests for host to base_url instead, as <base_url>/<scheme>/<host>/<path>?<query>
+	(pass base_url=None to remove the override)
+	'''
+	if base_url is None:
+		host_overrides.pop(host, None)
+	else:
+		host_overrides[host] = base_url.rstrip('/')
+
+def rewrite_url(url):
+	url_split = urllib.parse.urlsplit(url)
+	base_url = host_overrides.get(url_split.netloc.lower(), host_overrides.get('*'))
+	if base_url is None:
+		return url
+	rewritten = f'{base_url}/{url_split.scheme or "https"}/{url_split.netloc.lower()}{url_split.path}'
+	if url_split.query:
+		rewritten += f'?{url_split.query}'
+	return rewritten
+
+def configure_session(pool_connections=None, pool_maxsize=None, timeout=None):
+	'''
+	Update the pool sizes/timeouts used by the shared sessions.
+	Open sessions are closed so the new settings apply on next use.
+	'''
+	if pool_connections is not None:
+		session_config['pool_connections'] = pool_connections
+	if pool_maxsize is not None:
+		session_config['pool_maxsize'] = pool_maxsize
+	if timeout is not None:
+		session_config['timeout'] = timeout
+	close_sessions()
+
+def get_session(url):
+	'''
+	Get the pooled keep-alive session for the host of url, creating it on first use
+	'''
+	host = get_host(url)
+	with _sessions_lock:
+		session = _sessions.get(host)
+		if session is None:
+			session = requests.Session()
+			adapter = HTTPAdapter(
+				pool_connections=session_config['pool_connections'],
+				pool_maxsize=session_config['pool_maxsize'],
+			)
+			session.mount('https://', adapter)
+			session.mount('http://', adapter)
+			session.headers.update(default_headers)
+			_sessions[host] = session
+	return session
+
+def close_sessions():
+	with _sessions_lock:
+		for session in _sessions.values():
+			session.close()
+		_sessions.clear()
+
+def get_with_retries(url, sleep_time=20, timeout=None, headers=None, data=None):
+	'''
+	GET (POST when data is given) through the host's token bucket, retrying transient failures with jittered
+	exponential backoff (sleep_time caps a single backoff delay). Hosts whose circuit
+	breaker is open get an UnavailableResponse straight away.
+	'''
+	if timeout is None:
+		timeout = session_config['timeout']
+	host = get_host(url)
+	method = 'GET' if data is None else 'POST'
+	request_url = rewrite_url(url)
+	session = get_session(request_url)
+	# limits stay keyed on the upstream host, even when redirected to a stand-in
+	bucket = get_bucket(host)
+	slots = get_host_slots(host)
+	breaker = get_breaker(host)
+	if not breaker.allow_request():
+		return UnavailableResponse(url, host)
+	policy = RetryPolicy(max_delay=sleep_time)
+	for i in range(policy.max_tries):
+		last_try = i == policy.max_tries - 1
 		try:
-			response = requests.get(url, headers=headers)
-		except requests.exceptions.ConnectionError:
-			print(f'  Connection error: waiting {sleep_time}s before trying again (n={i}/{max_tries})...')
-			time.sleep(20)
-			response = requests.get(url, headers=headers)
-		# also except ChunkedEncodingError
-		except requests.exceptions.ChunkedEncodingError:
-			print(f'  Chunked encoding error: waiting {sleep_time}s before trying again (n={i}/{max_tries})...')
-			time.sleep(20)
-			response = requests.get(url, headers=headers)
-		if response.status_code == 200:
+			# hold a host slot only while the request is in flight (not while backing off)
+			with slots:
+				bucket.acquire()
+				response = session.request(method, request_url, data=data, timeout=timeout, headers=headers)
+		# also retry ChunkedEncodingError
+		except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+			if last_try or breaker.state == 'open':
+				print(f'  {type(e).__name__}: giving up on {host} (n={i+1}/{policy.max_tries})...')
+				breaker.record_failure()
+				return UnavailableResponse(url, host)
+			delay = policy.backoff(i)
+			print(f'  {type(e).__name__}: waiting {delay:.1f}s before trying again (n={i+1}/{policy.max_tries})...')
+			time.sleep(delay)
+			continue
+		# anything else (InvalidURL, TooManyRedirects, ...) isn't retried, but still counts
+		# as a failed request so a half-open trial never stays in flight
+		except Exception:
+			breaker.record_failure()
+			raise
+		# retried attempts, for telemetry
+		response.retries = i
+		# 404 and other client errors fail fast
+		if not policy.should_retry(response.status_code):
+			bucket.reward()
+			breaker.record_success()
 			return response
-		if response.status_code == 404:
-			# print(f'  Status code {response.status_code}: {url} does not exist...')
+		if response.status_code in policy.throttle_status_codes:
+			bucket.penalize()
+		# stop retrying once the host has been marked down (e.g. by another thread)
+		if last_try or breaker.state == 'open':
 			break
-			return response
-		if response.status_code == 502:
-			# print(f'  Status code {response.status_code}: waiting {sleep_time}s before trying again (n={i}/{max_tries})...')
-			time.sleep(sleep_time)
-		else:
-			# print(f'  Status code {response.status_code} for {url}')
-			time.sleep(sleep_time)
-	return response
\ No newline at end of file
+		delay = policy.backoff(i, response.headers.get('retry-after'))
+		# print(f'  Status code {response.status_code}: waiting {delay:.1f}s before trying again (n={i+1}/{policy.max_tries})...')
+		time.sleep(delay)
+	breaker.record_failure()
+	return response
+
+def test_connection(url, sleep_time=20, timeout=None, data=None):
+	start_time = time.perf_counter()
+	try:
+		response = coalesced_get(url, sleep_time, timeout, data)
+	except Exception:
+		record_request(url, time.perf_counter() - start_time)
+		raise
+	record_request(url, time.perf_counter() - start_time, response)
+	return response
+
+class InFlight:
+	def __init__(self):
+		self.done = threading.Event()
+		self.response = None
+		self.error = None
+
+# {request key: InFlight} for requests currently on their way
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def share_response(response):
+	# shallow copy so followers can't clobber the leader's cache_status/retries
+	shared = object.__new__(type(response))
+	shared.__dict__.update(response.__dict__)
+	return shared
+
+def coalesced_get(url, sleep_time=20, timeout=None, data=None):
+	'''
+	Single-flight: identical requests made while one is already in flight wait
+	for it and get a copy of its response instead of hitting the network again
+	'''
+	key = cache_key(url, 'GET' if data is None else 'POST', data)
+	with _in_flight_lock:
+		flight = _in_flight.get(key)
+		leader = flight is None
+		if leader:
+			flight = _in_flight[key] = InFlight()
+	if not leader:
+		flight.done.wait()
+		if flight.error is not None:
+			raise flight.error
+		response = share_response(flight.response)
+		response.retries = 0
+		response.cache_status = 'coalesced'
+		return response
+	try:
+		flight.response = cassette_get(url, sleep_time, timeout, data)
+	except Exception as e:
+		flight.error = e
+		raise
+	finally:
+		with _in_flight_lock:
+			del _in_flight[key]
+		flight.done.set()
+	return flight.response
+
+def cassette_get(url, sleep_time=20, timeout=None, data=None):
+	method = 'GET' if data is None else 'POST'
+	cassette = get_cassette()
+	if cassette is not None and cassette.mode == 'replay':
+		response = cassette.play(url, method, data)
+		response.cache_status = 'cassette'
+		return response
+	response = cached_get(url, sleep_time, timeout, data)
+	if cassette is not None and not is_unavailable(response):
+		cassette.record(url, response, method, data)
+	return response
+
+def cached_get(url, sleep_time=20, timeout=None, data=None):
+	method = 'GET' if data is None else 'POST'
+	cache = get_cache()
+	if cache is None:
+		return get_with_retries(url, sleep_time, timeout, data=data)
+	# fresh hits (or any hit when offline) never touch the network
+	entry = cache.lookup(url, method, data)
+	if entry is not None and (cache.mode == 'offline' or cache.is_fresh(entry)):
+		response = cache.to_response(entry)
+		response.cache_status = 'hit'
+		return response
+	if cache.mode == 'offline':
+		response = cache.miss_response(url)
+		response.cache_status = 'offline_miss'
+		return response
+	# stale entries are revalidated with If-None-Match / If-Modified-Since
+	response = get_with_retries(url, sleep_time, timeout, headers=cache.revalidation_headers(entry), data=data)
+	# serve a stale copy rather than nothing while the host is down
+	if is_unavailable(response) and entry is not None:
+		stale = cache.to_response(entry)
+		stale.cache_status = 'stale'
+		return stale
+	if response.status_code == 304 and entry is not None:
+		cache.refresh(entry)
+		revalidated = cache.to_response(entry)
+		revalidated.retries = getattr(response, 'retries', 0)
+		revalidated.cache_status = 'revalidated'
+		return revalidated
+	cache.store(url, response, method, data)
+	response.cache_status = 'miss'
+	return response
+
+def read_url(url, timeout=None):
+	'''
+	Drop-in for urllib.request.urlopen(url).read() that goes through the shared session
+	(raises requests.HTTPError on a failed response, like urlopen does)
+	'''
+	response = test_connection(url, timeout=timeout)
+	if is_unavailable(response):
+		raise UpstreamUnavailable(response.host)
+	response.raise_for_status()
+	return response.content